@@ -0,0 +1,214 @@
+"""Route chaining: offer open errands to runners whose current errand ends close to them.
+
+A runner holding RUNNER_MAX_ACTIVE_ERRANDS IN_PROGRESS errands is not available for matching, but
+once those are done they may be standing next to another open errand's go_to. Chaining is the
+only path that offers such a runner more errands, up to ERRAND_CHAIN_MAX_ACTIVE_ERRANDS in
+progress at once: runners at that cap are neither planned nor offered chained errands. Every ERRAND_CHAIN_REFRESH_SECONDS,
+`manage.py run_chain_planner` (`plan_chains`) looks at each online runner's current route:
+
+    runner position -> go_to of each in-progress errand (-> return_to for round trips)
+
+For the open errands near the end of that route, it computes the cheapest way to insert the
+errand's stops:
+- cheapest insertion after every committed stop, so no buyer the runner already serves is
+  delayed (round trips keep their return_to before the new errand),
+- then a bounded 2-opt pass over the new stops, keeping each go_to before its return_to.
+
+Distances come from the matching travel provider (road matrix, or straight line). The options
+whose extra distance (detour) stays under ERRAND_CHAIN_MAX_DETOUR_M are stored in the cache per
+errand, with the runner's quoted distance counted from the stop just before the new go_to: the
+new buyer does not pay for the legs of the errands before it. Offer waves
+(`tasks.dispatch_next_wave`) put those runners first in the errand's first wave, so fewer
+runners drive an empty leg.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from apps.errands.models import Errand
+from apps.errands.services import open_errands_near
+from apps.locations.grid import region_for
+from apps.locations.service_areas import service_area_for
+from errand_location.models import ErrandLocation
+from runners.models import RunnerPresence
+from runners.travel import get_travel_provider
+
+logger = logging.getLogger(__name__)
+
+CHAIN_KEY = "errands:chain:{errand_id}"
+TWO_OPT_PASSES = 2
+
+
+class ChainOption(NamedTuple):
+    runner_id: int
+    detour_m: float
+    # Leg from the previous stop to the errand's go_to on the new route, used for the offer quote
+    distance_m: float
+
+
+class Stop(NamedTuple):
+    errand_id: int
+    latitude: float
+    longitude: float
+    # A return_to stop must come after the go_to stop of the same errand
+    is_return: bool = False
+
+
+def _stops_for(errand_id, go_to, return_to=None):
+    stops = [Stop(errand_id, float(go_to.latitude), float(go_to.longitude))]
+    if return_to is not None:
+        stops.append(Stop(errand_id, float(return_to.latitude), float(return_to.longitude), True))
+    return stops
+
+
+class RouteCost:
+    """Route lengths with the provider's pairwise distances memoised for one planning run."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._memo = {}
+
+    def leg(self, a, b):
+        key = (a[0], a[1], b[0], b[1])
+        if key not in self._memo:
+            self._memo[key] = float(self.provider.distance_m((a[0], a[1]), (b[0], b[1])))
+        return self._memo[key]
+
+    def length(self, start, stops):
+        points = [start] + [(s.latitude, s.longitude) for s in stops]
+        return sum(self.leg(a, b) for a, b in zip(points, points[1:]))
+
+
+def _valid(stops):
+    seen = set()
+    for stop in stops:
+        if stop.is_return and stop.errand_id not in seen:
+            return False
+        if not stop.is_return:
+            seen.add(stop.errand_id)
+    return True
+
+
+def insert_errand(costs, start, route, new_stops, fixed=None):
+    """Cheapest insertion of `new_stops` (go_to, then optionally return_to) into `route` after its
+    first `fixed` stops (default all of them: the runner's committed stops stay first and in
+    order), improved by up to TWO_OPT_PASSES 2-opt passes over the free tail.
+    Returns (new route, new length)."""
+    fixed = len(route) if fixed is None else fixed
+    best, best_length = None, float("inf")
+    go_to, rest = new_stops[0], new_stops[1:]
+    for i in range(min(fixed, len(route)), len(route) + 1):
+        with_go_to = route[:i] + [go_to] + route[i:]
+        positions = range(i + 1, len(with_go_to) + 1) if rest else [None]
+        for j in positions:
+            candidate = with_go_to if j is None else with_go_to[:j] + rest + with_go_to[j:]
+            length = costs.length(start, candidate)
+            if length < best_length:
+                best, best_length = candidate, length
+
+    for _ in range(TWO_OPT_PASSES):
+        improved = False
+        for i in range(min(fixed, len(best)), len(best) - 1):
+            for j in range(i + 2, len(best) + 1):
+                candidate = best[:i] + best[i:j][::-1] + best[j:]
+                if not _valid(candidate):
+                    continue
+                length = costs.length(start, candidate)
+                if length < best_length - 1e-6:
+                    best, best_length, improved = candidate, length, True
+        if not improved:
+            break
+    return best, best_length
+
+
+def approach_distance(costs, start, route, errand_id):
+    """Leg to the go_to of `errand_id` from the stop before it on `route` (or from `start`)."""
+    here = start
+    for stop in route:
+        if stop.errand_id == errand_id and not stop.is_return:
+            return costs.leg(here, (stop.latitude, stop.longitude))
+        here = (stop.latitude, stop.longitude)
+    raise ValueError(f"errand {errand_id} has no go_to on the route")
+
+
+def chain_capacity():
+    """Most IN_PROGRESS errands a runner may hold and still be offered a chained one."""
+    return getattr(settings, 'ERRAND_CHAIN_MAX_ACTIVE_ERRANDS', 2)
+
+
+def _current_routes():
+    """{runner_id: (runner position, committed stops, region, service area)} for online runners
+    with IN_PROGRESS errands and room for another one, stops in the order the errands were accepted."""
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300))
+    errands = (
+        Errand.objects.filter(status=Errand.Status.IN_PROGRESS, runner__isnull=False, go_to__isnull=False)
+        .filter(runner__presence__is_online=True, runner__presence__last_heartbeat_at__gte=cutoff, runner__location__isnull=False)
+        .filter(runner__presence__active_errand_count__lt=chain_capacity())
+        .select_related("go_to", "return_to", "runner__location")
+        .order_by("runner_id", "accepted_at", "id")
+    )
+    routes = {}
+    for errand in errands:
+        if errand.runner_id not in routes:
+            location = errand.runner.location
+            routes[errand.runner_id] = (
+                (float(location.latitude), float(location.longitude)), [],
+                region_for(errand.go_to.latitude, errand.go_to.longitude),
+                service_area_for(errand.go_to.latitude, errand.go_to.longitude),
+            )
+        routes[errand.runner_id][1].extend(_stops_for(errand.id, errand.go_to, errand.return_to))
+    return routes
+
+
+def plan_chains():
+    """Recompute the chaining options of every open errand near a busy runner's route end and
+    store them in the cache. Returns the number of (runner, errand) options stored."""
+    max_detour_m = float(getattr(settings, 'ERRAND_CHAIN_MAX_DETOUR_M', 1500))
+    radius_m = float(getattr(settings, 'ERRAND_CHAIN_SEARCH_RADIUS_M', 3000))
+    per_runner = int(getattr(settings, 'ERRAND_CHAIN_CANDIDATES', 10))
+    costs = RouteCost(get_travel_provider())
+
+    options = defaultdict(list)
+    for runner_id, (start, route, region, service_area_id) in _current_routes().items():
+        end = route[-1]
+        nearby = [
+            e for e in open_errands_near(end.latitude, end.longitude, radius_m, limit=per_runner)
+            if not e.out_of_area and e.user_id != runner_id
+            and region_for(e.go_to.latitude, e.go_to.longitude) == region
+            and service_area_for(e.go_to.latitude, e.go_to.longitude) == service_area_id
+        ]
+        if not nearby:
+            continue
+        return_tos = ErrandLocation.objects.in_bulk([e.return_to_id for e in nearby if e.return_to_id])
+        current_length = costs.length(start, route)
+        for errand in nearby:
+            new_route, length = insert_errand(costs, start, route, _stops_for(errand.id, errand.go_to, return_tos.get(errand.return_to_id)))
+            detour_m = length - current_length
+            if detour_m <= max_detour_m:
+                options[errand.id].append(ChainOption(runner_id, detour_m, approach_distance(costs, start, new_route, errand.id)))
+
+    ttl = 3 * getattr(settings, 'ERRAND_CHAIN_REFRESH_SECONDS', 20)
+    cache.set_many({CHAIN_KEY.format(errand_id=e): sorted(opts, key=lambda o: o.detour_m) for e, opts in options.items()}, timeout=ttl)
+    stored = sum(len(opts) for opts in options.values())
+    logger.info("plan_chains: %s chaining options for %s open errands", stored, len(options))
+    return stored
+
+
+def chain_options(errand_id):
+    """Chaining runners for an open errand, smallest detour first (empty until planned).
+
+    Options are planned up to 3 refresh periods ago: runners who have since reached
+    chain_capacity() are dropped."""
+    options = cache.get(CHAIN_KEY.format(errand_id=errand_id)) or []
+    if not options:
+        return []
+    with_room = set(
+        RunnerPresence.objects.filter(user_id__in=[o.runner_id for o in options], active_errand_count__lt=chain_capacity())
+        .values_list("user_id", flat=True)
+    )
+    return [o for o in options if o.runner_id in with_room]
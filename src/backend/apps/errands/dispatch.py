@@ -0,0 +1,317 @@
+"""Routing of per-errand matching work to matching worker processes by grid cell.
+
+Matching workers (`manage.py run_matching_worker`) register their socket address in the cache and
+renew it every few seconds. Web processes and workers build the same consistent-hash ring over the
+live workers. The errand's go_to grid cell (see apps.locations.grid) decides which worker owns it,
+so all matching work for one area lands in the same process and any per-process state about that
+area stays warm:
+
+- CreateErrand hands the new errand to the owner (`dispatcher.dispatch`).
+- Follow-up offer waves are re-routed when their delayed job runs (`dispatcher.follow_up`), so
+  they move with the cell when ownership changes.
+- Each worker periodically sweeps the open errands of the cells it owns whose offers have run
+  out (`MatchingWorker.sweep`). This re-offers or expires errands whose follow-up jobs were lost
+  with a worker that left. Without workers, the periodic "errands.sweep" job does this for all
+  cells (apps.errands.tasks).
+
+A worker joining or leaving only moves the cells between it and its ring neighbours. When no
+worker is registered or the owner cannot be reached, the work goes to this process's job queue
+(apps.utils.jobs).
+
+Wire protocol: one JSON object per line in each direction, like the runner index.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import socketserver
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.errands.models import Errand, ErrandOffer
+from apps.locations.grid import grid_cell_for
+from apps.utils import jobs
+from runners.index import bind_server, connect
+
+logger = logging.getLogger(__name__)
+
+WORKER_KEY = "errands:matching-worker:{worker_id}"
+WORKERS_KEY = "errands:matching-workers"
+WORKERS_LOCK_KEY = "errands:matching-workers:lock"
+
+# Job run for each op a worker accepts
+OP_JOBS = {"match": "errands.match", "advance": "errands.advance"}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring: each node is placed at `replicas` points and a key belongs to the
+    first node point at or after the key's hash."""
+
+    def __init__(self, nodes=(), replicas=None):
+        replicas = replicas or getattr(settings, 'ERRAND_DISPATCH_VNODES', 64)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def __bool__(self):
+        return bool(self._nodes)
+
+    def owner(self, key):
+        if not self._nodes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+# =====================
+# WORKER REGISTRY
+# =====================
+
+def _update_workers(change):
+    """Rewrite the registered worker id set with `change(ids)` under a cache lock (`cache.add` is
+    atomic on every backend), so workers registering together do not drop each other. Returns
+    False when the lock could not be taken; registrations retry on the next heartbeat."""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + 1.0
+    while not cache.add(WORKERS_LOCK_KEY, token, timeout=5):
+        if time.monotonic() >= deadline:
+            logger.warning("_update_workers: worker registry is locked; retrying later")
+            return False
+        time.sleep(0.01)
+    try:
+        workers = cache.get(WORKERS_KEY) or set()
+        updated = change(set(workers))
+        if updated != workers:
+            cache.set(WORKERS_KEY, updated, timeout=None)
+    finally:
+        # get-then-delete: at worst a lock taken in between is released early
+        if cache.get(WORKERS_LOCK_KEY) == token:
+            cache.delete(WORKERS_LOCK_KEY)
+    return True
+
+
+def register_worker(worker_id, address):
+    """Announce (or renew) a live worker; it drops out of the ring if not renewed within
+    ERRAND_WORKER_TTL_SECONDS."""
+    cache.set(WORKER_KEY.format(worker_id=worker_id), address, timeout=getattr(settings, 'ERRAND_WORKER_TTL_SECONDS', 15))
+    if worker_id not in (cache.get(WORKERS_KEY) or set()):
+        _update_workers(lambda ids: ids | {worker_id})
+
+
+def unregister_worker(worker_id):
+    cache.delete(WORKER_KEY.format(worker_id=worker_id))
+    _update_workers(lambda ids: ids - {worker_id})
+
+
+def live_workers():
+    """{worker_id: address} of the workers whose registration has not expired. Ids of expired
+    ones (crashed workers) are pruned from the registry; a late worker re-adds itself on renewal."""
+    workers = cache.get(WORKERS_KEY) or set()
+    addresses = cache.get_many([WORKER_KEY.format(worker_id=w) for w in workers])
+    live = {w: addresses[WORKER_KEY.format(worker_id=w)] for w in workers if WORKER_KEY.format(worker_id=w) in addresses}
+    expired = workers - set(live)
+    if expired:
+        logger.info("live_workers: pruning %s expired workers", len(expired))
+        _update_workers(lambda ids: ids - expired)
+    return live
+
+
+def stalled_errands(now):
+    """(errand_id, go_to lat, go_to lon) of open errands whose offers ran out more than one offer
+    TTL and sweep interval ago: their follow-up job was lost."""
+    grace = timedelta(seconds=getattr(settings, 'ERRAND_OFFER_TTL_SECONDS', 60) + getattr(settings, 'ERRAND_WORKER_SWEEP_SECONDS', 30))
+    live_offers = ErrandOffer.objects.filter(status=ErrandOffer.Status.PENDING, expires_at__gt=now)
+    return (
+        Errand.objects.filter(
+            status=Errand.Status.PENDING, is_open=True, out_of_area=False, go_to__isnull=False, updated_at__lt=now - grace
+        )
+        .exclude(id__in=live_offers.values("errand_id"))
+        .values_list("id", "go_to__latitude", "go_to__longitude")
+    )
+
+
+# =====================
+# DISPATCHER
+# =====================
+
+def errand_cell(errand_id):
+    """Grid cell of an errand's go_to, or None when the errand or its go_to is gone."""
+    row = Errand.objects.filter(id=errand_id, go_to__isnull=False).values_list("go_to__latitude", "go_to__longitude").first()
+    return grid_cell_for(*row) if row else None
+
+
+class MatchingDispatcher:
+    """Routes matching work for a cell to the worker owning it. `worker_id` is set in matching
+    worker processes so they keep the work they own."""
+
+    def __init__(self):
+        self.worker_id = None
+        self._lock = threading.Lock()
+        self._ring = HashRing()
+        self._addresses = {}
+        self._refreshed_at = float("-inf")
+
+    def ring(self):
+        """The ring of live workers, re-read from the cache every ERRAND_DISPATCH_RING_REFRESH_SECONDS."""
+        if time.monotonic() - self._refreshed_at >= getattr(settings, 'ERRAND_DISPATCH_RING_REFRESH_SECONDS', 5):
+            addresses = live_workers()
+            with self._lock:
+                if set(addresses) != set(self._addresses):
+                    logger.info("MatchingDispatcher: ring now has %s workers", len(addresses))
+                    self._ring = HashRing(addresses)
+                self._addresses = addresses
+                self._refreshed_at = time.monotonic()
+        return self._ring
+
+    def invalidate(self):
+        self._refreshed_at = float("-inf")
+
+    def owner_of(self, cell):
+        return self.ring().owner(cell)
+
+    def owns(self, cell):
+        """True when this process should run the work for `cell`: it is the owning worker, or no
+        worker is registered at all."""
+        owner = self.owner_of(cell)
+        return owner is None or owner == self.worker_id
+
+    def _send(self, worker_id, payload):
+        address = self._addresses.get(worker_id)
+        if not address:
+            return False
+        try:
+            sock = connect(address, getattr(settings, 'ERRAND_DISPATCH_TIMEOUT_MS', 200) / 1000.0)
+            with sock, sock.makefile("rb") as reader:
+                sock.sendall((json.dumps(payload) + "\n").encode())
+                response = json.loads(reader.readline())
+        except (OSError, ValueError) as e:
+            # The worker is gone or stuck: rebuild the ring on the next call
+            logger.warning("MatchingDispatcher: worker %s at %s unreachable (%s)", worker_id, address, e)
+            self.invalidate()
+            return False
+        return bool(response.get("ok"))
+
+    def _route(self, op, errand_id, cell, inline=False):
+        if cell is not None and not self.owns(cell):
+            owner = self.owner_of(cell)
+            if self._send(owner, {"op": op, "errand_id": errand_id}):
+                logger.info("MatchingDispatcher: %s errand=%s cell=%s -> worker %s", op, errand_id, cell, owner)
+                return owner
+            logger.warning("MatchingDispatcher: running %s for errand=%s locally", op, errand_id)
+        if inline:
+            jobs.get_job(OP_JOBS[op])(errand_id)
+        else:
+            jobs.enqueue(OP_JOBS[op], errand_id)
+        return self.worker_id
+
+    def dispatch(self, errand_id, cell=None):
+        """Start matching a new errand on the worker owning its cell. Returns the worker id that
+        took it (None when it runs in this non-worker process)."""
+        cell = cell or errand_cell(errand_id)
+        return self._route("match", errand_id, cell)
+
+    def follow_up(self, errand_id):
+        """Run the errand's next offer wave (or its expiry) on the worker now owning its cell;
+        called from a queued job, so local work runs inline."""
+        return self._route("advance", errand_id, errand_cell(errand_id), inline=True)
+
+
+dispatcher = MatchingDispatcher()
+
+
+# =====================
+# WORKER
+# =====================
+
+class _WorkerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            try:
+                request = json.loads(raw)
+                op = request.get("op")
+                if op in OP_JOBS:
+                    jobs.enqueue(OP_JOBS[op], int(request["errand_id"]))
+                    response = {"ok": True}
+                elif op == "ping":
+                    response = {"ok": True, "worker": dispatcher.worker_id}
+                else:
+                    response = {"ok": False, "error": f"unknown op {op!r}"}
+            except Exception as e:
+                logger.exception("matching worker: failed handling request")
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class MatchingWorker:
+    def __init__(self, worker_id, address):
+        self.worker_id = worker_id
+        self.address = address
+        self._stop = threading.Event()
+
+    def heartbeat(self):
+        register_worker(self.worker_id, self.address)
+
+    def sweep(self, now=None):
+        """Advance open errands in owned cells whose offers ran out more than one offer TTL ago
+        (their follow-up job was lost, e.g. with a worker that left). Returns the number advanced."""
+        from apps.errands.tasks import advance_offer_wave
+
+        advanced = 0
+        for errand_id, lat, lon in stalled_errands(now or timezone.now()):
+            if self.owner_of(grid_cell_for(lat, lon)) != self.worker_id:
+                continue
+            try:
+                advance_offer_wave(errand_id, path="sweep")
+                advanced += 1
+            except Exception:
+                logger.exception("MatchingWorker.sweep: failed advancing errand=%s", errand_id)
+        if advanced:
+            logger.info("MatchingWorker.sweep: advanced %s stalled errands", advanced)
+        return advanced
+
+    def owner_of(self, cell):
+        return dispatcher.owner_of(cell)
+
+    def _loop(self, interval, fn):
+        while not self._stop.wait(interval):
+            try:
+                close_old_connections()
+                fn()
+            except Exception:
+                logger.exception("MatchingWorker: %s failed", getattr(fn, "__name__", fn))
+
+    def serve(self):
+        """Register, start heartbeat and sweep threads, and serve dispatch requests until stopped."""
+        dispatcher.worker_id = self.worker_id
+        self.heartbeat()
+        jobs.start()
+        dispatcher.invalidate()
+        ttl = getattr(settings, 'ERRAND_WORKER_TTL_SECONDS', 15)
+        threading.Thread(target=self._loop, args=(max(ttl / 3.0, 1.0), self.heartbeat), daemon=True).start()
+        if getattr(settings, 'ERRAND_MATCHING_MODE', 'per_errand') != 'batch':
+            threading.Thread(target=self._loop, args=(getattr(settings, 'ERRAND_WORKER_SWEEP_SECONDS', 30), self.sweep), daemon=True).start()
+
+        self.server = bind_server(self.address, _WorkerRequestHandler)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        unregister_worker(self.worker_id)
+        server = getattr(self, "server", None)
+        if server is not None:
+            server.server_close()
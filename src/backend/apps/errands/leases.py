@@ -0,0 +1,159 @@
+"""Per-errand matching lease, so only one process runs matching for an errand at a time.
+
+Every path that sends offers for an errand (the first wave started by CreateErrand, follow-up
+wave jobs, the matching worker sweep, the batch matcher) first takes the errand's lease with
+`matching_lease(errand_id)`. A run that finds the lease held by someone else is skipped and
+counted in the `errand_matching.lease_skipped` metric.
+
+Backends (ERRAND_LEASE_BACKEND):
+- "cache": `cache.add` on a per-errand key with a TTL. It is atomic, and only meaningful with
+  the shared Redis cache.
+- "db": a MatchingLease row locked with SELECT ... FOR UPDATE.
+- "auto" (default): "cache" when the default cache is Redis, else "db". It also falls back to
+  "db" when the cache is unreachable.
+
+A lease expires after ERRAND_LEASE_TTL_SECONDS, so a crashed holder blocks the errand for at most
+that long. A holder that stalls past its TTL could still be running when the next holder starts,
+so each lease carries a fencing token that increases with every grant. Matching writes the
+errand's wave counter only while the errand's `match_fence` is not newer than its token
+(`fenced_update`). A stale holder's write is refused with LeaseLost, so it stops before sending
+offers.
+"""
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from apps.errands.models import Errand, MatchingLease
+from apps.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+LEASE_KEY = "errands:lease:{errand_id}"
+TOKEN_KEY = "errands:lease-token:{errand_id}"
+
+
+class LeaseLost(Exception):
+    """A newer lease holder has written to the errand; this holder must stop."""
+
+
+def _holder():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _ttl():
+    return getattr(settings, 'ERRAND_LEASE_TTL_SECONDS', 30)
+
+
+def _backend():
+    backend = getattr(settings, 'ERRAND_LEASE_BACKEND', 'auto')
+    if backend == 'auto':
+        cache_backend = getattr(settings, 'CACHES', {}).get('default', {}).get('BACKEND', '')
+        return 'cache' if 'redis' in cache_backend.lower() else 'db'
+    return backend
+
+
+class Lease:
+    def __init__(self, errand_id, token, holder, backend):
+        self.errand_id = errand_id
+        self.token = token
+        self.holder = holder
+        self.backend = backend
+
+    def release(self):
+        """Give the lease up early; a no-op when it already expired and was taken by someone else."""
+        if self.backend == 'cache':
+            key = LEASE_KEY.format(errand_id=self.errand_id)
+            # get-then-delete: at worst a lease granted in between is dropped and re-granted with a new token
+            if cache.get(key) == self.token:
+                cache.delete(key)
+        else:
+            MatchingLease.objects.filter(errand_id=self.errand_id, token=self.token).update(expires_at=timezone.now())
+
+
+def _next_cache_token(errand_id):
+    key = TOKEN_KEY.format(errand_id=errand_id)
+    timeout = getattr(settings, 'ERRAND_LIFETIME_SECONDS', 7200) * 2
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Counter missing (first lease, or evicted): continue from the errand's fence
+        fence = Errand.objects.filter(id=errand_id).values_list("match_fence", flat=True).first() or 0
+        cache.add(key, fence, timeout=timeout)
+        return cache.incr(key)
+
+
+def _acquire_cache(errand_id, holder):
+    token = _next_cache_token(errand_id)
+    if cache.add(LEASE_KEY.format(errand_id=errand_id), token, timeout=_ttl()):
+        return Lease(errand_id, token, holder, 'cache')
+    return None
+
+
+def _acquire_db(errand_id, holder):
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=_ttl())
+    try:
+        with transaction.atomic():
+            lease = MatchingLease.objects.select_for_update().filter(errand_id=errand_id).first()
+            if lease is None:
+                fence = Errand.objects.filter(id=errand_id).values_list("match_fence", flat=True).first() or 0
+                lease = MatchingLease.objects.create(errand_id=errand_id, token=fence + 1, holder=holder, expires_at=expires_at)
+                return Lease(errand_id, lease.token, holder, 'db')
+            if lease.expires_at > now:
+                return None
+            lease.token += 1
+            lease.holder = holder
+            lease.expires_at = expires_at
+            lease.save(update_fields=["token", "holder", "expires_at"])
+            return Lease(errand_id, lease.token, holder, 'db')
+    except IntegrityError:
+        # Another process created the row first: it holds the lease
+        return None
+
+
+def acquire(errand_id):
+    """The errand's lease, or None when another holder has it."""
+    holder = _holder()
+    if _backend() == 'cache':
+        try:
+            return _acquire_cache(errand_id, holder)
+        except Exception:
+            logger.exception("leases.acquire: cache unavailable; using the database lease for errand=%s", errand_id)
+    return _acquire_db(errand_id, holder)
+
+
+@contextmanager
+def matching_lease(errand_id, path="matching"):
+    """Hold the errand's lease for the block. Yields the Lease, or None when the run must be skipped."""
+    lease = acquire(errand_id)
+    if lease is None:
+        logger.info("matching_lease: errand=%s is being matched elsewhere; skipping %s", errand_id, path)
+        metrics.incr("errand_matching.lease_skipped")
+        metrics.incr(f"errand_matching.lease_skipped.{path}")
+        yield None
+        return
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+def fenced_update(errand, lease, **fields):
+    """Write `fields` to the errand if no newer lease holder has written to it. Raises LeaseLost
+    otherwise."""
+    fields["updated_at"] = timezone.now()
+    updated = Errand.objects.filter(id=errand.id, match_fence__lte=lease.token).update(match_fence=lease.token, **fields)
+    if not updated:
+        metrics.incr("errand_matching.lease_fenced")
+        raise LeaseLost(f"errand {errand.id}: lease token {lease.token} is stale")
+    errand.match_fence = lease.token
+    for name, value in fields.items():
+        setattr(errand, name, value)
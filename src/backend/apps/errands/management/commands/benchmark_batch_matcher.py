@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.errands.matching import MatchingMarket, assign
+from runners.services import np
+
+
+class Command(BaseCommand):
+    help = "Time one batch-matcher solve on a synthetic market (no database access)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--errands", type=int, default=2000)
+        parser.add_argument("--runners", type=int, default=5000)
+        parser.add_argument("--radius-m", type=float, default=10000)
+        parser.add_argument("--spread-deg", type=float, default=0.3, help="Side of the square market area")
+        parser.add_argument("--solver", choices=["greedy", "hungarian"], default="greedy")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("NumPy is required")
+        rng = np.random.default_rng(options["seed"])
+        spread = options["spread_deg"]
+        n_errands, n_runners = options["errands"], options["runners"]
+        # Around Yaoundé
+        market = MatchingMarket(
+            errand_lats=3.85 + rng.random(n_errands) * spread,
+            errand_lons=11.50 + rng.random(n_errands) * spread,
+            errand_ages=rng.random(n_errands) * 600,
+            runner_lats=3.85 + rng.random(n_runners) * spread,
+            runner_lons=11.50 + rng.random(n_runners) * spread,
+            runner_trust=rng.integers(0, 101, n_runners).astype(np.float64),
+        )
+
+        timings = []
+        for _ in range(options["repeat"]):
+            started = time.perf_counter()
+            pairs = assign(market, radius_m=options["radius_m"], solver=options["solver"])
+            timings.append(time.perf_counter() - started)
+
+        self.stdout.write(
+            f"{n_errands} errands x {n_runners} runners ({options['solver']}): "
+            f"{len(pairs)} assigned, best {min(timings) * 1000:.1f} ms, worst {max(timings) * 1000:.1f} ms"
+        )
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from apps.utils import jobs, metrics
+
+
+class Command(BaseCommand):
+    help = "Print matching counters, e.g. how many offer waves errands needed before acceptance or expiry, and job queue depth and latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("prefix", nargs="?", default="", help="Only counters starting with this prefix")
+
+    def handle(self, *args, **options):
+        counters = metrics.snapshot(options["prefix"])
+        if not counters:
+            self.stdout.write("No counters recorded")
+        for name, value in counters.items():
+            self.stdout.write(f"{name} {value}")
+
+        for outcome in ("accepted", "expired"):
+            count = counters.get(f"errand_offer_waves.{outcome}.count")
+            if count:
+                mean = counters.get(f"errand_offer_waves.{outcome}.sum", 0) / count
+                self.stdout.write(f"mean waves per {outcome} errand: {mean:.2f}")
+
+        if "jobs.enqueued" in counters:
+            stats = jobs.queue_stats()
+            self.stdout.write(f"job queue depth: {stats['depth']}")
+            if stats["rejected"]:
+                self.stdout.write(f"jobs rejected by a full queue: {stats['rejected']}")
+            if stats["dropped"]:
+                self.stdout.write(f"jobs dropped on shutdown: {stats['dropped']}")
+            if stats["mean_latency_ms"] is not None:
+                self.stdout.write(f"mean job queue latency: {stats['mean_latency_ms']:.0f} ms")
@@ -0,0 +1,42 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.errands.matching import run_batch_matching
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run the batch errand matcher every ERRAND_BATCH_INTERVAL_SECONDS (ERRAND_MATCHING_MODE=batch)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=None, help="Seconds between ticks")
+        parser.add_argument("--once", action="store_true", help="Run a single tick and exit")
+        parser.add_argument("--region", default=None, help="Only match errands and runners in this region")
+        parser.add_argument(
+            "--exclude-region",
+            action="append",
+            default=[],
+            help="Skip a region served by its own matcher (repeatable)",
+        )
+
+    def handle(self, *args, **options):
+        if getattr(settings, "ERRAND_MATCHING_MODE", "per_errand") != "batch":
+            self.stderr.write("ERRAND_MATCHING_MODE is not 'batch': errands are also matched per errand")
+
+        interval = options["interval"] or getattr(settings, "ERRAND_BATCH_INTERVAL_SECONDS", 5)
+        while True:
+            started = time.monotonic()
+            try:
+                close_old_connections()
+                sent = run_batch_matching(region=options["region"], exclude_regions=options["exclude_region"])
+                logger.info("run_batch_matcher: tick sent %s offers in %.3fs", sent, time.monotonic() - started)
+            except Exception:
+                logger.exception("run_batch_matcher: tick failed")
+            if options["once"]:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
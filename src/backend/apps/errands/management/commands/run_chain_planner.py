@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.errands.chaining import plan_chains
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Recompute route-chaining options for runners with in-progress errands every ERRAND_CHAIN_REFRESH_SECONDS."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=None, help="Seconds between runs")
+        parser.add_argument("--once", action="store_true", help="Plan once and exit")
+
+    def handle(self, *args, **options):
+        interval = options["interval"] or getattr(settings, "ERRAND_CHAIN_REFRESH_SECONDS", 20)
+        while True:
+            started = time.monotonic()
+            try:
+                close_old_connections()
+                stored = plan_chains()
+                logger.info("run_chain_planner: stored %s options in %.3fs", stored, time.monotonic() - started)
+            except Exception:
+                logger.exception("run_chain_planner: run failed")
+            if options["once"]:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,27 @@
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+
+from apps.errands.dispatch import MatchingWorker
+
+
+class Command(BaseCommand):
+    help = "Run a matching worker that owns the per-errand matching of a share of grid cells."
+
+    def add_arguments(self, parser):
+        parser.add_argument("address", help='Address to serve on ("unix:/run/runam/matcher-1.sock" or "host:port")')
+        parser.add_argument(
+            "--worker-id",
+            default=None,
+            help="Stable id on the hash ring (default hostname:pid); reuse it on restart to keep the same cells",
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options["worker_id"] or f"{socket.gethostname()}:{os.getpid()}"
+        worker = MatchingWorker(worker_id, options["address"])
+        self.stdout.write(f"Matching worker {worker_id} serving on {options['address']}")
+        try:
+            worker.serve()
+        except KeyboardInterrupt:
+            pass
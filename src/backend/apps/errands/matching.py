@@ -0,0 +1,267 @@
+"""Batch assignment of pending errands to available runners.
+
+Alternative to the per-errand flow (`tasks.start_errand_matching`, which offers each new errand to
+its closest runners independently): every `ERRAND_BATCH_INTERVAL_SECONDS` the batch matcher
+(`manage.py run_batch_matcher`) looks at all PENDING errands without a live offer and all available
+runners without one, and makes a single targeted offer per errand so that several errands never
+compete for the same runner.
+
+Select with `ERRAND_MATCHING_MODE` = "per_errand" | "batch". Each region is its own market; a busy
+region can get a dedicated matcher with `run_batch_matcher --region`.
+
+Cost of offering errand i to runner j (lower is better, inf when j is outside the search radius):
+
+    distance_ij / radius + TRUST_WEIGHT * (1 - trust_j / 100) - AGE_WEIGHT * min(age_i / AGE_HORIZON, 1)
+        [+ ACCEPTANCE_WEIGHT * (1 - p_j) once runners.acceptance has published a score table]
+
+The older an errand, the cheaper all its pairs, so long-waiting errands are served first.
+
+Errands are only matched to runners of the same region and service area.
+"""
+import logging
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from apps.errands.leases import LeaseLost, fenced_update, matching_lease
+from apps.errands.models import Errand, ErrandOffer
+from apps.errands.services import send_errand_offer, travel_distance_m
+from apps.locations.service_areas import has_service_areas
+from apps.roles.models import Role
+from runners.acceptance import get_acceptance_table
+from runners.offer_caps import saturated_runners
+from runners.presence import available_runners_q
+from runners.services import np, pairwise_distances
+
+# Optional SciPy import: the "hungarian" solver falls back to greedy without it
+try:
+    from scipy.optimize import linear_sum_assignment  # type: ignore
+except Exception:  # pragma: no cover
+    linear_sum_assignment = None
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# Errands are costed against all runners in chunks of this many rows to bound memory
+COST_CHUNK_ROWS = 256
+
+
+class MatchingMarket(NamedTuple):
+    """Column arrays describing one matching tick. `blocked` holds (errand_idx, runner_idx)
+    pairs that must not be offered again (the runner already had an offer for that errand)."""
+    errand_lats: "np.ndarray"
+    errand_lons: "np.ndarray"
+    errand_ages: "np.ndarray"
+    runner_lats: "np.ndarray"
+    runner_lons: "np.ndarray"
+    runner_trust: "np.ndarray"
+    blocked: tuple = ((), ())
+    runner_acceptance: "np.ndarray" = None
+
+
+def _weights():
+    return (
+        float(getattr(settings, 'ERRAND_BATCH_TRUST_WEIGHT', 0.3)),
+        float(getattr(settings, 'ERRAND_BATCH_AGE_WEIGHT', 0.5)),
+        float(getattr(settings, 'ERRAND_BATCH_AGE_HORIZON_SECONDS', 300)),
+    )
+
+
+def cost_rows(market, radius_m, start, stop):
+    """float32 cost matrix for errands [start, stop) against every runner."""
+    trust_weight, age_weight, age_horizon = _weights()
+    dist = pairwise_distances(
+        market.errand_lats[start:stop], market.errand_lons[start:stop], market.runner_lats, market.runner_lons
+    )
+    cost = dist / radius_m
+    cost += trust_weight * (1.0 - np.clip(market.runner_trust, 0, 100) / 100.0)[None, :]
+    cost -= age_weight * np.minimum(market.errand_ages[start:stop] / age_horizon, 1.0)[:, None]
+    if market.runner_acceptance is not None:
+        cost += float(getattr(settings, 'ERRAND_BATCH_ACCEPTANCE_WEIGHT', 0.5)) * (1.0 - market.runner_acceptance)[None, :]
+    cost[dist > radius_m] = np.inf
+
+    blocked_e, blocked_r = (np.asarray(a, dtype=np.intp) for a in market.blocked)
+    in_chunk = (blocked_e >= start) & (blocked_e < stop)
+    cost[blocked_e[in_chunk] - start, blocked_r[in_chunk]] = np.inf
+    return cost.astype(np.float32)
+
+
+def _greedy(market, radius_m, candidates):
+    """Greedy auction: keep each errand's `candidates` cheapest runners, then award pairs globally
+    cheapest-first, skipping errands and runners already taken. O(E*R) costing plus
+    O(E*k log(E*k)) for the award, with memory bounded by the chunk size."""
+    n_errands, n_runners = len(market.errand_lats), len(market.runner_lats)
+    k = min(candidates, n_runners)
+    pair_costs, pair_errands, pair_runners = [], [], []
+    for start in range(0, n_errands, COST_CHUNK_ROWS):
+        stop = min(start + COST_CHUNK_ROWS, n_errands)
+        cost = cost_rows(market, radius_m, start, stop)
+        if k < n_runners:
+            idx = np.argpartition(cost, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(n_runners), cost.shape)
+        pair_costs.append(np.take_along_axis(cost, idx, axis=1).ravel())
+        pair_errands.append(np.repeat(np.arange(start, stop), k))
+        pair_runners.append(idx.ravel())
+
+    pair_costs = np.concatenate(pair_costs)
+    feasible = np.isfinite(pair_costs)
+    order = np.argsort(pair_costs[feasible], kind="stable")
+    pair_errands = np.concatenate(pair_errands)[feasible][order]
+    pair_runners = np.concatenate(pair_runners)[feasible][order]
+
+    taken_errands, taken_runners, pairs = set(), set(), []
+    limit = min(n_errands, n_runners)
+    for e, r in zip(pair_errands.tolist(), pair_runners.tolist()):
+        if e in taken_errands or r in taken_runners:
+            continue
+        taken_errands.add(e)
+        taken_runners.add(r)
+        pairs.append((e, r))
+        if len(pairs) == limit:
+            break
+    return pairs
+
+
+def _hungarian(market, radius_m):
+    """Optimal assignment on the full cost matrix (SciPy). O(n^3): for smaller markets."""
+    cost = cost_rows(market, radius_m, 0, len(market.errand_lats)).astype(np.float64)
+    feasible = np.isfinite(cost)
+    if not feasible.any():
+        return []
+    # Infeasible pairs get a cost no real assignment can beat, then are dropped from the result
+    penalty = float(np.abs(cost[feasible]).max()) * 10 + 1e6
+    rows, cols = linear_sum_assignment(np.where(feasible, cost, penalty))
+    return [(int(e), int(r)) for e, r in zip(rows, cols) if feasible[e, r]]
+
+
+def assign(market, radius_m=None, solver=None, candidates=None):
+    """(errand_idx, runner_idx) pairs: each errand and runner used at most once, never a pair
+    outside the radius or blocked."""
+    if not len(market.errand_lats) or not len(market.runner_lats):
+        return []
+    radius_m = radius_m or getattr(settings, 'RUNNER_SEARCH_RADIUS_M', 10000)
+    solver = solver or getattr(settings, 'ERRAND_BATCH_SOLVER', 'greedy')
+    candidates = candidates or getattr(settings, 'ERRAND_BATCH_CANDIDATES', 20)
+
+    if solver == "hungarian":
+        if linear_sum_assignment is not None:
+            return _hungarian(market, radius_m)
+        logger.warning("assign: SciPy is not installed; using the greedy solver")
+    return _greedy(market, radius_m, candidates)
+
+
+def run_batch_matching(now=None, region=None, exclude_regions=()):
+    """One matching tick: send one targeted offer per assignable pending errand. Errands are only
+    matched to runners of their own region, one market per region. `region` restricts the tick to
+    a single region (a dedicated matcher process); `exclude_regions` skips regions that have one.
+    Returns the number of offers sent."""
+    if np is None:  # pragma: no cover
+        logger.error("run_batch_matching: NumPy is required for the batch matcher")
+        return 0
+    now = now or timezone.now()
+    live_offers = ErrandOffer.objects.filter(status=ErrandOffer.Status.PENDING, expires_at__gt=now)
+
+    errands_qs = (
+        Errand.objects.filter(status=Errand.Status.PENDING, is_open=True, out_of_area=False, go_to__isnull=False)
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+        .exclude(id__in=live_offers.values("errand_id"))
+    )
+    runners_qs = (
+        User.objects.filter(available_runners_q(now), profile__roles__name=Role.RUNNER, location__isnull=False)
+        .exclude(id__in=live_offers.values("runner_id"))
+    )
+    if region:
+        errands_qs = errands_qs.filter(go_to__region=region)
+        runners_qs = runners_qs.filter(location__region=region)
+    if exclude_regions:
+        errands_qs = errands_qs.exclude(go_to__region__in=exclude_regions)
+        runners_qs = runners_qs.exclude(location__region__in=exclude_regions)
+
+    # One market per (region, service area); outside every area nobody is matched
+    errands_by_market, runners_by_market = defaultdict(list), defaultdict(list)
+    for errand_region, service_area_id, *row in (
+        errands_qs.annotate(offer_count=Count("offers"))
+        .values_list("go_to__region", "go_to__service_area_id", "id", "go_to__latitude", "go_to__longitude", "created_at", "offer_count")
+    ):
+        errands_by_market[errand_region, service_area_id].append(row)
+    for runner_region, service_area_id, *row in (
+        runners_qs.values_list(
+            "location__region", "location__service_area_id", "id", "location__latitude", "location__longitude", "profile__trust_score"
+        ).distinct()
+    ):
+        runners_by_market[runner_region, service_area_id].append(row)
+
+    # Runners at their per-minute offer cap sit this tick out
+    saturated = saturated_runners({row[0] for rows in runners_by_market.values() for row in rows})
+    if saturated:
+        runners_by_market = {
+            market: [row for row in rows if row[0] not in saturated] for market, rows in runners_by_market.items()
+        }
+
+    zoned = has_service_areas()
+    sent = 0
+    for (market_region, service_area_id), errand_rows in errands_by_market.items():
+        if zoned and service_area_id is None:
+            logger.info("run_batch_matching: region=%s has %s errands outside every service area", market_region, len(errand_rows))
+            continue
+        runner_rows = runners_by_market.get((market_region, service_area_id))
+        if not runner_rows:
+            logger.info("run_batch_matching: region=%s area=%s has %s errands and no runners", market_region, service_area_id, len(errand_rows))
+            continue
+        sent += _match_market(now, market_region, errand_rows, runner_rows)
+    return sent
+
+
+def _match_market(now, region, errand_rows, runner_rows):
+    errand_ids, errand_lats, errand_lons, created, offer_counts = zip(*errand_rows)
+    runner_ids, runner_lats, runner_lons, trusts = zip(*runner_rows)
+    errand_pos = {errand_id: i for i, errand_id in enumerate(errand_ids)}
+    runner_pos = {runner_id: j for j, runner_id in enumerate(runner_ids)}
+    acceptance = get_acceptance_table()
+
+    blocked = [
+        (errand_pos[e], runner_pos[r])
+        for e, r in ErrandOffer.objects.filter(errand_id__in=errand_ids).values_list("errand_id", "runner_id")
+        if r in runner_pos
+    ]
+    market = MatchingMarket(
+        errand_lats=np.asarray(errand_lats, dtype=np.float64),
+        errand_lons=np.asarray(errand_lons, dtype=np.float64),
+        errand_ages=np.asarray([(now - c).total_seconds() for c in created], dtype=np.float64),
+        runner_lats=np.asarray(runner_lats, dtype=np.float64),
+        runner_lons=np.asarray(runner_lons, dtype=np.float64),
+        runner_trust=np.asarray([t or 0 for t in trusts], dtype=np.float64),
+        blocked=tuple(zip(*blocked)) if blocked else ((), ()),
+        runner_acceptance=acceptance.probabilities_for(runner_ids) if acceptance is not None else None,
+    )
+    pairs = assign(market)
+
+    errands = Errand.objects.select_related("go_to").in_bulk([errand_ids[e] for e, _ in pairs])
+    runners = User.objects.in_bulk([runner_ids[r] for _, r in pairs])
+    sent = 0
+    for e, r in pairs:
+        try:
+            # Skip errands another matching path is working on right now
+            with matching_lease(errand_ids[e], "batch") as lease:
+                if lease is None:
+                    continue
+                errand = errands[errand_ids[e]]
+                fenced_update(errand, lease)
+                distance_m = travel_distance_m((runner_lats[r], runner_lons[r]), errand.go_to)
+                if send_errand_offer(errand, runners[runner_ids[r]], position=offer_counts[e] + 1, distance_m=distance_m):
+                    sent += 1
+        except LeaseLost as exc:
+            logger.warning("run_batch_matching: %s; skipping", exc)
+        except Exception:
+            logger.exception("run_batch_matching: failed to offer errand=%s to runner=%s", errand_ids[e], runner_ids[r])
+
+    logger.info(
+        "run_batch_matching: region=%s %s errands x %s runners -> %s offers",
+        region, len(errand_ids), len(runner_ids), sent,
+    )
+    return sent
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errand',
+            name='offer_wave',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0.1 on 2026-10-17 10:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0002_errand_offer_wave'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ErrandTrail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.BinaryField()),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('errand', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trail_record', to='errands.errand')),
+            ],
+        ),
+    ]
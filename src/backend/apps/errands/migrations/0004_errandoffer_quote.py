@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-17 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0003_errandtrail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errandoffer',
+            name='distance_m',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='errandoffer',
+            name='quoted_errand_value',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='errandoffer',
+            name='quoted_distance_fee',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='errandoffer',
+            name='quoted_service_fee',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='errandoffer',
+            name='quoted_total_price',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
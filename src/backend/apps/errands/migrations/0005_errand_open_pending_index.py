@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0004_errandoffer_quote'),
+        ('errand_location', '0004_errandlocation_grid_cell'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='errand',
+            index=models.Index(condition=models.Q(('is_open', True), ('status', 'PENDING')), fields=['go_to'], name='errand_open_pending_go_to'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0005_errand_open_pending_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errand',
+            name='out_of_area',
+            field=models.BooleanField(default=False),
+        ),
+    ]
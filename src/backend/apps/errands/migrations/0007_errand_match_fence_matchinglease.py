@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-17 15:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errands', '0006_errand_out_of_area'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errand',
+            name='match_fence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MatchingLease',
+            fields=[
+                ('errand', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='matching_lease', serialize=False, to='errands.errand')),
+                ('token', models.PositiveBigIntegerField(default=0)),
+                ('holder', models.CharField(blank=True, max_length=100)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+    ]
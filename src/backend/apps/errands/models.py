@@ -55,6 +55,13 @@ class Errand(models.Model):
     # Open window for runner acceptance
     is_open = models.BooleanField(default=True)
     expires_at = models.DateTimeField(blank=True, null=True)
+    # Number of offer waves (ERRAND_OFFER_WAVES rings) sent so far
+    offer_wave = models.PositiveSmallIntegerField(default=0)
+    # Created outside every service area (SERVICE_AREA_ENFORCEMENT = "flag"): never matched
+    out_of_area = models.BooleanField(default=False)
+    # Highest matching lease token that has written to this errand (see apps/errands/leases.py);
+    # writes carrying an older token are refused
+    match_fence = models.PositiveBigIntegerField(default=0)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -68,6 +75,17 @@ class Errand(models.Model):
     )
     accepted_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Only the few errands still looking for a runner; keeps "open errands near me" and
+            # the matchers independent of the size of the errand history
+            models.Index(
+                fields=["go_to"],
+                condition=models.Q(status="PENDING", is_open=True),
+                name="errand_open_pending_go_to",
+            ),
+        ]
+
     def refresh_open_state(self):
         """
         Behavioral Pattern: Template Method
@@ -86,8 +104,8 @@ class Errand(models.Model):
         return int(self.errand_value() * 0.2)
 
     def distance_fee(self):
-        # placeholder – integrate maps later
-        return 0
+        # Priced from the runner's travel distance when the offer is accepted
+        return self.quoted_distance_fee
 
     def total_price(self):
         return self.quoted_total_price
@@ -125,6 +143,14 @@ class ErrandOffer(models.Model):
     expires_at = models.DateTimeField()
     responded_at = models.DateTimeField(null=True, blank=True)
 
+    # Quote computed when the offer is made (runner's travel distance at match time); accepting
+    # the offer charges exactly this. Null on offers created before quotes were stored.
+    distance_m = models.FloatField(null=True, blank=True)
+    quoted_errand_value = models.PositiveIntegerField(null=True, blank=True)
+    quoted_distance_fee = models.PositiveIntegerField(null=True, blank=True)
+    quoted_service_fee = models.PositiveIntegerField(null=True, blank=True)
+    quoted_total_price = models.PositiveIntegerField(null=True, blank=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -146,3 +172,37 @@ class ErrandTask(models.Model):
 
     def __str__(self):
         return f"{self.description} - XAF {self.price}"
+
+
+class ErrandTrail(models.Model):
+    """Runner location trail recorded while the errand was in progress, persisted when it ends.
+    `points` is the zlib-compressed delta encoding produced by apps/errands/trail.py."""
+    errand = models.OneToOneField(
+        Errand,
+        related_name="trail_record",
+        on_delete=models.CASCADE
+    )
+    points = models.BinaryField()
+    point_count = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Trail of errand {self.errand_id} ({self.point_count} points)"
+
+
+class MatchingLease(models.Model):
+    """Database-backed matching lease of an errand, used when no shared cache is configured
+    (see apps/errands/leases.py)."""
+    errand = models.OneToOneField(
+        Errand,
+        primary_key=True,
+        related_name="matching_lease",
+        on_delete=models.CASCADE
+    )
+    token = models.PositiveBigIntegerField(default=0)
+    holder = models.CharField(max_length=100, blank=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Lease on errand {self.errand_id} (token {self.token})"
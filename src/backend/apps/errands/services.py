@@ -5,9 +5,17 @@ from typing import Tuple
 import base64
 from django.conf import settings
 from apps.errands.models import ErrandOffer, Errand
+from django.db import DatabaseError, transaction
+from django.db.models import Q
 from django.utils import timezone
 import logging
-from runners.services import distance_between
+from apps.errands.trail import start_trail
+from apps.utils import jobs, metrics
+from runners.presence import errand_started
+from runners.offer_caps import release_errand_offers, reserve_offer
+from runners.services import distances_from, haversine_expression
+from runners.travel import get_travel_provider
+from apps.locations.grid import bounding_box, grid_cells_within
 
 logger = logging.getLogger(__name__)
 
@@ -67,21 +75,40 @@ def store_errand_image(image_b64: str, user) -> str:
     return store_image_local(image_b64, user)
 
 
-def accept_offer(errand, runner):
-    # Calculate distance between runner location and errand.go_to
+def travel_distance_m(runner_location, go_to):
+    """Travel distance from the runner's location to errand.go_to (road distance when the
+    precomputed matrix is available, straight line otherwise); 0 when it cannot be computed."""
     try:
-        distance_m = float(distance_between(getattr(runner, 'location', None), errand.go_to))
+        distance_m = float(get_travel_provider().distance_m(runner_location, go_to))
     except Exception:
         distance_m = 0.0
+    if distance_m == float("inf"):
+        distance_m = 0.0
+    return distance_m
+
 
+def quote_price(errand_value, distance_m):
+    """(distance_fee, service_fee, total_price) for an errand worth `errand_value`."""
     # distance fee: 250 per 1 KM
     distance_km = distance_m / 1000.0
     distance_fee = int(round(distance_km * 250))
 
     # service fee & totals
-    errand_value = errand.errand_value()
     service_fee = int(errand_value * 0.2)
     total_price = errand_value + service_fee + distance_fee
+    return distance_fee, service_fee, total_price
+
+
+def accept_offer(errand, runner, offer=None):
+    """Assign the errand to the runner at the price quoted in their offer. Without a stored quote
+    (legacy offers, direct calls) the price is computed now."""
+    if offer is not None and offer.quoted_total_price is not None:
+        distance_fee = offer.quoted_distance_fee
+        service_fee = offer.quoted_service_fee
+        total_price = offer.quoted_total_price
+    else:
+        distance_m = travel_distance_m(getattr(runner, 'location', None), errand.go_to)
+        distance_fee, service_fee, total_price = quote_price(errand.errand_value(), distance_m)
 
     # Persist pricing and acceptance
     errand.quoted_distance_fee = distance_fee
@@ -94,9 +121,16 @@ def accept_offer(errand, runner):
     errand.accepted_at = timezone.now()
     errand.save(update_fields=["status", "is_open", "runner", "quoted_distance_fee", "quoted_service_fee", "quoted_total_price", "accepted_at"])
 
-    # Expire other pending offers for this errand
+    # The runner now has an in-progress errand; matching stops offering them more work
+    errand_started(runner)
+    start_trail(errand)
+    metrics.observe("errand_offer_waves.accepted", errand.offer_wave)
+
+    # Expire other pending offers for this errand and give every runner's offer slot back
     try:
-        ErrandOffer.objects.filter(errand=errand, status=ErrandOffer.Status.PENDING).exclude(runner=runner).update(status=ErrandOffer.Status.EXPIRED)
+        others = ErrandOffer.objects.filter(errand=errand, status=ErrandOffer.Status.PENDING).exclude(runner=runner)
+        release_errand_offers(errand.id, [runner.id, *others.values_list("runner_id", flat=True)])
+        others.update(status=ErrandOffer.Status.EXPIRED)
     except Exception:
         logger.exception('Failed expiring other offers')
 
@@ -104,6 +138,15 @@ def accept_offer(errand, runner):
     logger.info('accept_offer: completed accept for errand=%s runner=%s total_price=%s', errand.id, getattr(runner, 'id', None), total_price)
 
 def notify_runner(runner, offer):
+    """Queue the runner's notification about a new errand offer (`push_offer_notification`), so
+    building and sending it stays off the matching path. Queued once the offer is committed, so
+    the job can read it."""
+    transaction.on_commit(lambda: jobs.enqueue("errands.notify_offer", offer.id))
+    return True
+
+
+@jobs.job("errands.notify_offer")
+def push_offer_notification(offer_id):
     """Notify a runner about a new errand offer via WebSocket (Channels) when available.
 
     Group name convention: "user_{user_id}". Frontend should subscribe to that group.
@@ -117,6 +160,11 @@ def notify_runner(runner, offer):
 
     If Channels is not present, we go back to logging a warning.
     """
+    offer = ErrandOffer.objects.select_related("errand__go_to", "runner").filter(id=offer_id).first()
+    if offer is None or offer.status != ErrandOffer.Status.PENDING:
+        logger.info('push_offer_notification: offer=%s is gone or answered; not notifying', offer_id)
+        return False
+    runner = offer.runner
     payload = {
         "type": "errand_offer",
         "offer_id": offer.id,
@@ -135,23 +183,41 @@ def notify_runner(runner, offer):
                 "longitude": getattr(getattr(offer.errand, 'go_to', None), 'longitude', None),
                 "address": getattr(getattr(offer.errand, 'go_to', None), 'address', None),
             },
-            "errand_value": offer.errand.errand_value(),
+            "errand_value": offer.quoted_errand_value,
         }
     }
 
     # No websocket/webhook; frontend should poll offers endpoint to discover pending offers.
-    logger.info('notify_runner (noop): created offer=%s for runner=%s errand=%s', getattr(offer, 'id', None), getattr(runner, 'id', None), getattr(offer.errand, 'id', None))
+    logger.info('push_offer_notification (noop): created offer=%s for runner=%s errand=%s', getattr(offer, 'id', None), getattr(runner, 'id', None), getattr(offer.errand, 'id', None))
     return True
 
 
-def send_errand_offer(errand, runner, position: int = 0):
+def send_errand_offer(errand, runner, position: int = 0, distance_m=None, errand_value=None):
     """Create an ErrandOffer and notify the runner, then return immediately.
     This function no longer blocks or waits for acceptance. Frontend will poll for PENDING offers.
+
+    The offer stores the price quote the runner sees and will be charged. Matching passes the
+    distance it already computed and, when offering one errand to several runners, the errand
+    value computed once; either is computed here when missing.
+
+    Returns None without creating anything when the runner is at their pending-offer or
+    per-minute cap (see runners.offer_caps).
     """
-    # Use update_or_create to avoid unique_together IntegrityError and to refresh an existing offer's TTL.
     ttl_seconds = getattr(settings, 'ERRAND_OFFER_TTL_SECONDS', 60)
+    if not reserve_offer(runner.id, errand.id, ttl_seconds):
+        logger.info("send_errand_offer: runner=%s is saturated; skipping errand=%s", getattr(runner, 'id', None), getattr(errand, 'id', None))
+        metrics.incr("errand_offers.capped")
+        return None
+
+    # Use update_or_create to avoid unique_together IntegrityError and to refresh an existing offer's TTL.
     expires = timezone.now() + timedelta(seconds=ttl_seconds)
 
+    if distance_m is None:
+        distance_m = travel_distance_m(getattr(runner, 'location', None), errand.go_to)
+    if errand_value is None:
+        errand_value = errand.errand_value()
+    distance_fee, service_fee, total_price = quote_price(errand_value, distance_m)
+
     offer, created = ErrandOffer.objects.update_or_create(
         errand=errand,
         runner=runner,
@@ -159,6 +225,11 @@ def send_errand_offer(errand, runner, position: int = 0):
             'position': position,
             'status': ErrandOffer.Status.PENDING,
             'expires_at': expires,
+            'distance_m': distance_m,
+            'quoted_errand_value': errand_value,
+            'quoted_distance_fee': distance_fee,
+            'quoted_service_fee': service_fee,
+            'quoted_total_price': total_price,
         }
     )
 
@@ -182,18 +253,63 @@ def expire_errand(errand):
     except Exception:
         # Best effort; avoid raising from background task
         pass
+    metrics.observe("errand_offer_waves.expired", errand.offer_wave)
 
     # Expire any pending offers
     try:
-        ErrandOffer.objects.filter(
+        pending = ErrandOffer.objects.filter(
             errand=errand,
             status=ErrandOffer.Status.PENDING
-        ).update(status=ErrandOffer.Status.EXPIRED)
+        )
+        release_errand_offers(errand.id, pending.values_list("runner_id", flat=True))
+        pending.update(status=ErrandOffer.Status.EXPIRED)
     except Exception:
         pass
 
     logger.info('expire_errand: errand=%s expired and pending offers were expired', getattr(errand, 'id', None))
 
+
+def open_errands_near(latitude, longitude, radius_m, limit=20, offset=0, exclude_user=None):
+    """Open PENDING errands whose go_to lies within `radius_m` meters of (latitude, longitude),
+    closest first, as Errand instances annotated with `distance_m`. Paginated by offset/limit.
+
+    Open errands are found through the partial index on open PENDING errands and the indexed
+    `ErrandLocation.grid_cell` key, so the cost follows the number of open errands nearby rather
+    than the errand history.
+    """
+    now = timezone.now()
+    qs = (
+        Errand.objects.filter(status=Errand.Status.PENDING, is_open=True, go_to__isnull=False)
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+        .select_related("go_to", "user")
+    )
+    if exclude_user is not None:
+        qs = qs.exclude(user=exclude_user)
+
+    cells = grid_cells_within(latitude, longitude, radius_m)
+    if cells is not None:
+        qs = qs.filter(go_to__grid_cell__in=cells)
+    else:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_m)
+        qs = qs.filter(go_to__latitude__range=(min_lat, max_lat), go_to__longitude__range=(min_lon, max_lon))
+
+    try:
+        ranked = (
+            qs.annotate(distance_m=haversine_expression(latitude, longitude, "go_to__latitude", "go_to__longitude"))
+            .filter(distance_m__lte=radius_m)
+            .order_by("distance_m", "id")
+        )
+        return list(ranked[offset:offset + limit])
+    except DatabaseError:
+        logger.exception("open_errands_near: SQL distance ranking failed; ranking in Python")
+
+    errands = list(qs)
+    dists = distances_from((latitude, longitude), [e.go_to.latitude for e in errands], [e.go_to.longitude for e in errands])
+    for errand, dist in zip(errands, dists):
+        errand.distance_m = float(dist)
+    errands = sorted((e for e in errands if e.distance_m <= radius_m), key=lambda e: (e.distance_m, e.id))
+    return errands[offset:offset + limit]
+
 # def store_image_supabase(image_b64: str, user) -> str:
 #     if not _supabase_module:
 #         raise GraphQLError("Supabase client not installed. Set STORAGE_MODE=local or install supabase-py")
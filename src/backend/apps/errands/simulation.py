@@ -0,0 +1,346 @@
+"""Discrete-event marketplace simulator for tuning matching settings offline.
+
+Runs the production matching code (`start_errand_matching` / `advance_offer_wave`, and through them
+`find_nearby_runners` and `send_errand_offer`, then `accept_offer`) against the current database
+under a virtual clock. `manage.py simulate_marketplace` runs it on a throwaway test database
+(in-memory for SQLite) with a private cache, so a day of city traffic takes minutes and never
+touches real data.
+
+The clock is an event queue; while the simulation runs:
+- `django.utils.timezone.now` returns the virtual time,
+- the delayed follow-up wave jobs of `tasks._schedule_next_wave` become queue events,
+- `services.notify_runner` hands each new offer to the simulated runner.
+
+Runners start spread around the city centre and stay online. Each runner accepts, rejects or
+ignores an offer according to their own acceptance rate, after an exponentially distributed
+delay. An accepted errand keeps the runner busy for the trip there and back plus a fixed service
+time, and the runner finishes at the errand's go_to. Errands arrive as a Poisson process
+following HOURLY_PROFILE, or are replayed from a CSV file of `offset_s,latitude,longitude[,price]`
+rows.
+
+Tune by changing settings around the run (ERRAND_OFFER_TTL_SECONDS, ERRAND_LIFETIME_SECONDS,
+ERRAND_OFFER_WAVES, RUNNER_RANK_* ...); the report gives fill rate, time to accept, offers per
+errand and database queries per errand.
+"""
+import csv
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from apps.errands import services, tasks
+from apps.errands.models import Errand, ErrandOffer, ErrandTask
+from apps.errands.services import accept_offer
+from apps.locations.models import LocationMode, UserLocation
+from apps.locations.services import upsert_user_location
+from apps.roles.models import Role
+from apps.users.models import UserProfile
+from errand_location.models import ErrandLocation
+from runners.models import RunnerPresence
+from runners.offer_caps import release_offer
+from runners.presence import errand_finished
+from runners.services import distance_between
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# Relative errand arrival rate per hour of the day (mean 1.0): morning, lunch and evening peaks
+HOURLY_PROFILE = (
+    0.15, 0.1, 0.1, 0.1, 0.2, 0.4, 0.9, 1.6, 1.9, 1.4, 1.1, 1.3,
+    1.8, 1.6, 1.1, 1.0, 1.2, 1.7, 2.0, 1.6, 1.1, 0.7, 0.4, 0.25,
+)
+SIM_EPOCH = datetime(2026, 1, 5, tzinfo=dt_timezone.utc)  # a Monday, 00:00
+HEARTBEAT_SECONDS = 60
+SERVICE_SECONDS = 300
+
+
+class SimulationReport(NamedTuple):
+    errands: int
+    filled: int
+    expired: int
+    fill_rate: float
+    accept_p50_s: float
+    accept_p90_s: float
+    offers_per_errand: float
+    offers_per_filled: float
+    db_queries_per_errand: float
+    simulated_hours: float
+    wall_seconds: float
+
+    def lines(self):
+        return [
+            f"errands              {self.errands}",
+            f"filled               {self.filled} ({self.fill_rate:.1%})",
+            f"expired              {self.expired}",
+            f"time to accept       p50 {self.accept_p50_s:.0f}s  p90 {self.accept_p90_s:.0f}s",
+            f"offers per errand    {self.offers_per_errand:.2f} ({self.offers_per_filled:.2f} per filled errand)",
+            f"db queries / errand  {self.db_queries_per_errand:.1f}",
+            f"simulated            {self.simulated_hours:.1f} h in {self.wall_seconds:.1f} s",
+        ]
+
+
+def _percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+def load_arrivals(path):
+    """[(offset_s, latitude, longitude, price)] from a CSV file, sorted by offset."""
+    arrivals = []
+    with open(path, newline="") as fh:
+        for row in csv.reader(fh):
+            try:
+                price = int(row[3]) if len(row) > 3 and row[3].strip() else 2000
+                arrivals.append((float(row[0]), float(row[1]), float(row[2]), price))
+            except (ValueError, IndexError):
+                continue  # header, comment or blank line
+    return sorted(arrivals)
+
+
+class MarketplaceSimulator:
+    def __init__(
+        self,
+        runners=200,
+        errands_per_hour=60,
+        hours=24,
+        center=(3.8480, 11.5021),
+        spread_deg=0.03,
+        arrivals=None,
+        mean_response_s=20,
+        ignore_rate=0.25,
+        seed=0,
+    ):
+        self.n_runners = runners
+        self.errands_per_hour = errands_per_hour
+        self.duration_s = hours * 3600
+        self.center = center
+        self.spread_deg = spread_deg
+        self.arrivals = arrivals
+        self.mean_response_s = mean_response_s
+        self.ignore_rate = ignore_rate
+        self.rng = random.Random(seed)
+
+        self.now = SIM_EPOCH
+        self._queue = []
+        self._seq = itertools.count()
+        self._counting = False
+        self.db_queries = 0
+        self.acceptance = {}
+        self.errand_ids = []
+
+    # ---------------------------------------------------------------
+    # Clock
+    # ---------------------------------------------------------------
+
+    def at(self, offset_s, fn, *args):
+        heapq.heappush(self._queue, (offset_s, next(self._seq), fn, args))
+
+    def after(self, delay_s, fn, *args):
+        self.at(self._offset() + delay_s, fn, *args)
+
+    def _offset(self):
+        return (self.now - SIM_EPOCH).total_seconds()
+
+    def _count_queries(self, execute, sql, params, many, context):
+        if self._counting:
+            self.db_queries += 1
+        return execute(sql, params, many, context)
+
+    def _counted(self, fn, *args):
+        """Run production code, counting its queries."""
+        self._counting = True
+        try:
+            return fn(*args)
+        finally:
+            self._counting = False
+
+    # ---------------------------------------------------------------
+    # Population
+    # ---------------------------------------------------------------
+
+    def _point(self):
+        lat = self.rng.gauss(self.center[0], self.spread_deg)
+        lon = self.rng.gauss(self.center[1], self.spread_deg)
+        return lat, lon
+
+    def _seed_population(self):
+        role, _ = Role.objects.get_or_create(name=Role.RUNNER)
+        self.buyers = [User.objects.create(username=f"sim-buyer-{i}", email=f"sim-buyer-{i}@example.com") for i in range(50)]
+        for i in range(self.n_runners):
+            user = User.objects.create(username=f"sim-runner-{i}", email=f"sim-runner-{i}@example.com")
+            profile = UserProfile.objects.create(user=user, trust_score=self.rng.randint(40, 100))
+            profile.roles.add(role)
+            lat, lon = self._point()
+            UserLocation.objects.create(user=user, latitude=lat, longitude=lon, mode=LocationMode.DEVICE)
+            RunnerPresence.objects.create(user=user, is_online=True, last_heartbeat_at=self.now)
+            self.acceptance[user.id] = self.rng.betavariate(4, 3)
+
+    def _schedule_arrivals(self):
+        if self.arrivals is not None:
+            for offset_s, lat, lon, price in self.arrivals:
+                if offset_s < self.duration_s:
+                    self.at(offset_s, self._create_errand, lat, lon, price)
+            return
+        t = 0.0
+        while True:
+            rate_per_s = self.errands_per_hour * HOURLY_PROFILE[int(t // 3600) % 24] / 3600.0
+            t += self.rng.expovariate(max(rate_per_s, 1e-9))
+            if t >= self.duration_s:
+                break
+            lat, lon = self._point()
+            self.at(t, self._create_errand, lat, lon, self.rng.choice((1000, 2000, 3000, 5000)))
+
+    # ---------------------------------------------------------------
+    # Events
+    # ---------------------------------------------------------------
+
+    def _heartbeat(self):
+        RunnerPresence.objects.update(last_heartbeat_at=self.now)
+        self.after(HEARTBEAT_SECONDS, self._heartbeat)
+
+    def _create_errand(self, lat, lon, price):
+        # What CreateErrand writes, then matching inline as on the matching worker
+        def create():
+            errand = Errand.objects.create(
+                user=self.rng.choice(self.buyers),
+                type=Errand.Type.ONE_WAY,
+                speed="NORMAL",
+                payment_method=Errand.PaymentMethod.CASH,
+                expires_at=self.now + timedelta(seconds=getattr(settings, 'ERRAND_LIFETIME_SECONDS', 7200)),
+            )
+            ErrandTask.objects.create(errand=errand, description="Simulated task", price=price)
+            errand.go_to = ErrandLocation.objects.create(errand=errand, latitude=lat, longitude=lon, mode=LocationMode.STATIC)
+            errand.save(update_fields=["go_to"])
+            return errand
+
+        errand = self._counted(create)
+        self.errand_ids.append(errand.id)
+        self._counted(tasks.start_errand_matching, errand.id)
+        # The matching worker's sweep expires the errand once expires_at has passed
+        self.at((errand.expires_at - SIM_EPOCH).total_seconds(), self._sweep, errand.id)
+
+    def _sweep(self, errand_id):
+        self._counted(tasks.advance_offer_wave, errand_id)
+
+    def _advance(self, errand_id):
+        self._counted(tasks.advance_offer_wave, errand_id)
+
+    def _schedule_next_wave(self, errand_id, delay):
+        self.after(delay, self._advance, errand_id)
+
+    def _on_offer(self, runner, offer):
+        ttl = getattr(settings, 'ERRAND_OFFER_TTL_SECONDS', 60)
+        # Offers nobody answers give their slot back when the TTL runs out (the cache TTL in production)
+        self.after(ttl, release_offer, runner.id, offer.errand_id)
+        if self.rng.random() < self.ignore_rate:
+            return
+        delay = self.rng.expovariate(1.0 / self.mean_response_s)
+        accepts = self.rng.random() < self.acceptance.get(runner.id, 0.5)
+        self.after(delay, self._respond, offer.id, accepts)
+
+    def _respond(self, offer_id, accepts):
+        self._counted(self._respond_to_offer, offer_id, accepts)
+
+    def _respond_to_offer(self, offer_id, accepts):
+        # Same steps as the AcceptErrandOffer / RejectErrandOffer mutations
+        with transaction.atomic():
+            offer = (
+                ErrandOffer.objects.select_related("errand", "errand__go_to", "runner__location")
+                .select_for_update()
+                .filter(id=offer_id, status=ErrandOffer.Status.PENDING)
+                .first()
+            )
+            if offer is None:
+                return
+            if offer.expires_at <= self.now or not offer.errand.is_open or offer.errand.status != Errand.Status.PENDING:
+                offer.status = ErrandOffer.Status.EXPIRED
+                offer.save(update_fields=["status"])
+                return
+            offer.status = ErrandOffer.Status.ACCEPTED if accepts else ErrandOffer.Status.REJECTED
+            offer.responded_at = self.now
+            offer.save(update_fields=["status", "responded_at"])
+            if not accepts:
+                release_offer(offer.runner_id, offer.errand_id)
+                return
+            accept_offer(offer.errand, offer.runner, offer=offer)
+
+        go_to = offer.errand.go_to
+        trip_m = distance_between(offer.runner.location, go_to) * 2
+        busy_s = trip_m / float(getattr(settings, 'RUNNER_AVG_SPEED_MPS', 5.0)) + SERVICE_SECONDS
+        self.after(busy_s, self._complete, offer.errand_id)
+
+    def _complete(self, errand_id):
+        def complete():
+            errand = Errand.objects.select_related("runner", "go_to").get(id=errand_id)
+            errand.status = Errand.Status.COMPLETED
+            errand.save(update_fields=["status", "updated_at"])
+            errand_finished(errand.runner)
+            return errand
+
+        errand = self._counted(complete)
+        # The runner's app reports its new position (a location ping, not matching work)
+        upsert_user_location(errand.runner, LocationMode.DEVICE, errand.go_to.latitude, errand.go_to.longitude)
+
+    # ---------------------------------------------------------------
+    # Run
+    # ---------------------------------------------------------------
+
+    def run(self):
+        started = time.monotonic()
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch("django.utils.timezone.now", lambda: self.now))
+            stack.enter_context(mock.patch.object(tasks, "_schedule_next_wave", self._schedule_next_wave))
+            stack.enter_context(mock.patch.object(services, "notify_runner", self._on_offer))
+            stack.enter_context(connection.execute_wrapper(self._count_queries))
+
+            self._seed_population()
+            self._schedule_arrivals()
+            self.at(HEARTBEAT_SECONDS, self._heartbeat)
+
+            while self._queue:
+                offset_s, _, fn, args = heapq.heappop(self._queue)
+                if offset_s > self.duration_s and fn == self._heartbeat:
+                    continue  # only the heartbeat keeps rescheduling itself
+                self.now = SIM_EPOCH + timedelta(seconds=offset_s)
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("simulation: event %s failed", getattr(fn, "__name__", fn))
+
+            report = self._report(time.monotonic() - started)
+        logger.info("simulation: %s", "; ".join(report.lines()))
+        return report
+
+    def _report(self, wall_seconds):
+        errands = Errand.objects.filter(id__in=self.errand_ids)
+        accepted = [
+            (accepted_at - created_at).total_seconds()
+            for created_at, accepted_at in errands.filter(accepted_at__isnull=False).values_list("created_at", "accepted_at")
+        ]
+        n_errands = len(self.errand_ids)
+        n_offers = ErrandOffer.objects.filter(errand_id__in=self.errand_ids).count()
+        return SimulationReport(
+            errands=n_errands,
+            filled=len(accepted),
+            expired=errands.filter(status=Errand.Status.EXPIRED).count(),
+            fill_rate=len(accepted) / n_errands if n_errands else 0.0,
+            accept_p50_s=_percentile(accepted, 0.5),
+            accept_p90_s=_percentile(accepted, 0.9),
+            offers_per_errand=n_offers / n_errands if n_errands else 0.0,
+            offers_per_filled=n_offers / len(accepted) if accepted else float("nan"),
+            db_queries_per_errand=self.db_queries / n_errands if n_errands else 0.0,
+            simulated_hours=self.duration_s / 3600,
+            wall_seconds=wall_seconds,
+        )
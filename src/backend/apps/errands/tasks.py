@@ -1,56 +1,166 @@
 import logging
 
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.errands.chaining import chain_options
+from apps.errands.dispatch import dispatcher, stalled_errands
+from apps.errands.leases import LeaseLost, fenced_update, matching_lease
 from apps.errands.models import Errand, ErrandOffer
-from runners.services import get_nearby_runners
+from apps.utils import jobs, metrics
+from runners.index import RunnerMatch
+from runners.offer_caps import saturated_runners
+from runners.services import find_nearby_runners, hydrate_runners
 from apps.errands.services import send_errand_offer, expire_errand
 
 logger = logging.getLogger(__name__)
 
-def start_errand_matching(errand_id):
-    logger.info("start_errand_matching triggered for errand=%s", errand_id)
+
+def offer_waves():
+    """(radius_m, size) rings from ERRAND_OFFER_WAVES, tried in order."""
+    return [tuple(wave) for wave in getattr(settings, 'ERRAND_OFFER_WAVES', [(1500, 3), (4000, 5), (10000, 10)])]
+
+
+def dispatch_next_wave(errand, lease=None):
+    """Send the errand's next offer wave: the closest `size` runners within the wave radius who
+    have not been offered this errand yet and are not at their offer caps. Empty rings are
+    skipped. Busy runners whose route passes close by (see apps.errands.chaining) come first in
+    the first wave. Returns the number of offers sent; 0 once every ring has been tried.
+
+    With the errand's matching `lease`, each wave is claimed with a fenced write, and LeaseLost
+    is raised before any offer is sent if a newer holder has taken over."""
+    waves = offer_waves()
+    offered = set(ErrandOffer.objects.filter(errand=errand).values_list('runner_id', flat=True))
+
+    while errand.offer_wave < len(waves):
+        radius_m, size = waves[errand.offer_wave]
+        if lease is not None:
+            fenced_update(errand, lease, offer_wave=errand.offer_wave + 1)
+        else:
+            errand.offer_wave += 1
+            errand.save(update_fields=["offer_wave", "updated_at"])
+
+        # 1️⃣ Closest runners in this ring (sorted by distance + trust_score), minus those already
+        # offered and those at their offer caps; twice the wave size is fetched to make up for them
+        matches = find_nearby_runners(errand, max_distance_m=radius_m, limit=2 * size + len(offered))
+        if errand.offer_wave == 1:
+            chained = [RunnerMatch(o.runner_id, None, None, 0, o.distance_m) for o in chain_options(errand.id)]
+            matches = chained + [m for m in matches if m.runner_id not in {c.runner_id for c in chained}]
+        matches = [m for m in matches if m.runner_id not in offered]
+        saturated = saturated_runners(m.runner_id for m in matches)
+        matches = [m for m in matches if m.runner_id not in saturated][:size]
+        runners = hydrate_runners(matches)
+        logger.info("dispatch_next_wave: wave=%s radius_m=%s found %s new runners for errand=%s", errand.offer_wave, radius_m, len(runners), errand.id)
+        if not runners:
+            continue
+
+        # 2️⃣ Send offers quoting the match distance; positions continue across waves
+        distances = {m.runner_id: m.distance_m for m in matches}
+        errand_value = errand.errand_value()
+        sent = 0
+        for idx, runner in enumerate(runners, start=len(offered) + 1):
+            try:
+                if send_errand_offer(errand, runner, position=idx, distance_m=distances.get(runner.id), errand_value=errand_value):
+                    sent += 1
+            except Exception as e:
+                logger.exception("dispatch_next_wave: failed to create offer for runner=%s errand=%s: %s", getattr(runner, 'id', None), errand.id, e)
+        metrics.incr("errand_offers.sent", sent)
+        if sent:
+            return sent
+    return 0
+
+
+def _schedule_next_wave(errand_id, delay):
+    jobs.enqueue("errands.follow_up", errand_id, delay=delay)
+
+
+@jobs.job("errands.follow_up")
+def follow_up_offer_wave(errand_id):
+    # Routed when the job runs: the cell may have moved to another matching worker by then
+    dispatcher.follow_up(errand_id)
+
+
+@jobs.job("errands.advance")
+def advance_offer_wave(errand_id, path="advance"):
+    """Send the errand's next wave if it is still unaccepted and unexpired, and schedule the one
+    after it for when this wave's offers run out. Runs under the errand's matching lease; a run
+    overlapping another one for the same errand is skipped (counted per `path`)."""
+    close_old_connections()
+    with matching_lease(errand_id, path) as lease:
+        if lease is None:
+            return
+        try:
+            _advance_offer_wave(errand_id, lease)
+        except LeaseLost as e:
+            logger.warning("advance_offer_wave: %s; stopping", e)
+
+
+def _advance_offer_wave(errand_id, lease):
     try:
-        errand = Errand.objects.get(id=errand_id)
+        errand = Errand.objects.select_related('go_to').get(id=errand_id)
     except Errand.DoesNotExist:
-        logger.warning("start_errand_matching: errand %s does not exist", errand_id)
+        logger.warning("advance_offer_wave: errand %s does not exist", errand_id)
         return
 
-    logger.debug("Loaded errand %s: status=%s is_open=%s", errand.id, errand.status, errand.is_open)
-
-    # Safety checks
+    # Safety checks: accepted, cancelled or already expired errands stop here
     if not errand.is_open or errand.status != Errand.Status.PENDING:
-        logger.info("start_errand_matching: errand %s is not open or not pending; skipping", errand.id)
+        logger.info("advance_offer_wave: errand %s is not open or not pending; stopping after %s waves", errand.id, errand.offer_wave)
+        return
+    if errand.expires_at and timezone.now() >= errand.expires_at:
+        logger.info("advance_offer_wave: errand %s reached expires_at after %s waves; expiring", errand.id, errand.offer_wave)
+        expire_errand(errand)
         return
 
-    # 1️⃣ Find nearby runners (sorted by distance + trust_score)
-    runners = get_nearby_runners(errand)
-    logger.info("start_errand_matching: found %s runners for errand=%s", len(runners), errand.id)
+    sent = dispatch_next_wave(errand, lease)
+    if sent:
+        logger.info("advance_offer_wave: wave=%s sent %s offers for errand=%s", errand.offer_wave, sent, errand.id)
+        if errand.offer_wave < len(offer_waves()):
+            _schedule_next_wave(errand.id, getattr(settings, 'ERRAND_OFFER_TTL_SECONDS', 60))
+        return
 
-    if not runners:
-        logger.info("start_errand_matching: no runners found for errand=%s; expiring errand", errand.id)
+    if not ErrandOffer.objects.filter(errand=errand).exists():
+        logger.info("advance_offer_wave: no runners found for errand=%s in any wave; expiring errand", errand.id)
         expire_errand(errand)
-        return
+    else:
+        # Offers of the last wave stay open; the errand expires at expires_at if nobody accepts
+        logger.info("advance_offer_wave: errand=%s has no more waves; waiting for expiry", errand.id)
 
-    # 2️⃣ Send offers sequentially
-    created_offers = []
-    for idx, runner in enumerate(runners, start=1):
-        logger.info("start_errand_matching: creating offer for runner=%s position=%s for errand=%s", getattr(runner, 'id', None), idx, errand.id)
-        try:
-            offer = send_errand_offer(errand, runner, position=idx)
-            if offer:
-                created_offers.append((getattr(offer, 'id', None), getattr(runner, 'id', None)))
-        except Exception as e:
-            logger.exception("start_errand_matching: failed to create offer for runner=%s errand=%s: %s", getattr(runner, 'id', None), errand.id, e)
-        # continue to create offers for next runners
-
-    # 3️⃣ Offers created — do NOT expire the errand here. Frontend polling / runner actions
-    # will drive acceptance and eventual expiration. We keep the errand open for the offers TTL.
-    logger.info("start_errand_matching: created %s offers for errand=%s; leaving errand open for polling", len(created_offers), errand.id)
-
-    # Extra debug: query DB for offers to ensure they persisted and log runner ids
-    try:
-        offers_qs = ErrandOffer.objects.filter(errand=errand).order_by('created_at')
-        offer_count = offers_qs.count()
-        sample = list(offers_qs.values_list('id', 'runner_id', 'status', 'expires_at')[:20])
-        logger.info("start_errand_matching: DB shows %s offers for errand=%s sample=%s", offer_count, errand.id, sample)
-    except Exception:
-        logger.exception("start_errand_matching: failed to query ErrandOffer rows for errand=%s", errand.id)
+
+@jobs.job("errands.match")
+def start_errand_matching(errand_id):
+    """Offer a new errand to runners in expanding waves (see ERRAND_OFFER_WAVES) instead of to
+    every nearby runner at once."""
+    logger.info("start_errand_matching triggered for errand=%s", errand_id)
+    advance_offer_wave(errand_id, path="start")
+
+
+@jobs.job("errands.sweep", every=getattr(settings, 'ERRAND_SWEEP_SECONDS', 60))
+def sweep_errands():
+    """Expire open errands past their expires_at and, when no matching worker is registered (the
+    workers sweep their own cells), advance stalled ones: errands whose follow-up job was
+    rejected by a full queue or lost with a restarting process. Both are found in the database,
+    so nothing long-lived waits in process memory. Returns (expired, advanced)."""
+    now = timezone.now()
+    batch = getattr(settings, 'ERRAND_SWEEP_BATCH', 500)
+
+    # 1️⃣ Errands past expires_at
+    expired = 0
+    due = Errand.objects.filter(status=Errand.Status.PENDING, is_open=True, expires_at__lte=now)
+    for errand in due.order_by("expires_at")[:batch]:
+        expire_errand(errand)
+        expired += 1
+
+    # 2️⃣ Errands whose follow-up wave was lost (per-errand matching without workers only)
+    advanced = 0
+    if getattr(settings, 'ERRAND_MATCHING_MODE', 'per_errand') != 'batch' and not dispatcher.ring():
+        for errand_id, _, _ in stalled_errands(now)[:batch]:
+            try:
+                advance_offer_wave(errand_id, path="sweep")
+                advanced += 1
+            except Exception:
+                logger.exception("sweep_errands: failed advancing errand=%s", errand_id)
+
+    if expired or advanced:
+        logger.info("sweep_errands: expired %s and advanced %s errands", expired, advanced)
+    return expired, advanced
@@ -1,3 +1,641 @@
-from django.test import TestCase
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
+
+from apps.errands.chaining import RouteCost, Stop, chain_options, insert_errand, plan_chains
+from apps.errands.dispatch import WORKER_KEY, WORKERS_KEY, HashRing, dispatcher, live_workers, register_worker, unregister_worker
+from apps.errands.matching import MatchingMarket, assign, run_batch_matching
+from apps.errands import leases
+from apps.errands.models import Errand, ErrandOffer, ErrandTask, MatchingLease
+from apps.errands.simulation import MarketplaceSimulator, load_arrivals
+from apps.errands.services import accept_offer, open_errands_near, send_errand_offer
+from apps.errands.tasks import advance_offer_wave, dispatch_next_wave, sweep_errands
+from apps.errands.trail import append_point, decode, encode, finish_trail, record_trail_point, trail_since
+from apps.locations.models import LocationMode
+from apps.locations.services import upsert_user_location
+from apps.utils import jobs, metrics
+from runners.index import bind_server
+from runners.services import np
+from runners.travel import HaversineProvider
+from runners.tests import make_errand, make_runner
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover - optional test dependency
+    fakeredis = None
+
+# Run the Redis-backed tests against a real, scratch Redis server (its db is flushed) instead of fakeredis
+REDIS_TEST_URL = os.getenv("REDIS_TEST_URL")
+
+
+def tearDownModule():
+    # Follow-up waves queued by the tests that ran matching
+    jobs.reset_queue()
+
+
+def market(errands, runners, blocked=((), ())):
+    return MatchingMarket(
+        errand_lats=np.array([e[0] for e in errands]),
+        errand_lons=np.array([e[1] for e in errands]),
+        errand_ages=np.array([e[2] for e in errands], dtype=np.float64),
+        runner_lats=np.array([r[0] for r in runners]),
+        runner_lons=np.array([r[1] for r in runners]),
+        runner_trust=np.array([r[2] for r in runners], dtype=np.float64),
+        blocked=blocked,
+    )
+
+
+class BatchAssignmentTests(SimpleTestCase):
+    def test_each_runner_gets_at_most_one_errand(self):
+        # Both errands want runner 0; the older one gets it, the other falls back to runner 1
+        m = market(
+            errands=[(3.8480, 11.5021, 10), (3.8481, 11.5022, 200)],
+            runners=[(3.8482, 11.5023, 60), (3.8600, 11.5100, 60), (4.0511, 9.7679, 100)],
+        )
+        for solver in ("greedy", "hungarian"):
+            self.assertEqual(sorted(assign(m, radius_m=5000, solver=solver)), [(0, 1), (1, 0)])
+
+    def test_blocked_and_out_of_radius_pairs_are_never_assigned(self):
+        m = market(
+            errands=[(3.8480, 11.5021, 0)],
+            runners=[(3.8482, 11.5023, 60), (4.0511, 9.7679, 100)],
+            blocked=((0,), (0,)),
+        )
+        self.assertEqual(assign(m, radius_m=5000), [])
+
+
+class BatchMatchingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_tick_sends_one_offer_per_errand_to_distinct_runners(self):
+        runners = [make_runner("r1", 3.8482, 11.5023), make_runner("r2", 3.8600, 11.5100)]
+        errands = [make_errand(3.8480, 11.5021), make_errand(3.8481, 11.5022)]
+
+        self.assertEqual(run_batch_matching(), 2)
+        offers = ErrandOffer.objects.filter(status=ErrandOffer.Status.PENDING)
+        self.assertEqual(sorted(offers.values_list("errand_id", flat=True)), sorted(e.id for e in errands))
+        self.assertEqual(sorted(offers.values_list("runner_id", flat=True)), sorted(r.id for r in runners))
+
+        # Everyone has a live offer: nothing more to send
+        self.assertEqual(run_batch_matching(), 0)
+
+    def test_markets_are_split_by_region(self):
+        yaounde_runner = make_runner("yaounde", 3.8482, 11.5023)
+        douala_runner = make_runner("douala", 4.0512, 9.7680)
+        yaounde_errand = make_errand(3.8480, 11.5021)
+        douala_errand = make_errand(4.0511, 9.7679)
+        self.assertEqual(douala_errand.go_to.region, "douala")
+
+        self.assertEqual(run_batch_matching(exclude_regions=["douala"]), 1)
+        self.assertEqual(run_batch_matching(region="douala"), 1)
+        self.assertEqual(
+            set(ErrandOffer.objects.values_list("errand_id", "runner_id")),
+            {(yaounde_errand.id, yaounde_runner.id), (douala_errand.id, douala_runner.id)},
+        )
+
+
+class HashRingTests(SimpleTestCase):
+    def test_only_the_joining_or_leaving_worker_cells_move(self):
+        cells = [f"{row}:{col}" for row in range(40) for col in range(50)]
+        before = HashRing(["w1", "w2", "w3"])
+        after = HashRing(["w1", "w2", "w3", "w4"])
+
+        moved = [cell for cell in cells if before.owner(cell) != after.owner(cell)]
+        self.assertTrue(all(after.owner(cell) == "w4" for cell in moved))
+        self.assertLess(abs(len(moved) / len(cells) - 0.25), 0.1)
+        # w4 leaving hands its cells back to their previous owners
+        self.assertTrue(all(before.owner(cell) == HashRing(["w1", "w2", "w3"]).owner(cell) for cell in moved))
+
+
+class _RecordingHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            self.server.requests.append(json.loads(raw))
+            self.wfile.write(b'{"ok": true}\n')
+
+
+class DispatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        dispatcher.invalidate()
+        self.addCleanup(dispatcher.invalidate)
+        directory = tempfile.mkdtemp()
+        self.servers = {}
+        for worker_id in ("w1", "w2"):
+            address = f"unix:{os.path.join(directory, worker_id)}.sock"
+            server = bind_server(address, _RecordingHandler)
+            server.requests = []
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            register_worker(worker_id, address)
+            self.servers[worker_id] = server
+
+    def test_errand_goes_to_the_cell_owner_and_moves_when_it_leaves(self):
+        errand = make_errand(3.8480, 11.5021)
+        cell = "76:230"
+        owner = dispatcher.owner_of(cell)
+        other = ({"w1", "w2"} - {owner}).pop()
+
+        self.assertEqual(dispatcher.dispatch(errand.id, cell), owner)
+        self.assertEqual(self.servers[owner].requests, [{"op": "match", "errand_id": errand.id}])
+
+        unregister_worker(owner)
+        dispatcher.invalidate()
+        self.assertEqual(dispatcher.follow_up(errand.id), other)
+        self.assertEqual(self.servers[other].requests, [{"op": "advance", "errand_id": errand.id}])
+
+    def test_workers_registering_together_are_all_kept_and_crashed_ones_pruned(self):
+        threads = [threading.Thread(target=register_worker, args=(f"n{i}", f"unix:/tmp/n{i}.sock")) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(live_workers()), {"w1", "w2", *(f"n{i}" for i in range(10))})
+
+        # A crashed worker stops renewing: its id leaves the registry, not only the ring
+        cache.delete(WORKER_KEY.format(worker_id="n0"))
+        self.assertNotIn("n0", live_workers())
+        self.assertNotIn("n0", cache.get(WORKERS_KEY))
+
+
+class OfferWaveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_waves_widen_ring_by_ring(self):
+        near = make_runner("near", 3.8490, 11.5021)   # ~100 m
+        mid = make_runner("mid", 3.8750, 11.5021)     # ~3 km
+        near_too = make_runner("near_too", 3.8485, 11.5021)
+        far = make_runner("far", 3.9200, 11.5021)     # ~8 km
+        errand = make_errand(3.8480, 11.5021)
+
+        with self.settings(ERRAND_OFFER_WAVES=[(1500, 1), (5000, 2), (10000, 5)]):
+            offered = []
+            for expected in ([near_too], [near, mid], [far]):
+                self.assertEqual(dispatch_next_wave(errand), len(expected))
+                wave = ErrandOffer.objects.filter(errand=errand).exclude(runner__in=offered)
+                self.assertEqual(sorted(wave.values_list("runner_id", flat=True)), sorted(r.id for r in expected))
+                offered += expected
+            self.assertEqual(errand.offer_wave, 3)
+            self.assertEqual(dispatch_next_wave(errand), 0)
+
+    def test_errand_without_runners_in_any_ring_expires(self):
+        make_runner("far", 4.0511, 9.7679)
+        errand = make_errand(3.8480, 11.5021)
+
+        advance_offer_wave(errand.id)
+
+        errand.refresh_from_db()
+        self.assertEqual(errand.status, Errand.Status.EXPIRED)
+        self.assertEqual(errand.offer_wave, 3)
+        self.assertEqual(metrics.get("errand_offer_waves.expired.3"), 1)
+
+
+class OfferCapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_saturated_runner_is_skipped_for_the_next_best(self):
+        busy = make_runner("busy", 3.8481, 11.5021)
+        spare = make_runner("spare", 3.8490, 11.5021)
+
+        with self.settings(RUNNER_MAX_PENDING_OFFERS=2, RUNNER_MAX_OFFERS_PER_MINUTE=0, ERRAND_OFFER_WAVES=[(1500, 1)]):
+            first, second, third = (make_errand(3.8480, 11.5021) for _ in range(3))
+            self.assertIsNotNone(send_errand_offer(first, busy))
+            self.assertIsNotNone(send_errand_offer(second, busy))
+            # Re-offering an errand the runner already holds does not take another slot
+            self.assertIsNotNone(send_errand_offer(second, busy))
+            self.assertIsNone(send_errand_offer(third, busy))
+
+            self.assertEqual(dispatch_next_wave(third), 1)
+            self.assertEqual(list(ErrandOffer.objects.filter(errand=third).values_list("runner_id", flat=True)), [spare.id])
+
+            # Accepting elsewhere gives the slot back
+            accept_offer(first, spare)
+            self.assertIsNotNone(send_errand_offer(third, busy))
+
+    def test_per_minute_cap(self):
+        runner = make_runner("runner", 3.8481, 11.5021)
+        with self.settings(RUNNER_MAX_PENDING_OFFERS=0, RUNNER_MAX_OFFERS_PER_MINUTE=2):
+            sent = [send_errand_offer(make_errand(3.8480, 11.5021), runner) for _ in range(3)]
+        self.assertEqual([offer is not None for offer in sent], [True, True, False])
+
+
+class ChainingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_insertion_keeps_committed_stop_first_and_return_after_go_to(self):
+        costs = RouteCost(HaversineProvider())
+        start = (0.0, 0.0)
+        route = [Stop(1, 0.0, 0.02)]
+        new_route, length = insert_errand(costs, start, route, [Stop(2, 0.0, 0.01), Stop(2, 0.0, 0.03, True)])
+        self.assertEqual([(s.errand_id, s.is_return) for s in new_route], [(1, False), (2, False), (2, True)])
+        self.assertAlmostEqual(length, costs.length(start, [Stop(0, 0.0, 0.03)]) + 2 * costs.leg((0.0, 0.02), (0.0, 0.01)), places=3)
+
+    def test_round_trip_in_progress_is_finished_before_the_new_errand(self):
+        costs = RouteCost(HaversineProvider())
+        route = [Stop(1, 0.0, 0.02), Stop(1, 0.0, 0.0, True)]
+        # Cheaper between the current go_to and return_to, but that would delay the current buyer
+        new_route, _ = insert_errand(costs, (0.0, 0.0), route, [Stop(2, 0.0, 0.021)])
+        self.assertEqual([(s.errand_id, s.is_return) for s in new_route], [(1, False), (1, True), (2, False)])
+
+    def test_busy_runner_finishing_nearby_is_offered_first(self):
+        busy = make_runner("busy", 3.8400, 11.5021)
+        idle = make_runner("idle", 3.8490, 11.5021)
+        current = make_errand(3.8470, 11.5021)
+        accept_offer(current, busy)
+        errand = make_errand(3.8480, 11.5021)
+
+        self.assertEqual(plan_chains(), 1)
+        [option] = chain_options(errand.id)
+        self.assertEqual(option.runner_id, busy.id)
+        self.assertLess(option.detour_m, 200)
+        # Quoted from the current errand's go_to (~111 m), not from the runner's position (~890 m)
+        self.assertLess(option.distance_m, 200)
+
+        with self.settings(ERRAND_OFFER_WAVES=[(1500, 1), (1500, 1)]):
+            dispatch_next_wave(errand)
+            self.assertEqual(list(ErrandOffer.objects.filter(errand=errand).values_list("runner_id", flat=True)), [busy.id])
+            dispatch_next_wave(errand)
+        self.assertEqual(sorted(ErrandOffer.objects.filter(errand=errand).values_list("runner_id", flat=True)), sorted([busy.id, idle.id]))
+
+    def test_runners_at_the_chain_capacity_are_not_offered_chained_errands(self):
+        busy = make_runner("busy", 3.8400, 11.5021)
+        accept_offer(make_errand(3.8470, 11.5021), busy)
+        errand = make_errand(3.8480, 11.5021)
+
+        with self.settings(ERRAND_CHAIN_MAX_ACTIVE_ERRANDS=1):
+            self.assertEqual(plan_chains(), 0)
+        self.assertEqual(plan_chains(), 1)
+        self.assertEqual([o.runner_id for o in chain_options(errand.id)], [busy.id])
+
+        # Planned options are dropped once the runner has since reached the cap
+        accept_offer(make_errand(3.8300, 11.5021), busy)
+        self.assertEqual(chain_options(errand.id), [])
+
+
+class MarketplaceSimulationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_simulated_hour_reports_marketplace_metrics(self):
+        arrivals = os.path.join(tempfile.mkdtemp(), "arrivals.csv")
+        with open(arrivals, "w") as fh:
+            fh.write("offset_s,latitude,longitude,price\n")
+            fh.writelines(f"{i * 120},3.848,11.502,2000\n" for i in range(20))
+
+        report = MarketplaceSimulator(runners=15, hours=1, arrivals=load_arrivals(arrivals), seed=1).run()
+
+        self.assertEqual(report.errands, 20)
+        self.assertGreater(report.filled, 0)
+        self.assertLessEqual(report.filled + report.expired, report.errands)
+        self.assertGreaterEqual(report.offers_per_errand, 1.0)
+        self.assertGreater(report.db_queries_per_errand, 0)
+        # The virtual clock is gone once the run is over
+        self.assertLess(abs((timezone.now() - datetime.now(dt_timezone.utc)).total_seconds()), 60)
+
+
+class MatchingLeaseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lease_is_exclusive_and_tokens_increase(self):
+        errand = make_errand(3.8480, 11.5021)
+        for backend in ("db", "cache"):
+            with self.settings(ERRAND_LEASE_BACKEND=backend):
+                first = leases.acquire(errand.id)
+                self.assertIsNotNone(first)
+                self.assertIsNone(leases.acquire(errand.id))
+                first.release()
+                second = leases.acquire(errand.id)
+                self.assertGreater(second.token, first.token)
+                second.release()
+
+    def test_overlapping_run_is_skipped_and_counted(self):
+        make_runner("runner", 3.8481, 11.5021)
+        errand = make_errand(3.8480, 11.5021)
+        with self.settings(ERRAND_LEASE_BACKEND="db"):
+            held = leases.acquire(errand.id)
+            advance_offer_wave(errand.id)
+            self.assertFalse(ErrandOffer.objects.filter(errand=errand).exists())
+            self.assertEqual(metrics.get("errand_matching.lease_skipped.advance"), 1)
+
+            held.release()
+            advance_offer_wave(errand.id)
+        self.assertEqual(ErrandOffer.objects.filter(errand=errand).count(), 1)
+
+    def test_stale_holder_is_fenced_off(self):
+        make_runner("runner", 3.8481, 11.5021)
+        errand = make_errand(3.8480, 11.5021)
+        with self.settings(ERRAND_LEASE_BACKEND="db"):
+            stale = leases.acquire(errand.id)
+            # The holder stalls past its TTL and a new holder takes over and writes
+            MatchingLease.objects.filter(errand=errand).update(expires_at=timezone.now())
+            current = leases.acquire(errand.id)
+            leases.fenced_update(Errand.objects.get(id=errand.id), current)
+
+            with self.assertRaises(leases.LeaseLost):
+                dispatch_next_wave(errand, stale)
+        self.assertFalse(ErrandOffer.objects.filter(errand=errand).exists())
+
+
+_job_calls = []
+_job_gates = {"hold": threading.Event()}
+
+
+@jobs.job("tests.record")
+def _record_job(value="tick", gate=None):
+    if gate:
+        _job_gates[gate].wait(5)
+    _job_calls.append((value, threading.current_thread().name))
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _job_calls.clear()
+        _job_gates["hold"].clear()
+
+    def test_full_queue_rejects_jobs_and_drain_finishes_queued_ones(self):
+        pool = jobs.ThreadPool(workers=1, size=1, delayed_size=1)
+        pool.submit("tests.record", ("busy", "hold"))   # occupies the only worker
+        time.sleep(0.05)
+        pool.submit("tests.record", ("queued",))        # fills the queue
+        pool.submit("tests.record", ("overflow",))      # no room: rejected, not run here
+        pool.submit("tests.record", ("later",), delay=60)
+        pool.submit("tests.record", ("too late",), delay=60)  # delayed jobs are bounded too
+        self.assertEqual(_job_calls, [])
+        self.assertEqual(metrics.get("jobs.rejected"), 2)
+        self.assertEqual(pool.depth(), (1, 1))
+
+        _job_gates["hold"].set()
+        self.assertTrue(pool.drain(timeout=5))
+        self.assertEqual([value for value, _ in _job_calls], ["busy", "queued"])
+        self.assertEqual(metrics.get("jobs.started"), 2)
+        self.assertEqual(metrics.get("jobs.latency_ms.count"), 2)
+        self.assertEqual(metrics.get("jobs.dropped"), 1)
+
+    def test_delayed_job_runs_once_due(self):
+        pool = jobs.ThreadPool(workers=1, size=4, delayed_size=4)
+        pool.submit("tests.record", ("second",), delay=0.2)
+        pool.submit("tests.record", ("first",), delay=0.05)
+        self.assertEqual(pool.depth(), (0, 2))
+        deadline = time.monotonic() + 5
+        while len(_job_calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([value for value, _ in _job_calls], ["first", "second"])
+        pool.drain(timeout=1)
+
+    def test_periodic_job_runs_once_per_interval_across_processes(self):
+        pools = [jobs.ThreadPool(workers=1, size=4, delayed_size=4) for _ in range(2)]
+        with mock.patch.dict(jobs._periodic, {"tests.record": 0.05}, clear=True):
+            # Both pools are due every 50 ms; the cache claim (held for 1 s) lets one of them run it
+            for pool in pools:
+                pool.start()
+            time.sleep(0.5)
+            for pool in pools:
+                pool.drain(timeout=1)
+        self.assertEqual(len(_job_calls), 1)
+        self.assertEqual(metrics.get("jobs.enqueued"), 1)
+        self.assertEqual(metrics.get("jobs.started"), 1)
+
+    def test_delayed_jobs_dropped_on_shutdown_leave_the_queue_depth(self):
+        jobs.reset_queue()
+        cache.clear()
+        jobs.enqueue("tests.record", "later", delay=60)
+        self.assertEqual(jobs.queue_stats()["depth"], 1)
+        jobs.reset_queue()
+        stats = jobs.queue_stats()
+        self.assertEqual((stats["depth"], stats["dropped"]), (0, 1))
+        self.assertEqual(_job_calls, [])
+
+    def test_sweep_expires_due_errands_and_advances_stalled_ones_without_workers(self):
+        dispatcher.invalidate()
+        due, stalled = make_errand(3.8480, 11.5021), make_errand(3.8490, 11.5031)
+        now = timezone.now()
+        Errand.objects.filter(id=due.id).update(expires_at=now - timedelta(seconds=1))
+        Errand.objects.filter(id=stalled.id).update(expires_at=now + timedelta(hours=1), updated_at=now - timedelta(hours=1))
+
+        with mock.patch("apps.errands.tasks.advance_offer_wave") as advance:
+            self.assertEqual(sweep_errands(), (1, 1))
+        self.assertEqual(Errand.objects.get(id=due.id).status, Errand.Status.EXPIRED)
+        advance.assert_called_once_with(stalled.id, path="sweep")
+
+        # With a matching worker registered, the worker sweeps its own cells
+        register_worker("w1", "unix:/tmp/w1.sock")
+        dispatcher.invalidate()
+        with mock.patch("apps.errands.tasks.advance_offer_wave") as advance:
+            self.assertEqual(sweep_errands(), (0, 0))
+        advance.assert_not_called()
+        unregister_worker("w1")
+        dispatcher.invalidate()
+
+
+@skipIf(jobs.celery is None, "celery is not installed")
+class CeleryJobQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _job_calls.clear()
+        jobs.reset_queue()
+
+    def tearDown(self):
+        jobs.reset_queue()
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_job_runs_through_eager_celery(self):
+        # apply_async runs the jobs.run task in this thread, through Celery's tracer
+        jobs.CeleryQueue().submit("tests.record", ("eager",))
+        self.assertEqual(_job_calls, [("eager", threading.current_thread().name)])
+        self.assertEqual(metrics.get("jobs.started"), 1)
+        self.assertEqual(metrics.get("jobs.latency_ms.count"), 1)
+
+    @override_settings(JOB_QUEUE_BACKEND="celery", CELERY_TASK_ALWAYS_EAGER=False)
+    def test_enqueue_sends_the_job_to_the_broker_with_its_delay(self):
+        from core.celery import run_job
+
+        with mock.patch.object(run_job, "apply_async") as send:
+            jobs.enqueue("tests.record", "x", delay=30)
+        self.assertIsInstance(jobs.get_queue(), jobs.CeleryQueue)
+        (name, args, due), = [call.kwargs["args"] for call in send.call_args_list]
+        self.assertEqual((name, args), ("tests.record", ["x"]))
+        self.assertAlmostEqual(due, time.time() + 30, delta=5)
+        self.assertEqual(send.call_args.kwargs["countdown"], 30)
+
+        # A worker runs what was sent
+        run_job(name, args, time.time())
+        self.assertEqual([value for value, _ in _job_calls], ["x"])
+        self.assertEqual((metrics.get("jobs.enqueued"), metrics.get("jobs.started")), (1, 1))
+
+    def test_beat_schedules_the_periodic_jobs_once_per_interval(self):
+        from core.celery import app, run_periodic_job, schedule_periodic_jobs
+
+        schedule_periodic_jobs()
+        entry = app.conf.beat_schedule["errands.sweep"]
+        self.assertEqual((entry["task"], entry["schedule"]), ("jobs.run_periodic", 60))
+
+        with mock.patch.dict(jobs._periodic, {"tests.record": 60}, clear=True):
+            run_periodic_job("tests.record")
+            run_periodic_job("tests.record")
+        self.assertEqual(len(_job_calls), 1)
+
+
+def register_concurrently(names):
+    threads = [threading.Thread(target=metrics.incr, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_counter_names_registered_concurrently_are_all_listed_once(self):
+        names = [f"c{i}" for i in range(20)] * 2
+        register_concurrently(names)
+        self.assertEqual(metrics.snapshot(), {f"c{i}": 2 for i in range(20)})
+        self.assertEqual(cache.get(metrics.METRIC_NAME_SLOTS_KEY), 20)
+
+
+@skipIf(fakeredis is None and not REDIS_TEST_URL, "needs fakeredis or REDIS_TEST_URL")
+class RedisMetricsTests(SimpleTestCase):
+    def test_counter_names_registered_concurrently_are_all_listed_once(self):
+        options = {} if REDIS_TEST_URL else {"connection_class": fakeredis.FakeConnection}
+        redis_cache = {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_TEST_URL or "redis://metrics-tests:6379/0",
+            "KEY_PREFIX": f"metrics-tests-{os.getpid()}",
+            "OPTIONS": options,
+        }
+        with override_settings(CACHES={"default": redis_cache}):
+            self.assertIsInstance(caches["default"], RedisCache)
+            cache.clear()
+            try:
+                register_concurrently([f"c{i}" for i in range(20)] * 2)
+                self.assertEqual(metrics.snapshot(), {f"c{i}": 2 for i in range(20)})
+                self.assertEqual(cache.get(metrics.METRIC_NAME_SLOTS_KEY), 20)
+            finally:
+                cache.clear()
+
+
+class TrailEncodingTests(SimpleTestCase):
+    def test_ring_buffer_keeps_latest_points(self):
+        points = [(1_700_000_000_000 + i * 5000, 3_848_000 + i * 7, 11_502_100 - i * 3) for i in range(10)]
+        self.assertEqual(decode(encode(points)), points)
+
+        blob = b""
+        for point in points:
+            blob = append_point(blob, point, capacity=4)
+        self.assertEqual(decode(blob), points[-4:])
+        # 20-byte header + 12 bytes per later point
+        self.assertEqual(len(blob), 20 + 3 * 12)
+
+
+class ErrandTrailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_trail_is_recorded_while_in_progress_and_persisted(self):
+        runner = make_runner("r1", 3.8490, 11.5030)
+        errand = make_errand(3.8480, 11.5021)
+        record_trail_point(runner.id, 3.8490, 11.5030)  # no errand yet: ignored
+        accept_offer(errand, runner)
+
+        start_ms = int(time.time() * 1000) - 60000
+        for i, lat in enumerate((3.8490, 3.8486, 3.8482)):
+            record_trail_point(runner.id, lat, 11.5030, at_ms=start_ms + i * 5000)
+        upsert_user_location(runner, LocationMode.DEVICE, 3.8481, 11.5025)
+
+        trail = trail_since(errand)
+        self.assertEqual([p[1] for p in trail], [3.8490, 3.8486, 3.8482, 3.8481])
+        since = datetime.fromtimestamp((start_ms + 5000) / 1000, tz=dt_timezone.utc)
+        self.assertEqual([p[1] for p in trail_since(errand, since)], [3.8482, 3.8481])
+
+        finish_trail(errand)
+        record_trail_point(runner.id, 3.9, 11.6)  # finished: ignored
+        cache.clear()
+        self.assertEqual(trail_since(errand), trail)
+
+    def test_chained_errand_does_not_stop_the_first_errands_trail(self):
+        runner = make_runner("r1", 3.8490, 11.5030)
+        first, chained = make_errand(3.8480, 11.5021), make_errand(3.8470, 11.5010)
+        accept_offer(first, runner)
+        record_trail_point(runner.id, 3.8490, 11.5030)
+        accept_offer(chained, runner)
+        record_trail_point(runner.id, 3.8486, 11.5030)
+        self.assertEqual([p[1] for p in trail_since(first)], [3.8490, 3.8486])
+        self.assertEqual([p[1] for p in trail_since(chained)], [3.8486])
+
+        Errand.objects.filter(id=first.id).update(status=Errand.Status.COMPLETED)
+        finish_trail(first)
+        record_trail_point(runner.id, 3.8482, 11.5030)
+        self.assertEqual([p[1] for p in trail_since(first)], [3.8490, 3.8486])
+        self.assertEqual([p[1] for p in trail_since(chained)], [3.8486, 3.8482])
+
+    def test_errand_leaving_in_progress_without_finish_gets_no_more_points(self):
+        runner = make_runner("r1", 3.8490, 11.5030)
+        errand = make_errand(3.8480, 11.5021)
+        accept_offer(errand, runner)
+        record_trail_point(runner.id, 3.8490, 11.5030)
+
+        # e.g. an admin edit: finish_trail is never called
+        Errand.objects.filter(id=errand.id).update(status=Errand.Status.COMPLETED)
+        record_trail_point(runner.id, 3.8486, 11.5030)
+        self.assertEqual([p[1] for p in trail_since(errand)], [3.8490])
+        with self.assertNumQueries(0):
+            record_trail_point(runner.id, 3.8482, 11.5030)
+
+
+class OfferQuoteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_accept_charges_the_quote_stored_on_the_offer(self):
+        runner = make_runner("r1", 3.8570, 11.5021)  # ~1 km
+        errand = make_errand(3.8480, 11.5021)
+        ErrandTask.objects.create(errand=errand, description="bread", price=1000)
+
+        offer = send_errand_offer(errand, runner, position=1)
+        self.assertAlmostEqual(offer.distance_m, 1000.8, delta=1)
+        self.assertEqual((offer.quoted_errand_value, offer.quoted_distance_fee, offer.quoted_service_fee), (1000, 250, 200))
+        self.assertEqual(offer.quoted_total_price, 1450)
+
+        # The runner drives away and the buyer edits tasks: the accepted price is still the quote
+        upsert_user_location(runner, LocationMode.DEVICE, 3.9480, 11.5021)
+        ErrandTask.objects.create(errand=errand, description="milk", price=500)
+        accept_offer(errand, runner, offer=offer)
+
+        errand.refresh_from_db()
+        self.assertEqual((errand.quoted_distance_fee, errand.quoted_total_price), (250, 1450))
+
+
+class OpenErrandsNearTests(TestCase):
+    def test_open_errands_are_paginated_by_distance(self):
+        far = make_errand(3.8750, 11.5021)     # ~3 km
+        near = make_errand(3.8490, 11.5021)    # ~100 m
+        mid = make_errand(3.8600, 11.5021)     # ~1.3 km
+        make_errand(3.9500, 11.5021)           # ~11 km, outside the radius
+        taken = make_errand(3.8481, 11.5021)
+        Errand.objects.filter(id=taken.id).update(status=Errand.Status.IN_PROGRESS)
+        stale = make_errand(3.8482, 11.5021)
+        Errand.objects.filter(id=stale.id).update(expires_at=datetime(2020, 1, 1, tzinfo=dt_timezone.utc))
+
+        first_page = open_errands_near(3.8480, 11.5021, 5000, limit=2)
+        self.assertEqual([e.id for e in first_page], [near.id, mid.id])
+        self.assertAlmostEqual(first_page[0].distance_m, 111, delta=2)
+        self.assertEqual([e.id for e in open_errands_near(3.8480, 11.5021, 5000, limit=2, offset=2)], [far.id])
+        self.assertEqual(open_errands_near(3.8480, 11.5021, 5000, exclude_user=near.user), [])
@@ -0,0 +1,186 @@
+"""Live location trail of the runner of an IN_PROGRESS errand.
+
+While an errand is in progress, each accepted location ping of its runner is appended to a
+fixed-size ring buffer (`ERRAND_TRAIL_SIZE` points, oldest dropped first) held in the cache. When
+the errand leaves IN_PROGRESS the buffer is written once, compressed, to ErrandTrail.
+
+A runner may carry several errands at once (chained errands, see apps.errands.chaining): each
+ping goes to the trail of every errand the runner has IN_PROGRESS, read from the database. A
+per-runner cache marker, renewed by the pings and expiring after ERRAND_TRAIL_TTL_SECONDS, keeps
+the pings of runners without errands to one cache read. An errand that left IN_PROGRESS without
+`finish_trail` (admin edits, expiry) gets no more points.
+
+Points are (timestamp_ms, lat_e6, lon_e6) integers. The buffer stores the oldest point in full
+and every later one as a delta from its predecessor, which keeps entries small (and compress well)
+for a runner moving a few meters every few seconds:
+
+    header  <Iqii   count, t0, lat0, lon0
+    body    int32   (dt, dlat, dlon) * (count - 1), little-endian
+"""
+import logging
+import struct
+import sys
+import time
+import zlib
+from array import array
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.errands.models import Errand, ErrandTrail
+
+logger = logging.getLogger(__name__)
+
+TRAIL_KEY = "errands:trail:{errand_id}"
+ACTIVE_RUNNER_KEY = "errands:trailing-runner:{runner_id}"
+
+_HEADER = struct.Struct("<Iqii")
+_SCALE = 1_000_000
+_INT32_MIN, _INT32_MAX = -(2 ** 31), 2 ** 31 - 1
+
+
+def _deltas_to_bytes(deltas):
+    if sys.byteorder != "little":  # pragma: no cover
+        deltas = array("i", deltas)
+        deltas.byteswap()
+    return deltas.tobytes()
+
+
+def encode(points):
+    """Pack [(t_ms, lat_e6, lon_e6), ...] (oldest first) into the delta format."""
+    if not points:
+        return b""
+    deltas = array("i")
+    for prev, cur in zip(points, points[1:]):
+        deltas.extend((cur[0] - prev[0], cur[1] - prev[1], cur[2] - prev[2]))
+    return _HEADER.pack(len(points), *points[0]) + _deltas_to_bytes(deltas)
+
+
+def decode(blob):
+    """Inverse of `encode`."""
+    if not blob:
+        return []
+    count, t, lat, lon = _HEADER.unpack_from(blob)
+    deltas = array("i")
+    deltas.frombytes(blob[_HEADER.size:])
+    if sys.byteorder != "little":  # pragma: no cover
+        deltas.byteswap()
+    points = [(t, lat, lon)]
+    for i in range(0, 3 * (count - 1), 3):
+        t, lat, lon = t + deltas[i], lat + deltas[i + 1], lon + deltas[i + 2]
+        points.append((t, lat, lon))
+    return points
+
+
+def append_point(blob, point, capacity):
+    """Append a point to an encoded ring buffer, dropping the oldest points beyond `capacity`."""
+    if not blob:
+        return encode([point])
+    count, t0, lat0, lon0 = _HEADER.unpack_from(blob)
+    deltas = array("i")
+    deltas.frombytes(blob[_HEADER.size:])
+    if sys.byteorder != "little":  # pragma: no cover
+        deltas.byteswap()
+
+    # Last point, to delta-encode the new one against it
+    t, lat, lon = t0 + sum(deltas[0::3]), lat0 + sum(deltas[1::3]), lon0 + sum(deltas[2::3])
+    delta = (point[0] - t, point[1] - lat, point[2] - lon)
+    if any(not _INT32_MIN <= d <= _INT32_MAX for d in delta):
+        # A gap of 24+ days (or a clock jump) does not fit a delta: start over from this point
+        logger.warning("append_point: delta %s out of range; restarting trail", delta)
+        return encode([point])
+    deltas.extend(delta)
+    count += 1
+
+    # Evict from the front: the next point becomes the full-precision base
+    while count > capacity:
+        t0, lat0, lon0 = t0 + deltas[0], lat0 + deltas[1], lon0 + deltas[2]
+        del deltas[0:3]
+        count -= 1
+    return _HEADER.pack(count, t0, lat0, lon0) + _deltas_to_bytes(deltas)
+
+
+def _to_point(latitude, longitude, at_ms=None):
+    return (
+        int(at_ms if at_ms is not None else time.time() * 1000),
+        int(round(float(latitude) * _SCALE)),
+        int(round(float(longitude) * _SCALE)),
+    )
+
+
+def _trail_ttl():
+    return getattr(settings, 'ERRAND_TRAIL_TTL_SECONDS', 86400)
+
+
+def _in_progress_errand_ids(runner_id, exclude=None):
+    errands = Errand.objects.filter(runner_id=runner_id, status=Errand.Status.IN_PROGRESS)
+    if exclude is not None:
+        errands = errands.exclude(id=exclude)
+    return list(errands.values_list("id", flat=True))
+
+
+def start_trail(errand):
+    """The errand was accepted: record its runner's pings from now on."""
+    cache.delete(TRAIL_KEY.format(errand_id=errand.id))
+    cache.set(ACTIVE_RUNNER_KEY.format(runner_id=errand.runner_id), True, timeout=_trail_ttl())
+
+
+def record_trail_point(runner_id, latitude, longitude, at_ms=None):
+    """Called on runner location writes; a no-op (one cache read) unless the runner has had an
+    errand in progress recently. Appends the point to the trail of each errand the runner has
+    IN_PROGRESS."""
+    active_key = ACTIVE_RUNNER_KEY.format(runner_id=runner_id)
+    if not cache.get(active_key):
+        return
+    errand_ids = _in_progress_errand_ids(runner_id)
+    if not errand_ids:
+        # Its errands left IN_PROGRESS without finish_trail
+        cache.delete(active_key)
+        return
+
+    point = _to_point(latitude, longitude, at_ms)
+    ttl = _trail_ttl()
+    for errand_id in errand_ids:
+        key = TRAIL_KEY.format(errand_id=errand_id)
+        cache.set(key, append_point(cache.get(key), point, getattr(settings, 'ERRAND_TRAIL_SIZE', 512)), timeout=ttl)
+    cache.touch(active_key, ttl)
+
+
+def finish_trail(errand):
+    """The errand left IN_PROGRESS: persist its trail (if any) and stop recording."""
+    key = TRAIL_KEY.format(errand_id=errand.id)
+    blob = cache.get(key)
+    discard_trail(errand)
+    if not blob:
+        return None
+    trail, _ = ErrandTrail.objects.update_or_create(
+        errand=errand,
+        defaults={"points": zlib.compress(blob), "point_count": _HEADER.unpack_from(blob)[0]},
+    )
+    logger.info("finish_trail: stored %s points (%s bytes) for errand=%s", trail.point_count, len(trail.points), errand.id)
+    return trail
+
+
+def discard_trail(errand):
+    """Stop recording and drop the live buffer without persisting it (the errand is being deleted).
+    The runner's pings keep going to their other in-progress errands."""
+    if errand.runner_id is not None and not _in_progress_errand_ids(errand.runner_id, exclude=errand.id):
+        cache.delete(ACTIVE_RUNNER_KEY.format(runner_id=errand.runner_id))
+    cache.delete(TRAIL_KEY.format(errand_id=errand.id))
+
+
+def trail_since(errand, since=None):
+    """Trail points after `since` (an aware datetime) as (datetime, lat, lon), oldest first.
+    Live errands are read from the ring buffer, finished ones from ErrandTrail."""
+    blob = cache.get(TRAIL_KEY.format(errand_id=errand.id))
+    if blob is None:
+        stored = ErrandTrail.objects.filter(errand=errand).values_list("points", flat=True).first()
+        blob = zlib.decompress(bytes(stored)) if stored else b""
+
+    since_ms = int(since.timestamp() * 1000) if since is not None else None
+    return [
+        (datetime.fromtimestamp(t / 1000, tz=dt_timezone.utc), lat / _SCALE, lon / _SCALE)
+        for t, lat, lon in decode(blob)
+        if since_ms is None or t > since_ms
+    ]
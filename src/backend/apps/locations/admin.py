@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ServiceArea
+
+
+@admin.register(ServiceArea)
+class ServiceAreaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'is_active', 'updated_at')
+    list_filter = ('is_active',)
+    search_fields = ('name',)
+    readonly_fields = ('min_lat', 'min_lon', 'max_lat', 'max_lon', 'updated_at')
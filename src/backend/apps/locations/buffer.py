@@ -0,0 +1,192 @@
+"""Write-behind buffer for frequent DEVICE location pings.
+
+Each worker process keeps the latest accepted position per user and writes all of them to
+UserLocation with one `bulk_update` every `LOCATION_PING_FLUSH_MS`. Pings that moved less than
+`LOCATION_PING_MIN_MOVE_M` from the last accepted position are dropped. The DB row therefore lags
+by at most one flush interval: the runner index sees the new position immediately
+(`services.ingest_location_ping`), and the nearby-runner snapshots covering a flushed runner's old
+and new cells are invalidated again once the row is written, so none is cached from stale rows.
+
+Each ping carries the time it was received, and the flush writes it as the row's `updated_at`.
+A row already updated at or after that time (another process handled a newer ping) is left alone.
+Pings of a failed flush go back into the buffer unless a newer one arrived in the meantime.
+Each flush also forgets the cached state of users not seeded for LOCATION_PING_RESEED_SECONDS.
+"""
+import atexit
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from apps.locations.grid import grid_cell_for, region_for
+from apps.locations.service_areas import service_area_for
+from runners.services import distance_between
+from runners.snapshots import touch_runner_cells
+
+from .models import UserLocation
+
+logger = logging.getLogger(__name__)
+
+
+class Ping(NamedTuple):
+    mode: str
+    latitude: float
+    longitude: float
+    address: object
+    received_at: object = None
+
+
+class _UserState:
+    __slots__ = (
+        "location_id", "latitude", "longitude", "is_runner", "seeded_at",
+        # Runners: when the presence heartbeat was last recorded, the availability it returned
+        # and the presence version it was read at
+        "heartbeat_at", "available", "presence_version",
+    )
+
+    def __init__(self, location_id, latitude, longitude, is_runner, seeded_at):
+        self.location_id = location_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.is_runner = is_runner
+        self.seeded_at = seeded_at
+        self.heartbeat_at = float("-inf")
+        self.available = False
+        self.presence_version = None
+
+
+class LocationPingBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # user_id -> Ping, latest only
+        self._state = {}  # user_id -> _UserState
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def state_for(self, user_id):
+        """Cached per-user state, or None when the user must go through the synchronous path
+        (first ping in this process, or the cached role/row is older than LOCATION_PING_RESEED_SECONDS)."""
+        state = self._state.get(user_id)
+        if state is None or time.monotonic() - state.seeded_at > getattr(settings, 'LOCATION_PING_RESEED_SECONDS', 60):
+            return None
+        return state
+
+    def seed(self, location, is_runner):
+        """Record a UserLocation row that was just written synchronously."""
+        with self._lock:
+            self._pending.pop(location.user_id, None)
+            self._state[location.user_id] = _UserState(
+                location.id, location.latitude, location.longitude, is_runner, time.monotonic()
+            )
+
+    def offer(self, user_id, ping, state):
+        """Queue a ping for the user's `state` (from state_for). Returns the previous accepted
+        (lat, lon), or None when the ping was dropped for moving less than LOCATION_PING_MIN_MOVE_M."""
+        min_move_m = getattr(settings, 'LOCATION_PING_MIN_MOVE_M', 10)
+        with self._lock:
+            # A flush may have evicted the state since state_for returned it
+            state = self._state.setdefault(user_id, state)
+            previous = (state.latitude, state.longitude)
+            if distance_between(previous, (ping.latitude, ping.longitude)) < min_move_m:
+                return None
+            state.latitude, state.longitude = ping.latitude, ping.longitude
+            self._pending[user_id] = ping
+        self._ensure_flusher()
+        return previous
+
+    def clear(self):
+        """Forget all pending pings and cached state without writing them."""
+        with self._lock:
+            self._pending.clear()
+            self._state.clear()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write every pending ping with a single bulk_update. Returns the number of rows written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._evict_stale(pending)
+        if not pending:
+            return 0
+
+        try:
+            rows, runner_cells = self._write(pending)
+        except Exception:
+            with self._lock:
+                for user_id, ping in pending.items():
+                    # A ping that arrived during the failed flush is newer: keep it
+                    self._pending.setdefault(user_id, ping)
+            raise
+        if runner_cells:
+            touch_runner_cells(*runner_cells)
+        logger.debug("LocationPingBuffer.flush: wrote %s of %s pings", len(rows), len(pending))
+        return len(rows)
+
+    def _evict_stale(self, pending):
+        # state_for ignores state older than LOCATION_PING_RESEED_SECONDS: drop it so users who
+        # stopped pinging do not stay in memory (the pinged ones are still needed by _write)
+        cutoff = time.monotonic() - getattr(settings, 'LOCATION_PING_RESEED_SECONDS', 60)
+        stale = [user_id for user_id, state in self._state.items() if state.seeded_at < cutoff and user_id not in pending]
+        for user_id in stale:
+            del self._state[user_id]
+
+    def _write(self, pending):
+        now = timezone.now()
+        runner_cells = set()
+        with transaction.atomic():
+            rows = []
+            for location in UserLocation.objects.select_for_update().filter(user_id__in=pending.keys()):
+                ping = pending[location.user_id]
+                if ping.received_at and location.updated_at >= ping.received_at:
+                    continue  # written from a newer ping, by this process or another one
+                state = self._state.get(location.user_id)
+                if state is not None and state.is_runner:
+                    runner_cells.update((location.grid_cell, grid_cell_for(ping.latitude, ping.longitude)))
+                location.mode = ping.mode
+                location.latitude = ping.latitude
+                location.longitude = ping.longitude
+                location.address = ping.address
+                # bulk_update bypasses save(): derive the spatial keys and auto_now field here
+                location.grid_cell = grid_cell_for(ping.latitude, ping.longitude)
+                location.region = region_for(ping.latitude, ping.longitude)
+                location.service_area_id = service_area_for(ping.latitude, ping.longitude)
+                location.updated_at = ping.received_at or now
+                rows.append(location)
+            UserLocation.objects.bulk_update(
+                rows, ["mode", "latitude", "longitude", "address", "grid_cell", "region", "service_area", "updated_at"], batch_size=500
+            )
+        return rows, runner_cells
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run, name="location-ping-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while not self._stop.wait(getattr(settings, 'LOCATION_PING_FLUSH_MS', 1000) / 1000.0):
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception("LocationPingBuffer: flush failed")
+
+    def shutdown(self):
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("LocationPingBuffer: final flush failed")
+
+
+location_buffer = LocationPingBuffer()
+atexit.register(location_buffer.shutdown)
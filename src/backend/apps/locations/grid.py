@@ -0,0 +1,69 @@
+from math import cos, degrees, floor, radians
+
+from django.conf import settings
+
+EARTH_RADIUS_M = 6371000
+
+
+def _cell_size():
+    return float(getattr(settings, 'RUNNER_GRID_CELL_DEG', 0.05))
+
+
+def grid_cell_for(latitude, longitude, cell_deg=None):
+    """Return the fixed-grid cell key ("row:col") containing a (latitude, longitude) point.
+    Cells are `RUNNER_GRID_CELL_DEG` degrees wide in both directions.
+    """
+    size = cell_deg or _cell_size()
+    row = floor(float(latitude) / size)
+    col = floor(float(longitude) / size)
+    return f"{row}:{col}"
+
+
+def region_for(latitude, longitude):
+    """Return the matching region containing a (latitude, longitude) point.
+
+    Regions partition the matching state: runners are only matched to errands of their own region,
+    and each region can get its own index and batch matcher processes. A point inside one of the
+    `REGIONS` boxes (checked in order) belongs to that named region; anywhere else it belongs to a
+    coarse grid cell ("g:row:col") `REGION_CELL_DEG` degrees wide.
+    """
+    lat = float(latitude)
+    lon = float(longitude)
+    for name, (min_lat, min_lon, max_lat, max_lon) in getattr(settings, 'REGIONS', ()):
+        if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+            return name
+    size = float(getattr(settings, 'REGION_CELL_DEG', 1.0))
+    return f"g:{floor(lat / size)}:{floor(lon / size)}"
+
+
+def bounding_box(latitude, longitude, radius_m):
+    """Return (min_lat, max_lat, min_lon, max_lon) of the box enclosing a circle of radius_m meters."""
+    lat = float(latitude)
+    lon = float(longitude)
+    dlat = degrees(radius_m / EARTH_RADIUS_M)
+    # Guard against the poles where a degree of longitude shrinks to nothing
+    dlon = degrees(radius_m / (EARTH_RADIUS_M * max(cos(radians(lat)), 0.01)))
+    return max(lat - dlat, -90.0), min(lat + dlat, 90.0), lon - dlon, lon + dlon
+
+
+def grid_cells_within(latitude, longitude, radius_m, cell_deg=None):
+    """Return the grid cell keys overlapping a circle of radius_m meters around (latitude, longitude).
+
+    Returns None when the circle spans more than `RUNNER_GRID_MAX_CELLS` cells, so callers can
+    fall back to a plain bounding-box filter instead of sending a huge IN clause to the database.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_m)
+    return grid_cells_in_box(min_lat, min_lon, max_lat, max_lon, cell_deg)
+
+
+def grid_cells_in_box(min_lat, min_lon, max_lat, max_lon, cell_deg=None):
+    """Return the grid cell keys overlapping a lat/lon box, or None past `RUNNER_GRID_MAX_CELLS`."""
+    size = cell_deg or _cell_size()
+    rows = range(floor(min_lat / size), floor(max_lat / size) + 1)
+    cols = range(floor(min_lon / size), floor(max_lon / size) + 1)
+
+    max_cells = int(getattr(settings, 'RUNNER_GRID_MAX_CELLS', 400))
+    if len(rows) * len(cols) > max_cells:
+        return None
+
+    return [f"{r}:{c}" for r in rows for c in cols]
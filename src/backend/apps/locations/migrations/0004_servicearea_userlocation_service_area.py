@@ -0,0 +1,33 @@
+# Generated by Django 6.0.1 on 2026-10-17 12:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0003_userlocation_region'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceArea',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('polygon', models.JSONField(help_text='Outer ring as [[latitude, longitude], ...] (at least 3 points)')),
+                ('is_active', models.BooleanField(default=True)),
+                ('min_lat', models.FloatField(default=0)),
+                ('min_lon', models.FloatField(default=0)),
+                ('max_lat', models.FloatField(default=0)),
+                ('max_lon', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userlocation',
+            name='service_area',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='locations.servicearea'),
+        ),
+    ]
@@ -1,5 +1,10 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .grid import grid_cell_for, region_for
+from .service_areas import invalidate_service_areas, retag_locations, service_area_for
 
 User = get_user_model()
 
@@ -7,6 +12,73 @@ class LocationMode(models.TextChoices):
     DEVICE = "DEVICE", "Device"
     STATIC = "STATIC", "Static"
 
+class ServiceArea(models.Model):
+    """A zone we operate in, managed in the admin. Errands must be created inside an active area
+    (see SERVICE_AREA_ENFORCEMENT) and are only matched to runners in the same area."""
+
+    name = models.CharField(max_length=100, unique=True)
+    polygon = models.JSONField(help_text='Outer ring as [[latitude, longitude], ...] (at least 3 points)')
+    is_active = models.BooleanField(default=True)
+
+    # Bounding box of the polygon, kept in sync on save
+    min_lat = models.FloatField(default=0)
+    min_lon = models.FloatField(default=0)
+    max_lat = models.FloatField(default=0)
+    max_lon = models.FloatField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def clean(self):
+        from django.core.exceptions import ValidationError
+
+        try:
+            points = [(float(lat), float(lon)) for lat, lon in self.polygon]
+        except (TypeError, ValueError):
+            raise ValidationError({"polygon": "Expected a list of [latitude, longitude] pairs"})
+        if len(points) < 3:
+            raise ValidationError({"polygon": "A polygon needs at least 3 points"})
+
+    def save(self, *args, **kwargs):
+        lats = [float(p[0]) for p in self.polygon]
+        lons = [float(p[1]) for p in self.polygon]
+        self.min_lat, self.max_lat = min(lats), max(lats)
+        self.min_lon, self.max_lon = min(lons), max(lons)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.name
+
+
+# Every write path (admin, ORM, shell, queryset deletes) reloads the area trees and retags the
+# stored areas of locations in both the old and the new polygon
+@receiver(pre_save, sender=ServiceArea)
+def _remember_previous_area(sender, instance, raw=False, **kwargs):
+    instance._previous = None if raw or instance.pk is None else ServiceArea.objects.filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=ServiceArea)
+def _service_area_saved(sender, instance, raw=False, **kwargs):
+    invalidate_service_areas()
+    if raw:
+        return
+    previous = getattr(instance, "_previous", None)
+    if previous is not None:
+        retag_locations(previous)
+    retag_locations(instance)
+
+
+@receiver(pre_delete, sender=ServiceArea)
+def _remember_tagged_runners(sender, instance, **kwargs):
+    # Deleting the area nulls their stored area before post_delete, so they would look unchanged
+    instance._tagged_runner_ids = list(UserLocation.objects.filter(service_area_id=instance.pk).values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=ServiceArea)
+def _service_area_deleted(sender, instance, **kwargs):
+    invalidate_service_areas()
+    retag_locations(instance, republish=getattr(instance, "_tagged_runner_ids", ()))
+
+
 class UserLocation(models.Model):
     user = models.OneToOneField(
         User,
@@ -23,9 +95,27 @@ class UserLocation(models.Model):
     latitude = models.FloatField()
     longitude = models.FloatField()
 
+    # Fixed-grid cell ("row:col") derived from latitude/longitude; used to prefilter nearby runners
+    grid_cell = models.CharField(max_length=32, blank=True, default="", db_index=True)
+
+    # Matching region (see grid.region_for); runners are only matched within their region
+    region = models.CharField(max_length=32, blank=True, default="", db_index=True)
+    # Service area containing the point (None outside every active area)
+    service_area = models.ForeignKey(ServiceArea, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+
     address = models.TextField(blank=True, null=True)
 
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        # Keep the spatial key in sync with the coordinates on every write path
+        self.grid_cell = grid_cell_for(self.latitude, self.longitude)
+        self.region = region_for(self.latitude, self.longitude)
+        self.service_area_id = service_area_for(self.latitude, self.longitude)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"latitude", "longitude"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "grid_cell", "region", "service_area"}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.user.email} – {self.mode}"
@@ -2,6 +2,7 @@ import graphene
 from graphene_django import DjangoObjectType
 from graphql_jwt.decorators import login_required
 from .models import UserLocation, LocationMode
+from .services import ingest_location_ping
 
 class UserLocationType(DjangoObjectType):
     class Meta:
@@ -22,14 +23,6 @@ class UpdateUserLocation(graphene.Mutation):
     def mutate(self, info, mode, latitude, longitude, address=None):
         user = info.context.user
 
-        location, _ = UserLocation.objects.update_or_create(
-            user=user,
-            defaults={
-                "mode": mode,
-                "latitude": latitude,
-                "longitude": longitude,
-                "address": address or "",
-            },
-        )
+        location = ingest_location_ping(user, mode, latitude, longitude, address or "")
 
         return UpdateUserLocation(location=location)
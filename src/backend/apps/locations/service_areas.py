@@ -0,0 +1,236 @@
+"""In-memory lookup of the service area (zone) containing a point.
+
+Active ServiceArea polygons are loaded once per process into an R-tree of their bounding boxes,
+bulk-loaded with Sort-Tile-Recursive packing. A lookup walks the tree to the few polygons whose
+box contains the point and runs an exact ray-casting point-in-polygon test on those, so it costs
+microseconds and never touches the database.
+
+Saving or deleting a ServiceArea (through the admin, the ORM or the shell) bumps a version token
+in the cache; every process reloads its tree within `SERVICE_AREA_REFRESH_SECONDS` of a change
+(immediately in the process that made it). The same model signals retag the stored service areas
+inside the changed area (`retag_locations`).
+
+With no active area configured every point counts as served, so deployments without zones keep
+working unchanged.
+"""
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "locations:service-areas-version"
+NODE_CAPACITY = 8
+
+
+class RTree:
+    """Static R-tree over (min_lat, min_lon, max_lat, max_lon, item) entries."""
+
+    def __init__(self, entries):
+        level = [(e[0], e[1], e[2], e[3], e[4], None) for e in entries]
+        # Pack each level into parents of NODE_CAPACITY children until one root remains
+        while len(level) > NODE_CAPACITY:
+            level = self._pack(level)
+        self._root = level
+
+    @staticmethod
+    def _pack(nodes):
+        slices = math.ceil(math.sqrt(math.ceil(len(nodes) / NODE_CAPACITY)))
+        per_slice = slices * NODE_CAPACITY
+        nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+        parents = []
+        for i in range(0, len(nodes), per_slice):
+            vertical = sorted(nodes[i:i + per_slice], key=lambda n: n[1] + n[3])
+            for j in range(0, len(vertical), NODE_CAPACITY):
+                children = vertical[j:j + NODE_CAPACITY]
+                parents.append((
+                    min(c[0] for c in children), min(c[1] for c in children),
+                    max(c[2] for c in children), max(c[3] for c in children),
+                    None, children,
+                ))
+        return parents
+
+    def query_point(self, latitude, longitude):
+        """Items whose box contains the point."""
+        found, stack = [], [self._root]
+        while stack:
+            for min_lat, min_lon, max_lat, max_lon, item, children in stack.pop():
+                if min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon:
+                    if children is None:
+                        found.append(item)
+                    else:
+                        stack.append(children)
+        return found
+
+
+def point_in_polygon(latitude, longitude, polygon):
+    """Ray casting on a ring of (lat, lon) vertices; points on an edge may fall either way."""
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        lat1, lon1 = polygon[i]
+        lat2, lon2 = polygon[i - 1]
+        if (lon1 > longitude) != (lon2 > longitude):
+            crossing = lat1 + (longitude - lon1) * (lat2 - lat1) / (lon2 - lon1)
+            if latitude < crossing:
+                inside = not inside
+    return inside
+
+
+class ServiceAreaIndex:
+    def __init__(self, areas):
+        """`areas`: [(id, [(lat, lon), ...]), ...]"""
+        self._polygons = {area_id: polygon for area_id, polygon in areas}
+        self._tree = RTree([
+            (min(p[0] for p in polygon), min(p[1] for p in polygon),
+             max(p[0] for p in polygon), max(p[1] for p in polygon), area_id)
+            for area_id, polygon in areas
+        ])
+
+    def __len__(self):
+        return len(self._polygons)
+
+    def area_for(self, latitude, longitude):
+        """Id of an area containing the point (the lowest id when areas overlap), or None."""
+        hits = [
+            area_id for area_id in self._tree.query_point(latitude, longitude)
+            if point_in_polygon(latitude, longitude, self._polygons[area_id])
+        ]
+        return min(hits) if hits else None
+
+
+def _load_index():
+    from .models import ServiceArea
+
+    areas = [
+        (area_id, [(float(lat), float(lon)) for lat, lon in polygon])
+        for area_id, polygon in ServiceArea.objects.filter(is_active=True).values_list("id", "polygon")
+    ]
+    logger.info("service areas: loaded %s active areas", len(areas))
+    return ServiceAreaIndex(areas)
+
+
+_lock = threading.Lock()
+_state = {"index": None, "version": None, "checked_at": float("-inf")}
+
+
+def get_service_area_index():
+    """The process-wide index, reloaded when the cache version token changed."""
+    now = time.monotonic()
+    if _state["index"] is not None and now - _state["checked_at"] < getattr(settings, 'SERVICE_AREA_REFRESH_SECONDS', 30):
+        return _state["index"]
+    with _lock:
+        version = cache.get(VERSION_KEY)
+        if _state["index"] is None or version != _state["version"]:
+            _state["index"] = _load_index()
+            _state["version"] = version
+        _state["checked_at"] = now
+    return _state["index"]
+
+
+def invalidate_service_areas():
+    cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+    _state["checked_at"] = float("-inf")
+
+
+def has_service_areas():
+    return len(get_service_area_index()) > 0
+
+
+def service_area_for(latitude, longitude):
+    """Id of the active service area containing the point, or None."""
+    if latitude is None or longitude is None:
+        return None
+    return get_service_area_index().area_for(float(latitude), float(longitude))
+
+
+def is_served(latitude, longitude):
+    """True when the point is inside an active area, or when no area is configured at all."""
+    index = get_service_area_index()
+    return not len(index) or index.area_for(float(latitude), float(longitude)) is not None
+
+
+def _box(area, prefix=""):
+    """Q on `<prefix>latitude/longitude` inside `area`'s bounding box or tagged with it; matches
+    everything without an area."""
+    from django.db.models import Q
+
+    if area is None:
+        return Q()
+    box = Q(**{
+        f"{prefix}latitude__range": (area.min_lat, area.max_lat),
+        f"{prefix}longitude__range": (area.min_lon, area.max_lon),
+    })
+    if area.pk is not None:
+        box |= Q(**{f"{prefix}service_area_id": area.pk})
+    return box
+
+
+def _retag(queryset, *fields):
+    """Recompute the stored service area of the rows (loading `fields` too); returns the rows
+    whose area changed."""
+    changed = []
+    for row in queryset.only("id", "latitude", "longitude", "service_area", *fields):
+        area_id = service_area_for(row.latitude, row.longitude)
+        if area_id != row.service_area_id:
+            row.service_area_id = area_id
+            changed.append(row)
+    queryset.model.objects.bulk_update(changed, ["service_area"], batch_size=500)
+    return changed
+
+
+def _reevaluate_out_of_area(area):
+    """Flag pending errands in `area`'s box that are no longer served, and clear (and start
+    matching) flagged ones that now are. Returns (flagged, cleared) counts."""
+    from apps.errands.dispatch import dispatcher
+    from apps.errands.models import Errand
+
+    if getattr(settings, 'SERVICE_AREA_ENFORCEMENT', 'reject') == 'off':
+        return 0, 0
+    rows = Errand.objects.filter(
+        _box(area, "go_to__"), status=Errand.Status.PENDING, is_open=True, go_to__isnull=False
+    ).values_list("id", "out_of_area", "go_to__latitude", "go_to__longitude")
+    flagged, cleared = [], []
+    for errand_id, out_of_area, lat, lon in rows:
+        served = is_served(lat, lon)
+        if out_of_area and served:
+            cleared.append(errand_id)
+        elif not out_of_area and not served:
+            flagged.append(errand_id)
+    Errand.objects.filter(id__in=flagged).update(out_of_area=True)
+    Errand.objects.filter(id__in=cleared).update(out_of_area=False)
+    if getattr(settings, 'ERRAND_MATCHING_MODE', 'per_errand') != 'batch':
+        # The batch matcher picks cleared errands up on its next tick
+        for errand_id in cleared:
+            dispatcher.dispatch(errand_id)
+    return len(flagged), len(cleared)
+
+
+def retag_locations(area=None, republish=()):
+    """Bring stored state up to date after `area` changed (saved or deleted; called from the
+    ServiceArea model signals): the service area of runner locations and pending errands inside
+    its bounding box (or tagged with it), the runners' zone in the runner index, and the
+    out_of_area flag of pending errands. Without an area everything is rechecked, e.g. after a
+    data migration, where model signals do not fire. Runners in `republish` are re-published even
+    if their stored area did not change. Returns the number of locations retagged."""
+    from errand_location.models import ErrandLocation
+    from runners.index import republish_runners
+    from .models import UserLocation
+
+    # 1️⃣ Runner locations, re-published so the index filters them by their new area
+    runners = _retag(UserLocation.objects.filter(_box(area)), "user")
+    republish_runners({row.user_id for row in runners} | set(republish))
+
+    # 2️⃣ Go-to locations of pending errands, and their out-of-area flag
+    errands = _retag(ErrandLocation.objects.filter(_box(area), errands_go_to__status="PENDING").distinct())
+    flagged, cleared = _reevaluate_out_of_area(area)
+
+    logger.info(
+        "retag_locations: retagged %s runner and %s errand locations, flagged %s and cleared %s out-of-area errands for area=%s",
+        len(runners), len(errands), flagged, cleared, getattr(area, "name", None),
+    )
+    return len(runners) + len(errands)
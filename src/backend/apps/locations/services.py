@@ -0,0 +1,108 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.errands.trail import record_trail_point
+from apps.roles.models import Role
+from runners.index import publish_runner
+from runners.presence import is_available, presence_version, record_heartbeat
+from runners.snapshots import note_runner_moved
+
+from .models import LocationMode, UserLocation
+
+logger = logging.getLogger(__name__)
+
+
+def _is_runner(user):
+    profile = getattr(user, "profile", None)
+    return profile is not None and profile.roles.filter(name=Role.RUNNER).exists()
+
+
+def upsert_user_location(user, mode, latitude, longitude, address=None):
+    """Create or update the user's single UserLocation row.
+
+    All location write paths (UpdateUserLocation mutations, CreateErrand's user_location payload)
+    go through here so derived spatial data stays consistent: for runners, the ping doubles as a
+    presence heartbeat, the shared index is updated and nearby-runner snapshots covering the
+    old/new position are invalidated.
+    """
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    with transaction.atomic():
+        location = UserLocation.objects.select_for_update().filter(user=user).first()
+        if location is None:
+            old = None
+            location = UserLocation(user=user)
+        else:
+            old = (location.latitude, location.longitude)
+        location.mode = mode
+        location.latitude = latitude
+        location.longitude = longitude
+        location.address = address
+        location.save()
+
+    is_runner = _is_runner(user)
+    if is_runner:
+        presence = record_heartbeat(user)
+        note_runner_moved(old, (latitude, longitude))
+        if is_available(presence):
+            publish_runner(user, location)
+        record_trail_point(user.id, latitude, longitude)
+    logger.debug("upsert_user_location: user=%s cell=%s created=%s", getattr(user, 'id', None), location.grid_cell, old is None)
+
+    # Local import: the buffer module imports this app's models and the runners services
+    from .buffer import location_buffer
+    location_buffer.seed(location, is_runner)
+    return location
+
+
+def _buffered_heartbeat(user, state):
+    """Record the runner's heartbeat at most every RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS,
+    or sooner when their availability changed. Returns (available, recorded now)."""
+    version = presence_version(user.id)
+    interval = getattr(settings, 'RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS', 15)
+    if version == state.presence_version and time.monotonic() - state.heartbeat_at < interval:
+        return state.available, False
+    state.available = is_available(record_heartbeat(user))
+    state.heartbeat_at = time.monotonic()
+    state.presence_version = version
+    return state.available, True
+
+
+def ingest_location_ping(user, mode, latitude, longitude, address=None):
+    """Entry point for updateUserLocation.
+
+    DEVICE pings are buffered (see buffer.py): no UserLocation read or write happens in the request,
+    tiny moves are dropped, and the row is written by the next bulk flush. For runners the index and
+    the snapshots see the new position immediately. STATIC updates, the first ping of a user in this
+    process and pings after LOCATION_PING_RESEED_SECONDS go through `upsert_user_location`. The
+    runner's presence heartbeat is written at most every RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS.
+
+    Returns the (possibly unsaved) UserLocation holding the submitted position.
+    """
+    from .buffer import Ping, location_buffer
+
+    latitude = float(latitude)
+    longitude = float(longitude)
+    state = location_buffer.state_for(user.id)
+    if mode != LocationMode.DEVICE or state is None or not getattr(settings, 'LOCATION_PING_BUFFER_ENABLED', True):
+        return upsert_user_location(user, mode, latitude, longitude, address)
+
+    previous = location_buffer.offer(user.id, Ping(mode, latitude, longitude, address, timezone.now()), state)
+    if state.is_runner:
+        # Heartbeat even when the ping is dropped: a parked runner is still online
+        available, recorded = _buffered_heartbeat(user, state)
+        if previous is not None:
+            note_runner_moved(previous, (latitude, longitude))
+            record_trail_point(user.id, latitude, longitude)
+        if available and (previous is not None or recorded):
+            # A dropped ping still refreshes the runner's heartbeat in the index, at the position
+            # it already holds
+            position = (latitude, longitude) if previous is not None else (state.latitude, state.longitude)
+            publish_runner(user, UserLocation(user=user, latitude=position[0], longitude=position[1]))
+
+    return UserLocation(id=state.location_id, user=user, mode=mode, latitude=latitude, longitude=longitude, address=address)
@@ -1,3 +1,198 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from apps.errands.models import Errand
+from apps.locations.buffer import Ping, location_buffer
+from apps.locations.grid import grid_cell_for
+from apps.locations.models import LocationMode, ServiceArea, UserLocation
+from apps.locations.service_areas import RTree, invalidate_service_areas, is_served, point_in_polygon
+from apps.locations.services import ingest_location_ping
+from runners.index import RunnerIndex, make_index_server, runner_index
+from runners.presence import set_online
+from runners.services import errand_region, find_nearby_runners
+from runners.snapshots import snapshot_nearby_runners
+from runners.tests import make_errand, make_runner
+
+
+@override_settings(LOCATION_PING_FLUSH_MS=600000)
+class LocationPingBufferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_buffer.clear()
+        self.addCleanup(location_buffer.clear)
+
+    def test_pings_are_coalesced_and_flushed_in_bulk(self):
+        runner = make_runner("r1", 3.8480, 11.5021)
+        errand = make_errand(3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.8480, 11.5021)  # first ping: written synchronously
+        self.assertEqual([m.runner_id for m in snapshot_nearby_runners(errand)], [runner.id])
+
+        # Jitter is dropped; real moves are buffered with only the latest kept
+        with self.assertNumQueries(1):  # the presence heartbeat only
+            ingest_location_ping(runner, LocationMode.DEVICE, 3.84801, 11.50211)
+        with self.assertNumQueries(0):  # heartbeat recorded less than an interval ago
+            ingest_location_ping(runner, LocationMode.DEVICE, 3.84802, 11.50211)
+        self.assertEqual(len(location_buffer), 0)
+        buffered = ingest_location_ping(runner, LocationMode.DEVICE, 3.9000, 11.5021)
+        self.assertEqual(buffered.id, runner.location.id)
+        ingest_location_ping(runner, LocationMode.DEVICE, 4.0511, 9.7679)
+        self.assertEqual(len(location_buffer), 1)
+        self.assertEqual(UserLocation.objects.get(user=runner).latitude, 3.8480)
+
+        self.assertEqual(location_buffer.flush(), 1)
+        location = UserLocation.objects.get(user=runner)
+        self.assertEqual((location.latitude, location.longitude), (4.0511, 9.7679))
+        self.assertEqual(location.grid_cell, grid_cell_for(4.0511, 9.7679))
+        self.assertEqual(snapshot_nearby_runners(errand), [])
+
+    def test_failed_flush_keeps_pings_and_older_pings_do_not_overwrite(self):
+        runner = make_runner("r1", 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.9000, 11.5021)
+        with mock.patch.object(UserLocation.objects, "bulk_update", side_effect=DatabaseError("down")):
+            with self.assertRaises(DatabaseError):
+                location_buffer.flush()
+        self.assertEqual(len(location_buffer), 1)
+
+        # Another process wrote a newer position after this ping was received
+        UserLocation.objects.filter(user=runner).update(latitude=4.0511, longitude=9.7679, updated_at=timezone.now())
+        self.assertEqual(location_buffer.flush(), 0)
+        self.assertEqual(UserLocation.objects.get(user=runner).latitude, 4.0511)
+
+    def test_flush_evicts_state_older_than_the_reseed_age(self):
+        idle = make_runner("idle", 3.8480, 11.5021)
+        moving = make_runner("moving", 3.8490, 11.5021)
+        ingest_location_ping(idle, LocationMode.DEVICE, 3.8480, 11.5021)
+        ingest_location_ping(moving, LocationMode.DEVICE, 3.8490, 11.5021)
+
+        with override_settings(LOCATION_PING_RESEED_SECONDS=0):
+            # Buffered with state just past the reseed age: kept for the flush that writes it
+            location_buffer.offer(moving.id, Ping(LocationMode.DEVICE, 3.9000, 11.5021, None), location_buffer._state[moving.id])
+            self.assertEqual(location_buffer.flush(), 1)
+            self.assertEqual(list(location_buffer._state), [moving.id])
+            location_buffer.flush()
+        self.assertEqual(location_buffer._state, {})
+
+    def test_availability_change_is_seen_before_the_heartbeat_interval(self):
+        runner = make_runner("r1", 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.84801, 11.50211)
+        self.assertTrue(location_buffer.state_for(runner.id).available)
+
+        set_online(runner, False)
+        with self.assertNumQueries(1):
+            ingest_location_ping(runner, LocationMode.DEVICE, 3.84802, 11.50211)
+        self.assertFalse(location_buffer.state_for(runner.id).available)
+
+    def test_static_updates_are_written_immediately(self):
+        runner = make_runner("r1", 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.DEVICE, 3.8480, 11.5021)
+        ingest_location_ping(runner, LocationMode.STATIC, 4.0511, 9.7679)
+        self.assertEqual(len(location_buffer), 0)
+        self.assertEqual(UserLocation.objects.get(user=runner).latitude, 4.0511)
+
+
+# Two adjacent squares over central Yaoundé, split at longitude 11.50
+WEST = [[3.80, 11.45], [3.90, 11.45], [3.90, 11.50], [3.80, 11.50]]
+EAST = [[3.80, 11.50], [3.90, 11.50], [3.90, 11.55], [3.80, 11.55]]
+
+
+class PointInPolygonTests(SimpleTestCase):
+    def test_concave_polygon(self):
+        # U shape: the notch between the arms is outside
+        u_shape = [(0, 0), (0, 3), (3, 3), (3, 2), (1, 2), (1, 1), (3, 1), (3, 0)]
+        self.assertTrue(point_in_polygon(2, 0.5, u_shape))
+        self.assertFalse(point_in_polygon(2, 1.5, u_shape))
+        self.assertTrue(point_in_polygon(2, 2.5, u_shape))
+
+    def test_rtree_returns_boxes_containing_the_point(self):
+        tree = RTree([(i, i, i + 1.5, i + 1.5, i) for i in range(100)])
+        self.assertEqual(sorted(tree.query_point(50.2, 50.2)), [49, 50])
+        self.assertEqual(tree.query_point(-5, -5), [])
+
+
+class ServiceAreaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_service_areas()
+        self.addCleanup(invalidate_service_areas)
+
+    def test_everything_is_served_until_an_area_exists(self):
+        self.assertTrue(is_served(4.0511, 9.7679))
+        ServiceArea.objects.create(name="west", polygon=WEST)
+        self.assertTrue(is_served(3.85, 11.47))
+        self.assertFalse(is_served(4.0511, 9.7679))
+
+    def test_runners_are_matched_within_the_errand_service_area(self):
+        west = ServiceArea.objects.create(name="west", polygon=WEST)
+        east = ServiceArea.objects.create(name="east", polygon=EAST)
+        same_area = make_runner("same_area", 3.8480, 11.4950)
+        other_area = make_runner("other_area", 3.8480, 11.5010)
+        outside = make_runner("outside", 3.7900, 11.4990)
+        errand = make_errand(3.8480, 11.4990)
+        self.assertEqual(errand.go_to.service_area_id, west.id)
+        self.assertEqual(other_area.location.service_area_id, east.id)
+
+        self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [same_area.id])
+        # Out-of-area errands get no candidates at all
+        self.assertEqual(find_nearby_runners(make_errand(3.7900, 11.4990)), [])
+
+        # Growing an area (through the ORM) re-tags the locations it now covers
+        west.polygon = [[3.75, 11.45], [3.90, 11.45], [3.90, 11.50], [3.75, 11.50]]
+        west.save()
+        self.assertEqual(
+            sorted(m.runner_id for m in find_nearby_runners(errand)),
+            sorted([same_area.id, outside.id]),
+        )
+
+    def test_area_changes_retag_the_runner_index_and_out_of_area_errands(self):
+        west = ServiceArea.objects.create(name="west", polygon=WEST)
+        ServiceArea.objects.create(name="east", polygon=EAST)
+        runner = make_runner("outside", 3.7900, 11.4990)
+        set_online(runner, True)
+        errand = make_errand(3.7900, 11.4990)
+        Errand.objects.filter(id=errand.id).update(out_of_area=True)
+
+        index = RunnerIndex()
+        index.upsert(runner.id, 3.7900, 11.4990)  # outside every area
+        address = "unix:" + os.path.join(tempfile.mkdtemp(), "index.sock")
+        server = make_index_server(index, address)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with self.settings(RUNNER_INDEX_ADDRESS=address, SERVICE_AREA_ENFORCEMENT="flag"):
+                west.polygon = [[3.75, 11.45], [3.90, 11.45], [3.90, 11.50], [3.75, 11.50]]
+                with mock.patch("apps.errands.dispatch.dispatcher.dispatch") as dispatch:
+                    west.save()
+                self.assertEqual([m.runner_id for m in index.within(3.7900, 11.4990, 1000, service_area=west.id)], [runner.id])
+                self.assertFalse(Errand.objects.get(id=errand.id).out_of_area)
+                dispatch.assert_called_once_with(errand.id)
+
+                # A queryset delete skips Model.delete but not the signals
+                ServiceArea.objects.filter(id=west.id).delete()
+                self.assertEqual(index.within(3.7900, 11.4990, 1000, service_area=west.id), [])
+                self.assertEqual([m.runner_id for m in index.within(3.7900, 11.4990, 1000)], [runner.id])
+                self.assertTrue(Errand.objects.get(id=errand.id).out_of_area)
+        finally:
+            server.shutdown()
+            server.server_close()
+            runner_index._close()
+
+    def test_index_fills_the_limit_from_the_errand_service_area(self):
+        west = ServiceArea.objects.create(name="west", polygon=WEST)
+        ServiceArea.objects.create(name="east", polygon=EAST)
+        errand = make_errand(3.8480, 11.4995)
+        index = RunnerIndex()
+        # The two closest runners are across the boundary, in the east area
+        index.upsert(1, 3.8480, 11.5001)
+        index.upsert(2, 3.8480, 11.5003)
+        index.upsert(3, 3.8480, 11.4960)
+        index.upsert(4, 3.8480, 11.4950)
+        matches = index.within(3.8480, 11.4995, 5000, limit=2, region=errand_region(errand.go_to), service_area=west.id)
+        self.assertEqual([m.runner_id for m in matches], [3, 4])
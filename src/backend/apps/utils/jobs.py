@@ -0,0 +1,363 @@
+"""Background job queue for matching, expiry and notification work.
+
+Jobs are plain functions registered under a name and queued with their (JSON-serialisable)
+arguments, ids rather than model instances:
+
+    @jobs.job("errands.match")
+    def start_errand_matching(errand_id): ...
+
+    jobs.enqueue("errands.match", errand.id)
+    jobs.enqueue("errands.follow_up", errand.id, delay=60)
+
+Jobs registered with `every=<seconds>` also run periodically, e.g. the errand sweep that expires
+errands and re-offers stalled ones from the database, so work whose delayed job was lost still
+happens:
+
+    @jobs.job("errands.sweep", every=60)
+    def sweep_errands(): ...
+
+Backends (JOB_QUEUE_BACKEND):
+- "threads" (default): JOB_QUEUE_WORKERS threads per process reading a queue bounded at
+  JOB_QUEUE_SIZE jobs. Delayed jobs wait in one scheduler thread, in process memory, up to
+  JOB_QUEUE_DELAYED_SIZE of them; keep delays short (offer follow-ups), since long-lived work such
+  as expiry belongs to the periodic sweep. When either is full, `enqueue` rejects the job
+  (counted in `jobs.rejected`) rather than block or run it in the caller, which is usually a
+  request thread; the periodic jobs pick up the errands it was for. At interpreter exit, queued
+  jobs are drained for up to JOB_QUEUE_DRAIN_SECONDS; delayed jobs are dropped (counted in
+  `jobs.dropped`). The pool starts with the web server
+  (core/wsgi.py, core/asgi.py) or the first job queued; each periodic job runs in one process
+  per interval, claimed in the cache.
+- "celery": jobs go to the Celery broker (CELERY_BROKER_URL, normally Redis) and run on
+  `celery -A core.celery worker` processes. Delayed jobs use the broker's countdown and tasks
+  are acknowledged after they ran, so queued work survives web and worker restarts. Periodic
+  jobs are sent by `celery -A core.celery beat`. Needs celery installed and a real broker;
+  without them the thread pool is used.
+
+Metrics (apps.utils.metrics, shared by all processes): `jobs.enqueued`, `jobs.started`,
+`jobs.failed[.<name>]`, `jobs.rejected`, `jobs.dropped`, and the queue latency (enqueue, or due time for delayed
+jobs, to start) as `jobs.latency_ms.<bucket>` with `.count`/`.sum`. `queue_stats()` reports the
+queue depth from them; `manage.py matching_metrics jobs` prints it.
+"""
+import atexit
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from apps.utils import metrics
+
+try:
+    import celery  # noqa: F401
+except Exception:  # pragma: no cover - optional dependency
+    celery = None
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS_MS = (10, 50, 100, 500, 1000, 5000, 30000)
+
+PERIODIC_CLAIM_KEY = "jobs:periodic:{name}"
+
+_registry = {}
+_periodic = {}
+
+
+def job(name, every=None):
+    """Register the decorated function as the job `name`; with `every`, it also runs every
+    `every` seconds (without arguments)."""
+    def register(fn):
+        _registry[name] = fn
+        if every:
+            _periodic[name] = every
+        return fn
+    return register
+
+
+def _import_job_modules():
+    for module in getattr(settings, 'JOB_MODULES', ['apps.errands.tasks']):
+        import_module(module)
+
+
+def get_job(name):
+    """The function registered as `name`, importing JOB_MODULES on first use (a Celery worker
+    or a fresh process may not have imported the modules that register jobs yet)."""
+    if name not in _registry:
+        _import_job_modules()
+    try:
+        return _registry[name]
+    except KeyError:
+        raise LookupError(f"unknown job {name!r}") from None
+
+
+def periodic_jobs():
+    """{name: interval_seconds} of the periodic jobs in JOB_MODULES."""
+    _import_job_modules()
+    return dict(_periodic)
+
+
+def _record_latency(latency_ms):
+    bucket = next((b for b in LATENCY_BUCKETS_MS if latency_ms <= b), "inf")
+    metrics.incr(f"jobs.latency_ms.{bucket}")
+    metrics.incr("jobs.latency_ms.count")
+    metrics.incr("jobs.latency_ms.sum", int(latency_ms))
+
+
+def claim_periodic(name, every):
+    """Claim this interval's run of the periodic job `name` across processes; counted as enqueued
+    when claimed. False when another process has claimed it already."""
+    if not cache.add(PERIODIC_CLAIM_KEY.format(name=name), 1, timeout=max(1, int(every))):
+        return False
+    metrics.incr("jobs.enqueued")
+    return True
+
+
+def run(name, args, enqueued_at):
+    """Run one job; `enqueued_at` is the wall-clock time it became due. Failures are logged and
+    counted, never raised: a failed job must not kill the worker thread."""
+    metrics.incr("jobs.started")
+    _record_latency(max(0.0, (time.time() - enqueued_at) * 1000))
+    try:
+        get_job(name)(*args)
+    except Exception:
+        logger.exception("jobs.run: job %s%s failed", name, tuple(args))
+        metrics.incr("jobs.failed")
+        metrics.incr(f"jobs.failed.{name}")
+    finally:
+        close_old_connections()
+
+
+# =====================
+# THREAD POOL BACKEND
+# =====================
+
+class ThreadPool:
+    """Bounded in-process queue served by a fixed set of worker threads, started on first use.
+    The scheduler thread also runs the periodic jobs."""
+
+    def __init__(self, workers, size, delayed_size):
+        self.workers = workers
+        self.delayed_size = delayed_size
+        self._queue = queue.Queue(maxsize=size)
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def start(self):
+        periodic = periodic_jobs()
+        with self._cond:
+            if self._threads or self._closed:
+                return
+            for name, every in periodic.items():
+                heapq.heappush(self._delayed, (time.monotonic() + every, next(self._seq), name, (), every))
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"jobs-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            scheduler = threading.Thread(target=self._schedule, name="jobs-scheduler", daemon=True)
+            scheduler.start()
+            self._threads.append(scheduler)
+
+    def submit(self, name, args, delay=0):
+        self.start()
+        if delay > 0:
+            with self._cond:
+                if self._closed:
+                    logger.warning("ThreadPool: shutting down; dropping delayed job %s%s", name, tuple(args))
+                    metrics.incr("jobs.dropped")
+                    return
+                if sum(1 for item in self._delayed if item[4] is None) < self.delayed_size:
+                    heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), name, args, None))
+                    self._cond.notify()
+                    return
+            logger.warning("ThreadPool: %s delayed jobs waiting; rejecting %s%s", self.delayed_size, name, tuple(args))
+            metrics.incr("jobs.rejected")
+            return
+        self._put(name, args, time.time())
+
+    def _put(self, name, args, enqueued_at):
+        if self._closed:
+            logger.warning("ThreadPool: shutting down; dropping job %s%s", name, tuple(args))
+            metrics.incr("jobs.dropped")
+            return
+        try:
+            self._queue.put_nowait((name, args, enqueued_at))
+        except queue.Full:
+            logger.warning("ThreadPool: queue full (%s jobs); rejecting %s%s", self._queue.maxsize, name, tuple(args))
+            metrics.incr("jobs.rejected")
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                run(*item)
+            finally:
+                self._queue.task_done()
+
+    def _schedule(self):
+        with self._cond:
+            while not self._closed:
+                if not self._delayed:
+                    self._cond.wait()
+                    continue
+                wait = self._delayed[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                due, _, name, args, every = heapq.heappop(self._delayed)
+                if every:
+                    heapq.heappush(self._delayed, (due + every, next(self._seq), name, args, every))
+                enqueued_at = time.time() - (time.monotonic() - due)
+                # Put outside the lock: a full queue must not block new delayed submissions
+                self._cond.release()
+                try:
+                    if every is None or claim_periodic(name, every):
+                        self._put(name, args, enqueued_at)
+                except Exception:
+                    logger.exception("ThreadPool: failed queueing periodic job %s", name)
+                finally:
+                    self._cond.acquire()
+
+    def depth(self):
+        """(queued, delayed) jobs in this process, periodic ones not included."""
+        with self._cond:
+            delayed = sum(1 for item in self._delayed if item[4] is None)
+        return self._queue.qsize(), delayed
+
+    def drain(self, timeout=None):
+        """Stop taking jobs, let the workers finish the queued ones for up to `timeout` seconds
+        and stop them. Jobs submitted afterwards run in the caller. Returns True when the queue
+        was emptied in time."""
+        timeout = getattr(settings, 'JOB_QUEUE_DRAIN_SECONDS', 10) if timeout is None else timeout
+        with self._cond:
+            if self._closed:
+                return True
+            self._closed = True
+            dropped = sum(1 for item in self._delayed if item[4] is None)
+            self._delayed = []
+            self._cond.notify_all()
+            workers = [t for t in self._threads if t.name != "jobs-scheduler"]
+        if dropped:
+            logger.warning("ThreadPool: dropped %s delayed jobs on shutdown", dropped)
+            metrics.incr("jobs.dropped", dropped)
+
+        deadline = time.monotonic() + timeout
+        for _ in workers:
+            # Sentinels queue up behind the pending jobs, so each worker stops once they are done
+            try:
+                self._queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in workers:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        drained = not any(t.is_alive() for t in workers)
+        # Sentinels (at most one per worker) are not jobs
+        abandoned = sum(1 for item in list(self._queue.queue) if item is not None)
+        if abandoned:
+            logger.warning("ThreadPool: %s jobs still queued after %ss; abandoning them", abandoned, timeout)
+            metrics.incr("jobs.dropped", abandoned)
+        return drained
+
+
+# =====================
+# CELERY BACKEND
+# =====================
+
+class CeleryQueue:
+    """Sends jobs to the `jobs.run` Celery task (core/celery.py)."""
+
+    def submit(self, name, args, delay=0):
+        from core.celery import run_job
+
+        run_job.apply_async(args=(name, list(args), time.time() + delay), countdown=delay or None)
+
+    def start(self):
+        pass
+
+    def depth(self):
+        return None, None
+
+    def drain(self, timeout=None):
+        return True
+
+
+_lock = threading.Lock()
+_state = {"backend": None}
+
+
+def get_queue():
+    """The process's job queue, created from the settings on first use."""
+    if _state["backend"] is None:
+        with _lock:
+            if _state["backend"] is None:
+                backend = getattr(settings, 'JOB_QUEUE_BACKEND', 'threads')
+                if backend == 'celery' and celery is None:
+                    logger.warning("get_queue: JOB_QUEUE_BACKEND=celery but celery is not installed; using the thread pool")
+                    backend = 'threads'
+                elif backend == 'celery' and getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+                    # Eager Celery (memory broker) would run delayed jobs straight away
+                    logger.info("get_queue: Celery runs eagerly with the memory broker; using the thread pool")
+                    backend = 'threads'
+                if backend == 'celery':
+                    _state["backend"] = CeleryQueue()
+                else:
+                    pool = ThreadPool(
+                        workers=getattr(settings, 'JOB_QUEUE_WORKERS', 8),
+                        size=getattr(settings, 'JOB_QUEUE_SIZE', 256),
+                        delayed_size=getattr(settings, 'JOB_QUEUE_DELAYED_SIZE', 10000),
+                    )
+                    atexit.register(pool.drain)
+                    _state["backend"] = pool
+    return _state["backend"]
+
+
+def reset_queue():
+    """Drain and forget the process's job queue (tests, or after changing the settings)."""
+    with _lock:
+        backend, _state["backend"] = _state["backend"], None
+    if backend is not None:
+        backend.drain(timeout=0)
+
+
+def enqueue(name, *args, delay=0):
+    """Queue the job `name` with `args`, to start after `delay` seconds. Never blocks on a full
+    thread pool: the job is rejected (see the module docstring)."""
+    get_job(name)
+    metrics.incr("jobs.enqueued")
+    get_queue().submit(name, args, delay)
+
+
+def start():
+    """Start the process's job queue and its periodic jobs now rather than with the first job."""
+    get_queue().start()
+
+
+def queue_stats():
+    """Queue depth and latency: `depth` counts jobs enqueued but neither started, rejected nor
+    dropped yet in every process (delayed ones included); `local_queued`/`local_delayed` are this process's
+    thread pool."""
+    counters = metrics.snapshot("jobs.")
+    count = counters.get("jobs.latency_ms.count", 0)
+    local_queued, local_delayed = get_queue().depth()
+    return {
+        "backend": type(get_queue()).__name__,
+        "depth": (
+            counters.get("jobs.enqueued", 0) - counters.get("jobs.started", 0)
+            - counters.get("jobs.rejected", 0) - counters.get("jobs.dropped", 0)
+        ),
+        "local_queued": local_queued,
+        "local_delayed": local_delayed,
+        "mean_latency_ms": counters.get("jobs.latency_ms.sum", 0) / count if count else None,
+        "failed": counters.get("jobs.failed", 0),
+        "rejected": counters.get("jobs.rejected", 0),
+        "dropped": counters.get("jobs.dropped", 0),
+    }
@@ -0,0 +1,69 @@
+"""Process-shared counters kept in the Django cache (shared by all workers when REDIS_CACHE_URL is set).
+
+    metrics.incr("errand_offers.sent", 5)
+    metrics.observe("errand_offer_waves.accepted", 2)   # histogram bucket + count/sum
+    metrics.snapshot("errand_offer_waves")              # {"errand_offer_waves.accepted.2": 1, ...}
+
+Counters never expire; they are operational signals, not billing data, so a lost increment under
+a cache eviction is acceptable.
+"""
+import logging
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+METRIC_KEY = "metrics:{name}"
+# Counter names are listed in numbered slots so that registering one only takes atomic cache
+# operations (add, incr) on every backend: a name claims its registration key once, then the
+# next slot number
+METRIC_REGISTERED_KEY = "metrics:registered:{name}"
+METRIC_NAME_SLOT_KEY = "metrics:names:{slot}"
+METRIC_NAME_SLOTS_KEY = "metrics:names:count"
+
+
+def _register(name):
+    """Add `name` to the names listed by `snapshot`, once across all processes."""
+    if not cache.add(METRIC_REGISTERED_KEY.format(name=name), 1, timeout=None):
+        return
+    cache.add(METRIC_NAME_SLOTS_KEY, 0, timeout=None)
+    slot = cache.incr(METRIC_NAME_SLOTS_KEY)
+    cache.set(METRIC_NAME_SLOT_KEY.format(slot=slot), name, timeout=None)
+
+
+def _names():
+    slots = cache.get(METRIC_NAME_SLOTS_KEY) or 0
+    # A slot claimed but not written yet is listed on the next snapshot
+    return set(cache.get_many([METRIC_NAME_SLOT_KEY.format(slot=i) for i in range(1, slots + 1)]).values())
+
+
+def incr(name, value=1):
+    """Add `value` to the counter `name`. Never raises: metrics must not break the caller."""
+    key = METRIC_KEY.format(name=name)
+    try:
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            if not cache.add(key, value, timeout=None):
+                cache.incr(key, value)
+            _register(name)
+    except Exception:
+        logger.exception("metrics.incr failed for %s", name)
+
+
+def observe(name, value):
+    """Record an integer observation: one counter per value plus .count and .sum for the mean."""
+    incr(f"{name}.{int(value)}")
+    incr(f"{name}.count")
+    incr(f"{name}.sum", int(value))
+
+
+def get(name):
+    return cache.get(METRIC_KEY.format(name=name)) or 0
+
+
+def snapshot(prefix=""):
+    """All counters whose name starts with `prefix`, sorted by name."""
+    names = sorted(n for n in _names() if n.startswith(prefix))
+    values = cache.get_many([METRIC_KEY.format(name=n) for n in names])
+    return {n: values.get(METRIC_KEY.format(name=n), 0) for n in names}
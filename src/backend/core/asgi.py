@@ -13,3 +13,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# Start the job queue with the server so its periodic jobs (the errand sweep) run before the
+# first job is queued
+from apps.utils import jobs  # noqa: E402
+
+jobs.start()
@@ -0,0 +1,41 @@
+"""Celery app for the "celery" job queue backend (apps/utils/jobs.py).
+
+Run workers with `celery -A core.celery worker` and one `celery -A core.celery beat` for the
+periodic jobs. It is not imported from core/__init__.py, so web processes only load Celery when
+they queue their first job.
+"""
+import os
+import time
+
+from celery import Celery, signals
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+app = Celery('core')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+
+@app.task(name="jobs.run", acks_late=True)
+def run_job(name, args, enqueued_at):
+    from apps.utils.jobs import run
+
+    run(name, args, enqueued_at)
+
+
+@app.task(name="jobs.run_periodic")
+def run_periodic_job(name):
+    from apps.utils.jobs import claim_periodic, periodic_jobs, run
+
+    # Beat sends one per interval; the claim also keeps a second beat from doubling the runs
+    if claim_periodic(name, periodic_jobs()[name]):
+        run(name, [], time.time())
+
+
+@signals.import_modules.connect
+def schedule_periodic_jobs(sender=None, **kwargs):
+    # Sent at worker and beat start-up after the Django fixup ran django.setup(), and before beat
+    # reads its schedule
+    from apps.utils.jobs import periodic_jobs
+
+    for name, every in periodic_jobs().items():
+        app.add_periodic_task(every, run_periodic_job.s(name), name=name)
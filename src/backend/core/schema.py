@@ -5,13 +5,17 @@ from django.contrib.auth import get_user_model
 from graphene_django import DjangoObjectType
 from graphql import GraphQLError
 from graphql_jwt.decorators import login_required
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 from apps.errands.models import ErrandTask, ErrandOffer
 
 from apps.errands.models import Errand
+from apps.locations.grid import grid_cell_for
 from apps.locations.models import UserLocation, LocationMode
+from apps.locations.service_areas import is_served
+from apps.locations.services import ingest_location_ping, upsert_user_location
 from apps.roles.models import Role
 from apps.users.models import UserProfile
 from apps.users.services import (
@@ -22,8 +26,13 @@ from apps.users.services import (
 )
 from errand_location.models import ErrandLocation
 from apps.errands.schema import UploadImage
-from runners.services import get_nearby_runners, distance_between
-from apps.errands.services import accept_offer as services_accept_offer
+from runners.density import runner_density
+from runners.index import publish_runner
+from runners.offer_caps import release_offer
+from runners.snapshots import note_runner_moved, snapshot_nearby_runners
+from runners.presence import errand_finished, record_heartbeat, set_online
+from apps.errands.services import accept_offer as services_accept_offer, open_errands_near
+from apps.errands.trail import discard_trail, finish_trail, trail_since
 from apps.trust.models import Rating
 from apps.trust.services import recalculate_trust_score
 
@@ -57,6 +66,12 @@ class RunnerType(graphene.ObjectType):
         return getattr(profile, 'avatar', None) if profile else None
 
 
+class RunnerClusterType(graphene.ObjectType):
+    count = graphene.Int()
+    latitude = graphene.Float()
+    longitude = graphene.Float()
+
+
 class RoleType(DjangoObjectType):
     class Meta:
         model = Role
@@ -142,6 +157,12 @@ class ErrandTaskType(DjangoObjectType):
         model = ErrandTask
         fields = ("id", "description", "price")
 
+class TrailPointType(graphene.ObjectType):
+    timestamp = graphene.DateTime()
+    latitude = graphene.Float()
+    longitude = graphene.Float()
+
+
 class ErrandStatusType(graphene.ObjectType):
     errand_id = graphene.ID()
     status = graphene.String()
@@ -180,6 +201,14 @@ class ErrandType(DjangoObjectType):
     distanceFee = graphene.Int()
     totalPrice = graphene.Int()
 
+    # Runner path while in progress (and after completion); pass the last timestamp seen to get only new points
+    trail = graphene.List(TrailPointType, since=graphene.DateTime())
+
+    # Distance from the searched point (openErrandsNear only)
+    distanceM = graphene.Float()
+    # Saved outside every service area (SERVICE_AREA_ENFORCEMENT = "flag"); never matched
+    outOfArea = graphene.Boolean()
+
     class Meta:
         model = Errand
         fields = (
@@ -198,6 +227,12 @@ class ErrandType(DjangoObjectType):
     def resolve_go_to(self, info):
         return getattr(self, "go_to", None)
 
+    def resolve_distanceM(self, info):
+        return getattr(self, "distance_m", None)
+
+    def resolve_outOfArea(self, info):
+        return self.out_of_area
+
     def resolve_return_to(self, info):
         return getattr(self, "return_to", None)
 
@@ -289,6 +324,40 @@ class ErrandType(DjangoObjectType):
     def resolve_expiresAt(self, info):
         return getattr(self, "expires_at", None)
 
+    # --------------------
+    # Live tracking
+    # --------------------
+    def resolve_trail(self, info, since=None):
+        # Only the requester and the assigned runner may see the runner's path
+        user = getattr(info.context, 'user', None)
+        if user is None or user.id not in (self.user_id, self.runner_id):
+            return None
+        return [
+            TrailPointType(timestamp=ts, latitude=lat, longitude=lon)
+            for ts, lat, lon in trail_since(self, since)
+        ]
+
+
+
+def _check_service_area(go_to_data, user):
+    """Point-in-polygon check of an errand's go_to payload against the service areas. Raises in
+    "reject" mode; returns True when the errand must be flagged as out of area."""
+    enforcement = getattr(settings, 'SERVICE_AREA_ENFORCEMENT', 'reject')
+    if enforcement == 'off' or not isinstance(go_to_data, dict):
+        return False
+    latitude = go_to_data.get("latitude") or go_to_data.get("lat")
+    longitude = go_to_data.get("longitude") or go_to_data.get("lng")
+    try:
+        served = is_served(latitude, longitude)
+    except (TypeError, ValueError):
+        # Malformed coordinates are reported where the location is created
+        return False
+    if served:
+        return False
+    logger.info("Errand go_to (%s, %s) of user=%s is outside every service area (%s)", latitude, longitude, getattr(user, 'id', None), enforcement)
+    if enforcement == 'reject':
+        raise GraphQLError("We do not operate in this area yet")
+    return True
 
 
 class SaveErrandDraft(graphene.Mutation):
@@ -308,6 +377,8 @@ class SaveErrandDraft(graphene.Mutation):
         user = info.context.user
         errand_id = data.get("id")
 
+        out_of_area = _check_service_area(data.get("go_to"), user) if data.get("go_to") else None
+
         if errand_id:
             errand = Errand.objects.get(id=errand_id, user=user)
         else:
@@ -320,6 +391,8 @@ class SaveErrandDraft(graphene.Mutation):
         for field in ["type", "speed", "payment_method"]:
             if data.get(field) is not None:
                 setattr(errand, field, data[field])
+        if out_of_area is not None:
+            errand.out_of_area = out_of_area
 
         errand.save()
 
@@ -422,16 +495,8 @@ class UpdateUserLocation(graphene.Mutation):
     def mutate(self, info, mode, latitude, longitude, address=None):
         user = info.context.user
 
-        # Upsert user's current location (UserLocation is OneToOne)
-        location, _ = UserLocation.objects.update_or_create(
-            user=user,
-            defaults={
-                "mode": mode,
-                "latitude": latitude,
-                "longitude": longitude,
-                "address": address,
-            },
-        )
+        # Upsert user's current location (UserLocation is OneToOne); frequent DEVICE pings are buffered
+        location = ingest_location_ping(user, mode, latitude, longitude, address)
 
         return UpdateUserLocation(location=location)
 
@@ -448,10 +513,34 @@ class BecomeRunner(graphene.Mutation):
         runner_role = Role.objects.get(name=Role.RUNNER)
 
         profile.roles.add(runner_role)
+        record_heartbeat(user)
+
+        location = getattr(user, 'location', None)
+        if location is not None:
+            note_runner_moved(None, (location.latitude, location.longitude))
+            publish_runner(user, location)
 
         return BecomeRunner(ok=True)
 
 
+class SetRunnerOnline(graphene.Mutation):
+    """Runner goes on or off duty. Offline runners receive no offers until they come back online."""
+    ok = graphene.Boolean()
+    online = graphene.Boolean()
+
+    class Arguments:
+        online = graphene.Boolean(required=True)
+
+    @login_required
+    def mutate(self, info, online):
+        user = info.context.user
+        profile = getattr(user, 'profile', None)
+        if profile is None or not profile.roles.filter(name=Role.RUNNER).exists():
+            raise GraphQLError("Only runners can go on duty")
+        set_online(user, online)
+        return SetRunnerOnline(ok=True, online=online)
+
+
 class RunnerCandidate(graphene.ObjectType):
     id = graphene.ID()
     name = graphene.String()
@@ -472,14 +561,36 @@ class ErrandOfferType(graphene.ObjectType):
     expiresIn = graphene.Int()
     errand = graphene.Field(ErrandType)
 
+    # Quote stored on the offer when it was made; accepting charges exactly this
+    distanceM = graphene.Float()
+    distanceFee = graphene.Int()
+    serviceFee = graphene.Int()
+    totalPrice = graphene.Int()
+
     def resolve_id(self, info):
         return str(self.id)
 
+    def resolve_distanceM(self, info):
+        return getattr(self, 'distance_m', None)
+
+    def resolve_distanceFee(self, info):
+        return getattr(self, 'quoted_distance_fee', None)
+
+    def resolve_serviceFee(self, info):
+        return getattr(self, 'quoted_service_fee', None)
+
+    def resolve_totalPrice(self, info):
+        return getattr(self, 'quoted_total_price', None)
+
     def resolve_errandId(self, info):
         return getattr(self.errand, 'id', None)
 
     def resolve_price(self, info):
-        # Price shown in offers is the errand's base value (frontend expects a numeric field)
+        # Price shown in offers is the errand's base value (frontend expects a numeric field),
+        # as quoted when the offer was made; older offers without a quote fall back to the tasks
+        quoted = getattr(self, 'quoted_errand_value', None)
+        if quoted is not None:
+            return quoted
         try:
             return int(self.errand.errand_value())
         except Exception:
@@ -536,8 +647,8 @@ class AcceptErrandOffer(graphene.Mutation):
                 offer.responded_at = timezone.now()
                 offer.save(update_fields=["status", "responded_at"])
 
-                # 4. Update Errand State via Service
-                services_accept_offer(offer.errand, user)
+                # 4. Update Errand State via Service, at the price quoted in the offer
+                services_accept_offer(offer.errand, user, offer=offer)
 
                 # Refresh from DB to get the updated status/runner info
                 offer.errand.refresh_from_db()
@@ -598,6 +709,7 @@ class RejectErrandOffer(graphene.Mutation):
         offer.responded_at = timezone.now()
         offer.save(update_fields=['status', 'responded_at'])
 
+        release_offer(user.id, offer.errand_id)
         logger.info("Offer %s marked REJECTED by runner %s", offer_id, getattr(user, 'id', None))
 
         # No further side effects here; matching continues for other runners via polling.
@@ -657,15 +769,7 @@ class CreateErrand(graphene.Mutation):
                         mode_to_save = ul_mode if ul_mode in (LocationMode.DEVICE, LocationMode.STATIC) else (getattr(getattr(user, 'location', None), 'mode', LocationMode.STATIC))
 
                         # Upsert the user's UserLocation row
-                        UserLocation.objects.update_or_create(
-                            user=user,
-                            defaults={
-                                'mode': mode_to_save,
-                                'latitude': float(ul_lat),
-                                'longitude': float(ul_lon),
-                                'address': ul_address,
-                            }
-                        )
+                        upsert_user_location(user, mode_to_save, ul_lat, ul_lon, ul_address)
                         logger.info("UserLocation upserted for user=%s mode=%s lat=%s lon=%s", getattr(user, 'id', None), mode_to_save, ul_lat, ul_lon)
                 except Exception as e:
                     logger.exception("Failed to upsert UserLocation for user=%s: %s", getattr(user, 'id', None), e)
@@ -673,6 +777,9 @@ class CreateErrand(graphene.Mutation):
             user_location = getattr(user, "location", None)
             mode = user_location.mode if user_location else LocationMode.STATIC
 
+            # 0️⃣ Service area check before anything touches the runner pool
+            out_of_area = _check_service_area(kwargs.get("go_to"), user)
+
             # 1️⃣ Create Errand (NO instructions anymore)
             try:
                 errand = Errand.objects.create(
@@ -681,7 +788,8 @@ class CreateErrand(graphene.Mutation):
                     speed=kwargs["speed"],
                     payment_method=kwargs.get("payment_method"),
                     image_url=kwargs.get("image_url"),
-                    expires_at=timezone.now() + timedelta(hours=2),
+                    expires_at=timezone.now() + timedelta(seconds=getattr(settings, 'ERRAND_LIFETIME_SECONDS', 7200)),
+                    out_of_area=out_of_area,
                 )
                 logger.info("Errand created id=%s user=%s type=%s", errand.id, getattr(user, 'id', None), kwargs.get("type"))
             except Exception as e:
@@ -756,37 +864,51 @@ class CreateErrand(graphene.Mutation):
             errand.save(update_fields=["go_to", "return_to"])
             logger.debug("Errand %s saved with locations", errand.id)
 
+            if errand.out_of_area:
+                logger.info("CreateErrand: errand=%s is outside every service area; not matching", errand.id)
+                return CreateErrand(errand_id=errand.id, runners=[])
+
             # 6️⃣ Compute nearby runners and return them immediately to frontend
             try:
-                candidates = get_nearby_runners(errand)
+                # Distances come from the errand's nearby-runner snapshot; users are only
+                # loaded for their display names.
+                candidates = snapshot_nearby_runners(errand)
                 logger.info("Found %s candidate runners for errand=%s", len(candidates), errand.id)
+                users_by_id = User.objects.select_related('profile').in_bulk([m.runner_id for m in candidates])
                 runners_payload = []
-                for r in candidates:
-                    dist = distance_between(getattr(r, 'location', None), go_to_loc)
+                for match in candidates:
+                    r = users_by_id.get(match.runner_id)
+                    if r is None:
+                        continue
                     profile = getattr(r, 'profile', None)
                     runners_payload.append(RunnerCandidate(
                         id=str(r.id),
                         name=(getattr(profile, 'name', None) or f"{getattr(r, 'first_name', '')} {getattr(r, 'last_name', '')}".strip()),
-                        latitude=getattr(r.location, 'latitude', None),
-                        longitude=getattr(r.location, 'longitude', None),
-                        trust_score=getattr(profile, 'trust_score', None),
-                        distance_m=float(dist or 0.0),
+                        latitude=match.latitude,
+                        longitude=match.longitude,
+                        trust_score=match.trust_score,
+                        distance_m=float(match.distance_m),
                     ))
-                    logger.debug("Candidate runner %s: distance_m=%s trust=%s", getattr(r, 'id', None), dist, getattr(profile, 'trust_score', None))
+                    logger.debug("Candidate runner %s: distance_m=%s trust=%s", match.runner_id, match.distance_m, match.trust_score)
             except Exception as ex:
                 logger.exception("Error computing nearby runners for errand=%s: %s", errand.id, ex)
                 runners_payload = []
 
             # 7️⃣ Start matching process (async)
-            from apps.errands.tasks import start_errand_matching
-
-            # Run matching in a background thread so the HTTP response returns fast.
-            import threading
-            try:
-                logger.info("Starting start_errand_matching in background thread for errand=%s", errand.id)
-                threading.Thread(target=lambda: start_errand_matching(errand.id), daemon=True).start()
-            except Exception as e:
-                logger.exception("Failed to start background thread for start_errand_matching errand=%s: %s", errand.id, e)
+            from apps.errands.dispatch import dispatcher
+
+            # Hand matching to the worker owning the errand's grid cell (or this process's job
+            # queue, see apps/utils/jobs.py) so the HTTP response returns fast.
+            # In batch mode the batch matcher picks the errand up on its next tick.
+            if getattr(settings, 'ERRAND_MATCHING_MODE', 'per_errand') == 'batch':
+                logger.info("CreateErrand: errand=%s left for the batch matcher", errand.id)
+            else:
+                try:
+                    cell = grid_cell_for(errand.go_to.latitude, errand.go_to.longitude)
+                    worker = dispatcher.dispatch(errand.id, cell)
+                    logger.info("CreateErrand: matching for errand=%s dispatched to worker=%s", errand.id, worker or "local")
+                except Exception as e:
+                    logger.exception("Failed to dispatch start_errand_matching errand=%s: %s", errand.id, e)
 
             logger.info("CreateErrand completed for errand=%s responding with %s candidates", errand.id, len(runners_payload))
             return CreateErrand(errand_id=errand.id, runners=runners_payload)
@@ -871,6 +993,8 @@ class UpdateErrand(graphene.Mutation):
         if errand.user != info.context.user:
             raise GraphQLError("Not permitted")
 
+        was_in_progress = errand.status == Errand.Status.IN_PROGRESS
+
         # Update scalar fields
         for field in [
             "type",
@@ -886,6 +1010,11 @@ class UpdateErrand(graphene.Mutation):
 
         errand.save()
 
+        # Completion / cancellation frees the runner for new offers
+        if was_in_progress and errand.status != Errand.Status.IN_PROGRESS:
+            errand_finished(errand.runner)
+            finish_trail(errand)
+
         # 🔁 Replace tasks if provided
         if updates.get("tasks") is not None:
             errand.tasks.all().delete()
@@ -923,7 +1052,10 @@ class DeleteErrand(graphene.Mutation):
         if errand.user != info.context.user:
             raise GraphQLError("Not permitted")
 
+        runner = errand.runner if errand.status == Errand.Status.IN_PROGRESS else None
+        discard_trail(errand)
         errand.delete()
+        errand_finished(runner)
         return DeleteErrand(ok=True)
 
 # =====================
@@ -992,6 +1124,23 @@ class Query(graphene.ObjectType):
     assigned_errands = graphene.List(ErrandType, name='assignedErrands')
     my_runs = graphene.List(ErrandType, name='myRuns')
     errand = graphene.Field(ErrandType, id=graphene.ID(required=True))
+    # Open errands around a point, closest first; page with first/offset
+    open_errands_near = graphene.List(
+        ErrandType,
+        lat=graphene.Float(required=True),
+        lon=graphene.Float(required=True),
+        radius_m=graphene.Float(name='radiusM'),
+        first=graphene.Int(),
+        offset=graphene.Int(),
+        name='openErrandsNear',
+    )
+    # Runner clusters (count + centroid) for the buyer map; bbox is [minLat, minLon, maxLat, maxLon]
+    runner_density = graphene.List(
+        RunnerClusterType,
+        bbox=graphene.List(graphene.Float, required=True),
+        zoom=graphene.Int(required=True),
+        name='runnerDensity',
+    )
 
     @login_required
     def resolve_my_errands(self, info, **kwargs):
@@ -1001,6 +1150,8 @@ class Query(graphene.ObjectType):
     @login_required
     def resolve_my_pending_offers(self, info, **kwargs):
         user = info.context.user
+        # Runners poll for offers while the app is open: count it as a presence heartbeat
+        record_heartbeat(user)
         now = timezone.now()
         qs = ErrandOffer.objects.select_related('errand').filter(
             runner=user,
@@ -1013,6 +1164,25 @@ class Query(graphene.ObjectType):
             logger.debug("PendingOffer id=%s errand=%s expires_at=%s", getattr(of, 'id', None), getattr(getattr(of, 'errand', None), 'id', None), getattr(of, 'expires_at', None))
         return qs
 
+    @login_required
+    def resolve_open_errands_near(self, info, lat, lon, radius_m=None, first=None, offset=None):
+        user = info.context.user
+        max_radius_m = getattr(settings, 'OPEN_ERRANDS_MAX_RADIUS_M', 20000)
+        radius_m = min(radius_m or getattr(settings, 'RUNNER_SEARCH_RADIUS_M', 10000), max_radius_m)
+        first = max(1, min(first or 20, getattr(settings, 'OPEN_ERRANDS_PAGE_MAX', 100)))
+        offset = max(offset or 0, 0)
+        errands = open_errands_near(lat, lon, radius_m, limit=first, offset=offset, exclude_user=user)
+        logger.info("resolve_open_errands_near: user=%s radius_m=%s offset=%s found=%s", getattr(user, 'id', None), radius_m, offset, len(errands))
+        return errands
+
+    @login_required
+    def resolve_runner_density(self, info, bbox, zoom):
+        if len(bbox) != 4:
+            raise GraphQLError("bbox must be [minLat, minLon, maxLat, maxLon]")
+        zoom, clusters = runner_density(*bbox, zoom)
+        logger.info("resolve_runner_density: user=%s zoom=%s clusters=%s", getattr(info.context.user, 'id', None), zoom, len(clusters))
+        return clusters
+
     # Resolver helper: errands assigned to current authenticated runner
     def _resolve_assigned_for_runner(self, info):
         user = info.context.user
@@ -1081,17 +1251,15 @@ class Query(graphene.ObjectType):
         if errand.status == Errand.Status.PENDING and errand.is_open:
             nearby_list = []
             try:
-                candidates = get_nearby_runners(errand)[:10]
+                # Only ids, coordinates and distances are needed here: skip hydrating User objects
+                candidates = snapshot_nearby_runners(errand, limit=10)
                 logger.info("resolve_errand_status: found %s nearby candidates for errand=%s", len(candidates), errand.id)
-                for runner in candidates:
-                    runner_loc = getattr(runner, 'location', None)
-                    if not runner_loc:
-                        continue
+                for match in candidates:
                     nearby_list.append(RunnerType(
-                        id=runner.id,
-                        latitude=float(runner_loc.latitude),
-                        longitude=float(runner_loc.longitude),
-                        distance_m=distance_between(runner_loc, errand.go_to)
+                        id=match.runner_id,
+                        latitude=float(match.latitude),
+                        longitude=float(match.longitude),
+                        distance_m=match.distance_m,
                     ))
                 result.nearby_runners = nearby_list
             except Exception:
@@ -1128,6 +1296,7 @@ class Mutation(graphene.ObjectType):
     # User
     update_user_location = UpdateUserLocation.Field()
     become_runner = BecomeRunner.Field()
+    set_runner_online = SetRunnerOnline.Field()
 
     # Errands
     create_errand = CreateErrand.Field()
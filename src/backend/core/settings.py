@@ -62,6 +62,7 @@ INSTALLED_APPS = [
     'apps.roles.apps.RolesConfig',
     'apps.trust.apps.TrustConfig',
     'errand_location',
+    'runners',
     'storages',
 ]
 
@@ -203,6 +204,190 @@ STORAGE_MODE = os.getenv('STORAGE_MODE', 'dev' if DEBUG else 'prod')
 # Errand configuration
 # -------------------------------------------------------------------
 ERRAND_TTL_MINUTES = int(os.getenv('ERRAND_TTL_MINUTES', '30'))
+# How long a runner has to answer an offer before it expires
+ERRAND_OFFER_TTL_SECONDS = int(os.getenv('ERRAND_OFFER_TTL_SECONDS', '60'))
+# How long a new errand stays open for runners before it expires
+ERRAND_LIFETIME_SECONDS = int(os.getenv('ERRAND_LIFETIME_SECONDS', '7200'))
+# Matching lease per errand (apps/errands/leases.py): 'cache' (needs the shared Redis cache),
+# 'db' (MatchingLease rows) or 'auto' (cache when REDIS_CACHE_URL is set, else db). A crashed
+# holder blocks the errand's matching for at most the TTL.
+ERRAND_LEASE_BACKEND = os.getenv('ERRAND_LEASE_BACKEND', 'auto')
+ERRAND_LEASE_TTL_SECONDS = int(os.getenv('ERRAND_LEASE_TTL_SECONDS', '30'))
+# Live runner trail per in-progress errand: ring buffer size (points) and cache lifetime
+ERRAND_TRAIL_SIZE = int(os.getenv('ERRAND_TRAIL_SIZE', '512'))
+ERRAND_TRAIL_TTL_SECONDS = int(os.getenv('ERRAND_TRAIL_TTL_SECONDS', '86400'))
+# Offer waves for a new errand, as "radius_m:size" rings: the closest `size` runners within
+# `radius_m` get an offer, and if nobody accepts within ERRAND_OFFER_TTL_SECONDS the next ring is
+# tried, until the rings run out or the errand expires
+ERRAND_OFFER_WAVES = [
+    tuple(int(part) for part in wave.split(':'))
+    for wave in os.getenv('ERRAND_OFFER_WAVES', '1500:3,4000:5,10000:10').split(',')
+    if wave.strip()
+]
+# 'per_errand': each new errand is offered to its closest runners on creation.
+# 'batch': `manage.py run_batch_matcher` assigns all pending errands to runners every interval,
+# one targeted offer per errand (see apps/errands/matching.py)
+ERRAND_MATCHING_MODE = os.getenv('ERRAND_MATCHING_MODE', 'per_errand')
+ERRAND_BATCH_INTERVAL_SECONDS = float(os.getenv('ERRAND_BATCH_INTERVAL_SECONDS', '5'))
+# 'greedy' (scales to thousands x thousands) or 'hungarian' (optimal, needs SciPy, smaller markets)
+ERRAND_BATCH_SOLVER = os.getenv('ERRAND_BATCH_SOLVER', 'greedy')
+# Cheapest runners kept per errand by the greedy solver
+ERRAND_BATCH_CANDIDATES = int(os.getenv('ERRAND_BATCH_CANDIDATES', '20'))
+# Cost weights: trust shortfall, and errand age (capped at the horizon) which favours older errands
+ERRAND_BATCH_TRUST_WEIGHT = float(os.getenv('ERRAND_BATCH_TRUST_WEIGHT', '0.3'))
+ERRAND_BATCH_AGE_WEIGHT = float(os.getenv('ERRAND_BATCH_AGE_WEIGHT', '0.5'))
+ERRAND_BATCH_AGE_HORIZON_SECONDS = int(os.getenv('ERRAND_BATCH_AGE_HORIZON_SECONDS', '300'))
+# Weight of the acceptance shortfall (1 - probability) once `fit_acceptance_scores` has run
+ERRAND_BATCH_ACCEPTANCE_WEIGHT = float(os.getenv('ERRAND_BATCH_ACCEPTANCE_WEIGHT', '0.5'))
+# Offer caps per runner, kept as cache counters (see runners/offer_caps.py); 0 disables a cap.
+# Matching skips runners at a cap and offers to the next-best candidates instead.
+RUNNER_MAX_PENDING_OFFERS = int(os.getenv('RUNNER_MAX_PENDING_OFFERS', '3'))
+RUNNER_MAX_OFFERS_PER_MINUTE = int(os.getenv('RUNNER_MAX_OFFERS_PER_MINUTE', '6'))
+# Route chaining (`manage.py run_chain_planner`): open errands within SEARCH_RADIUS_M of the end
+# of a busy runner's route are offered to that runner first when inserting them adds at most
+# MAX_DETOUR_M to the route; options are recomputed every REFRESH_SECONDS. Chaining is how a runner
+# past RUNNER_MAX_ACTIVE_ERRANDS gets more errands, up to MAX_ACTIVE_ERRANDS in progress at once
+ERRAND_CHAIN_MAX_DETOUR_M = float(os.getenv('ERRAND_CHAIN_MAX_DETOUR_M', '1500'))
+ERRAND_CHAIN_SEARCH_RADIUS_M = float(os.getenv('ERRAND_CHAIN_SEARCH_RADIUS_M', '3000'))
+ERRAND_CHAIN_CANDIDATES = int(os.getenv('ERRAND_CHAIN_CANDIDATES', '10'))
+ERRAND_CHAIN_REFRESH_SECONDS = int(os.getenv('ERRAND_CHAIN_REFRESH_SECONDS', '20'))
+ERRAND_CHAIN_MAX_ACTIVE_ERRANDS = int(os.getenv('ERRAND_CHAIN_MAX_ACTIVE_ERRANDS', '2'))
+# Errands whose go_to lies outside every active ServiceArea (admin-managed polygons):
+# 'reject' fails CreateErrand/SaveErrandDraft, 'flag' saves them as out_of_area and never matches
+# them, 'off' skips the check. Without any active area every point is served.
+SERVICE_AREA_ENFORCEMENT = os.getenv('SERVICE_AREA_ENFORCEMENT', 'reject')
+# Processes reload the polygons at most this long after an admin change
+SERVICE_AREA_REFRESH_SECONDS = int(os.getenv('SERVICE_AREA_REFRESH_SECONDS', '30'))
+
+# openErrandsNear: largest search radius and page size a client may ask for
+OPEN_ERRANDS_MAX_RADIUS_M = int(os.getenv('OPEN_ERRANDS_MAX_RADIUS_M', '20000'))
+OPEN_ERRANDS_PAGE_MAX = int(os.getenv('OPEN_ERRANDS_PAGE_MAX', '100'))
+# runnerDensity: runners are clustered on a TILE_GRID x TILE_GRID grid inside each map tile,
+# cached per tile; larger boxes are answered at a lower zoom to stay within MAX_TILES tiles
+RUNNER_DENSITY_TILE_GRID = int(os.getenv('RUNNER_DENSITY_TILE_GRID', '8'))
+RUNNER_DENSITY_TTL_SECONDS = int(os.getenv('RUNNER_DENSITY_TTL_SECONDS', '15'))
+RUNNER_DENSITY_MAX_TILES = int(os.getenv('RUNNER_DENSITY_MAX_TILES', '16'))
+RUNNER_DENSITY_MAX_ZOOM = int(os.getenv('RUNNER_DENSITY_MAX_ZOOM', '18'))
+# Per-errand matching runs on the `run_matching_worker` process owning the errand's grid cell
+# (consistent hashing over the workers registered in the cache); without workers it runs on the
+# job queue of the web process that created the errand
+ERRAND_WORKER_TTL_SECONDS = int(os.getenv('ERRAND_WORKER_TTL_SECONDS', '15'))
+ERRAND_WORKER_SWEEP_SECONDS = int(os.getenv('ERRAND_WORKER_SWEEP_SECONDS', '30'))
+# The "errands.sweep" job expires errands past expires_at and, without workers, re-offers stalled
+# ones, in one process every ERRAND_SWEEP_SECONDS (up to ERRAND_SWEEP_BATCH errands of each)
+ERRAND_SWEEP_SECONDS = int(os.getenv('ERRAND_SWEEP_SECONDS', '60'))
+ERRAND_SWEEP_BATCH = int(os.getenv('ERRAND_SWEEP_BATCH', '500'))
+ERRAND_DISPATCH_VNODES = int(os.getenv('ERRAND_DISPATCH_VNODES', '64'))
+ERRAND_DISPATCH_RING_REFRESH_SECONDS = int(os.getenv('ERRAND_DISPATCH_RING_REFRESH_SECONDS', '5'))
+ERRAND_DISPATCH_TIMEOUT_MS = int(os.getenv('ERRAND_DISPATCH_TIMEOUT_MS', '200'))
+
+# -------------------------------------------------------------------
+# Runner matching
+# -------------------------------------------------------------------
+# Only runners within this radius (meters) of the errand's go_to are considered
+RUNNER_SEARCH_RADIUS_M = int(os.getenv('RUNNER_SEARCH_RADIUS_M', '10000'))
+# Maximum number of ranked runners returned to matching/CreateErrand (0 = no limit)
+RUNNER_MATCH_LIMIT = int(os.getenv('RUNNER_MATCH_LIMIT', '20'))
+# Where runner distances are computed and ranked when the shared index is unavailable: 'db' or 'python'
+RUNNER_DISTANCE_BACKEND = os.getenv('RUNNER_DISTANCE_BACKEND', 'db')
+# Per-errand ranked runner snapshot lifetime, and the move (meters) inside a grid cell that invalidates it
+RUNNER_SNAPSHOT_TTL_SECONDS = int(os.getenv('RUNNER_SNAPSHOT_TTL_SECONDS', '30'))
+RUNNER_SNAPSHOT_MIN_MOVE_M = int(os.getenv('RUNNER_SNAPSHOT_MIN_MOVE_M', '100'))
+# Runner presence: heartbeat age after which a runner is treated as offline, how many
+# in-progress errands a runner may hold and still get regular offers (chained offers use
+# ERRAND_CHAIN_MAX_ACTIVE_ERRANDS), and heartbeat write throttling
+RUNNER_PRESENCE_TIMEOUT_SECONDS = int(os.getenv('RUNNER_PRESENCE_TIMEOUT_SECONDS', '300'))
+RUNNER_MAX_ACTIVE_ERRANDS = int(os.getenv('RUNNER_MAX_ACTIVE_ERRANDS', '1'))
+RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS = int(os.getenv('RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS', '15'))
+# Size (degrees) of the fixed grid cells stored on UserLocation.grid_cell (~5.5 km at the equator)
+RUNNER_GRID_CELL_DEG = float(os.getenv('RUNNER_GRID_CELL_DEG', '0.05'))
+# Above this many cells the prefilter falls back to a latitude/longitude bounding box
+RUNNER_GRID_MAX_CELLS = int(os.getenv('RUNNER_GRID_MAX_CELLS', '400'))
+
+# DEVICE location pings are buffered per worker and written with one bulk_update every
+# LOCATION_PING_FLUSH_MS; pings moving less than LOCATION_PING_MIN_MOVE_M are dropped. A user's
+# first ping, and one every LOCATION_PING_RESEED_SECONDS, is written synchronously
+LOCATION_PING_BUFFER_ENABLED = os.getenv('LOCATION_PING_BUFFER_ENABLED', 'True') == 'True'
+LOCATION_PING_FLUSH_MS = int(os.getenv('LOCATION_PING_FLUSH_MS', '1000'))
+LOCATION_PING_MIN_MOVE_M = float(os.getenv('LOCATION_PING_MIN_MOVE_M', '10'))
+LOCATION_PING_RESEED_SECONDS = int(os.getenv('LOCATION_PING_RESEED_SECONDS', '60'))
+
+# Matching regions: "name=min_lat:min_lon:max_lat:max_lon;..." boxes, checked in order. Runners
+# are only matched to errands in their own region. Points outside every box fall into coarse
+# REGION_CELL_DEG grid regions ("g:row:col").
+REGIONS = [
+    (name.strip(), tuple(float(part) for part in bbox.split(':')))
+    for name, bbox in (
+        region.split('=', 1)
+        for region in os.getenv('REGIONS', 'yaounde=3.70:11.35:4.05:11.70;douala=3.90:9.55:4.20:9.90').split(';')
+        if region.strip()
+    )
+]
+REGION_CELL_DEG = float(os.getenv('REGION_CELL_DEG', '1.0'))
+
+# Shared runner position index served by `manage.py run_runner_index`
+# ("unix:/run/runam/runner-index.sock" or "127.0.0.1:8765"); empty disables it and matching uses the database
+RUNNER_INDEX_ADDRESS = os.getenv('RUNNER_INDEX_ADDRESS', '')
+# Dedicated index processes for busy regions ("yaounde=unix:/run/runam/yaounde.sock;..."), each
+# started with `run_runner_index --region`; other regions use RUNNER_INDEX_ADDRESS
+RUNNER_INDEX_REGION_ADDRESSES = dict(
+    entry.split('=', 1) for entry in os.getenv('RUNNER_INDEX_REGION_ADDRESSES', '').split(';') if entry.strip()
+)
+RUNNER_INDEX_TIMEOUT_MS = int(os.getenv('RUNNER_INDEX_TIMEOUT_MS', '50'))
+# After a failed call, workers skip the index for this long before retrying
+RUNNER_INDEX_RETRY_SECONDS = int(os.getenv('RUNNER_INDEX_RETRY_SECONDS', '30'))
+RUNNER_INDEX_RESYNC_SECONDS = int(os.getenv('RUNNER_INDEX_RESYNC_SECONDS', '300'))
+# Binary snapshot written on every resync; a restarting index maps it and catches up instead of
+# rebuilding from the database. Ignored when older than RUNNER_INDEX_SNAPSHOT_MAX_AGE_SECONDS.
+RUNNER_INDEX_SNAPSHOT_PATH = os.getenv('RUNNER_INDEX_SNAPSHOT_PATH', str(BASE_DIR / 'data' / 'runner-index.snap'))
+RUNNER_INDEX_SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv('RUNNER_INDEX_SNAPSHOT_MAX_AGE_SECONDS', '3600'))
+
+# Road distance / ETA provider for matching and pricing: 'matrix' (precomputed by
+# `manage.py build_travel_matrix`, falls back to haversine until built) or 'haversine'
+TRAVEL_PROVIDER = os.getenv('TRAVEL_PROVIDER', 'matrix')
+TRAVEL_MATRIX_DIR = os.getenv('TRAVEL_MATRIX_DIR', str(BASE_DIR / 'data' / 'travel_matrix'))
+# Matrix cell size in degrees (~550 m at the equator)
+TRAVEL_MATRIX_CELL_DEG = float(os.getenv('TRAVEL_MATRIX_CELL_DEG', '0.005'))
+# Straight-line speed used for haversine ETAs (m/s)
+RUNNER_AVG_SPEED_MPS = float(os.getenv('RUNNER_AVG_SPEED_MPS', '5.0'))
+# With road distances, matching ranks this many times the requested candidates by straight line first
+TRAVEL_RERANK_FACTOR = int(os.getenv('TRAVEL_RERANK_FACTOR', '3'))
+
+# Per-runner offer acceptance probabilities fitted by `manage.py fit_acceptance_scores` from
+# the last LOOKBACK_DAYS of offers (older offers count less, halving every HALF_LIFE_DAYS;
+# PRIOR_WEIGHT offers' worth of the overall rate smooths runners with little history)
+RUNNER_ACCEPTANCE_TABLE_PATH = os.getenv('RUNNER_ACCEPTANCE_TABLE_PATH', str(BASE_DIR / 'data' / 'acceptance.npz'))
+RUNNER_ACCEPTANCE_LOOKBACK_DAYS = int(os.getenv('RUNNER_ACCEPTANCE_LOOKBACK_DAYS', '90'))
+RUNNER_ACCEPTANCE_HALF_LIFE_DAYS = float(os.getenv('RUNNER_ACCEPTANCE_HALF_LIFE_DAYS', '30'))
+RUNNER_ACCEPTANCE_PRIOR_WEIGHT = float(os.getenv('RUNNER_ACCEPTANCE_PRIOR_WEIGHT', '5'))
+# Workers pick up a newly published table within this many seconds
+RUNNER_ACCEPTANCE_REFRESH_SECONDS = int(os.getenv('RUNNER_ACCEPTANCE_REFRESH_SECONDS', '300'))
+# With a table, candidates are ranked by
+#   DISTANCE_WEIGHT * distance / DISTANCE_SCALE_M + ACCEPTANCE_WEIGHT * (1 - acceptance probability)
+# (defaults: 1 km closer is worth as much as a 100% higher chance of acceptance)
+RUNNER_RANK_DISTANCE_WEIGHT = float(os.getenv('RUNNER_RANK_DISTANCE_WEIGHT', '1.0'))
+RUNNER_RANK_ACCEPTANCE_WEIGHT = float(os.getenv('RUNNER_RANK_ACCEPTANCE_WEIGHT', '1.0'))
+RUNNER_RANK_DISTANCE_SCALE_M = float(os.getenv('RUNNER_RANK_DISTANCE_SCALE_M', '1000'))
+
+# -------------------------------------------------------------------
+# Cache
+# -------------------------------------------------------------------
+# Matching caches (runner snapshots, cell versions) must be shared by all workers in production:
+# set REDIS_CACHE_URL (uses the redis package). Without it each process keeps its own in-memory cache.
+if os.getenv('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
 
 # Channels / WebSocket config
 CHANNEL_LAYERS = {
@@ -214,6 +399,19 @@ CHANNEL_LAYERS = {
     },
 }
 # Celery configuration
+# Background jobs (apps/utils/jobs.py): matching, offer wave follow-ups, expiry, notifications.
+# 'threads' runs them on a bounded pool in each process; 'celery' sends them to the broker below,
+# run by `celery -A core.celery worker` (needs celery and a real broker, else 'threads' is used)
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'threads')
+# Pool threads per process, bounds of the queue and of the delayed jobs (jobs beyond them are
+# rejected and left to the errand sweep), and how long queued jobs may take to finish on shutdown
+JOB_QUEUE_WORKERS = int(os.getenv('JOB_QUEUE_WORKERS', '8'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '256'))
+JOB_QUEUE_DELAYED_SIZE = int(os.getenv('JOB_QUEUE_DELAYED_SIZE', '10000'))
+JOB_QUEUE_DRAIN_SECONDS = int(os.getenv('JOB_QUEUE_DRAIN_SECONDS', '10'))
+# Modules whose @job functions must be registered before a job can run (e.g. in a Celery worker)
+JOB_MODULES = ['apps.errands.tasks', 'apps.errands.services']
+
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', CELERY_BROKER_URL)
 CELERY_ACCEPT_CONTENT = ['json']
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_wsgi_application()
+
+# Start the job queue with the server so its periodic jobs (the errand sweep) run before the
+# first job is queued
+from apps.utils import jobs  # noqa: E402
+
+jobs.start()
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.1 on 2026-10-17 04:05
+
+from django.db import migrations, models
+
+from apps.locations.grid import region_for
+
+
+def backfill_region(apps, schema_editor):
+    ErrandLocation = apps.get_model('errand_location', 'ErrandLocation')
+    rows = list(ErrandLocation.objects.only('id', 'latitude', 'longitude'))
+    for row in rows:
+        row.region = region_for(row.latitude, row.longitude)
+    ErrandLocation.objects.bulk_update(rows, ['region'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errand_location', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errandlocation',
+            name='region',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.RunPython(backfill_region, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.1 on 2026-10-17 04:40
+
+from django.db import migrations, models
+
+from apps.locations.grid import grid_cell_for
+
+
+def backfill_grid_cell(apps, schema_editor):
+    ErrandLocation = apps.get_model('errand_location', 'ErrandLocation')
+    rows = list(ErrandLocation.objects.only('id', 'latitude', 'longitude'))
+    for row in rows:
+        row.grid_cell = grid_cell_for(row.latitude, row.longitude)
+    ErrandLocation.objects.bulk_update(rows, ['grid_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errand_location', '0003_errandlocation_region'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errandlocation',
+            name='grid_cell',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.RunPython(backfill_grid_cell, migrations.RunPython.noop),
+    ]
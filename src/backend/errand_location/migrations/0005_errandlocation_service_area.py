@@ -0,0 +1,20 @@
+# Generated by Django 6.0.1 on 2026-10-17 12:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('errand_location', '0004_errandlocation_grid_cell'),
+        ('locations', '0004_servicearea_userlocation_service_area'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='errandlocation',
+            name='service_area',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='locations.servicearea'),
+        ),
+    ]
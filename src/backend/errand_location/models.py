@@ -1,6 +1,8 @@
 from django.db import models
 from apps.errands.models import Errand
-from apps.locations.models import LocationMode
+from apps.locations.grid import grid_cell_for, region_for
+from apps.locations.models import LocationMode, ServiceArea
+from apps.locations.service_areas import service_area_for
 
 class ErrandLocation(models.Model):
     errand = models.ForeignKey(
@@ -16,4 +18,19 @@ class ErrandLocation(models.Model):
         choices=LocationMode.choices,
     )
 
+    # Fixed-grid cell ("row:col") and matching region, derived from the coordinates on save;
+    # the grid cell prefilters open errands near a runner
+    grid_cell = models.CharField(max_length=32, blank=True, default="", db_index=True)
+    region = models.CharField(max_length=32, blank=True, default="", db_index=True)
+    # Service area containing the point (None outside every active area); runners are matched
+    # within it
+    service_area = models.ForeignKey(ServiceArea, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
 
+    def save(self, *args, **kwargs):
+        self.grid_cell = grid_cell_for(self.latitude, self.longitude)
+        self.region = region_for(self.latitude, self.longitude)
+        self.service_area_id = service_area_for(self.latitude, self.longitude)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"latitude", "longitude"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "grid_cell", "region", "service_area"}
+        super().save(*args, **kwargs)
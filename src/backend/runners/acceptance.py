@@ -0,0 +1,169 @@
+"""Per-runner acceptance probabilities used to rank matching candidates.
+
+`manage.py fit_acceptance_scores` fits, offline, how likely each runner is to accept an offer from
+their resolved ErrandOffer history (ACCEPTED / REJECTED / EXPIRED). It writes a compact table
+(sorted runner ids and float32 probabilities) to `RUNNER_ACCEPTANCE_TABLE_PATH`.
+
+The fit is a smoothed, recency-weighted acceptance rate:
+
+    p_j = (sum_k w_k * a_k + PRIOR_WEIGHT * p_all) / (sum_k w_k + PRIOR_WEIGHT)
+
+- w_k halves every RUNNER_ACCEPTANCE_HALF_LIFE_DAYS of offer age.
+- a_k is 1 for an offer accepted straight away, falling linearly to 0.5 for an offer accepted at
+  the very end of its TTL: while a runner sits on an offer the errand waits, so a late accept is
+  worth less. a_k is 0 for a rejected or expired offer.
+- p_all is the overall acceptance rate. Runners with little history stay close to it, and runners
+  not in the table get exactly p_all.
+
+Matching loads the table once per process (re-checked every RUNNER_ACCEPTANCE_REFRESH_SECONDS)
+and orders candidates by
+
+    DISTANCE_WEIGHT * distance_m / DISTANCE_SCALE_M + ACCEPTANCE_WEIGHT * (1 - p_j)
+
+then trust, in place of distance alone. Without a table (or NumPy) ranking is unchanged.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from runners.services import np
+
+logger = logging.getLogger(__name__)
+
+
+def fit_acceptance(runner_ids, accepted, latency_s, age_s, ttl_s=None, half_life_s=None, prior_weight=None):
+    """Fit from parallel arrays, one entry per resolved offer. `accepted` is a bool per offer;
+    `latency_s` is the response delay of accepted offers (ignored for the others); `age_s` is
+    how long ago the offer was made. Returns (sorted unique runner ids, probabilities, p_all)."""
+    ttl_s = float(ttl_s or getattr(settings, 'ERRAND_OFFER_TTL_SECONDS', 60))
+    half_life_s = float(half_life_s or getattr(settings, 'RUNNER_ACCEPTANCE_HALF_LIFE_DAYS', 30) * 86400)
+    if prior_weight is None:
+        prior_weight = float(getattr(settings, 'RUNNER_ACCEPTANCE_PRIOR_WEIGHT', 5.0))
+
+    runner_ids = np.asarray(runner_ids, dtype=np.int64)
+    accepted = np.asarray(accepted, dtype=bool)
+    weight = np.power(0.5, np.asarray(age_s, dtype=np.float64) / half_life_s)
+    lateness = np.clip(np.nan_to_num(np.asarray(latency_s, dtype=np.float64)) / ttl_s, 0.0, 1.0)
+    outcome = np.where(accepted, 1.0 - 0.5 * lateness, 0.0)
+
+    ids, inverse = np.unique(runner_ids, return_inverse=True)
+    weighted_outcome = np.bincount(inverse, weights=weight * outcome, minlength=len(ids))
+    total_weight = np.bincount(inverse, weights=weight, minlength=len(ids))
+    p_all = float(weighted_outcome.sum() / total_weight.sum()) if total_weight.sum() > 0 else 0.5
+    probabilities = (weighted_outcome + prior_weight * p_all) / (total_weight + prior_weight)
+    return ids, probabilities.astype(np.float32), p_all
+
+
+def offer_history(now=None, days=None):
+    """Parallel arrays (runner_ids, accepted, latency_s, age_s) of offers resolved in the last
+    `days` (RUNNER_ACCEPTANCE_LOOKBACK_DAYS)."""
+    from apps.errands.models import ErrandOffer
+
+    now = now or timezone.now()
+    days = days or getattr(settings, 'RUNNER_ACCEPTANCE_LOOKBACK_DAYS', 90)
+    rows = (
+        ErrandOffer.objects.filter(created_at__gte=now - timedelta(days=days))
+        .exclude(status=ErrandOffer.Status.PENDING)
+        .values_list("runner_id", "status", "created_at", "responded_at")
+        .iterator()
+    )
+    runner_ids, accepted, latency_s, age_s = [], [], [], []
+    for runner_id, status, created_at, responded_at in rows:
+        runner_ids.append(runner_id)
+        accepted.append(status == ErrandOffer.Status.ACCEPTED)
+        latency_s.append((responded_at - created_at).total_seconds() if responded_at else 0.0)
+        age_s.append((now - created_at).total_seconds())
+    return runner_ids, accepted, latency_s, age_s
+
+
+def write_table(path, ids, probabilities, p_all):
+    """Atomic write: readers see either the previous table or the complete new one."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}.npz"
+    np.savez(tmp, ids=ids, p=probabilities, p_all=np.float32(p_all))
+    os.replace(tmp, path)
+    logger.info("write_table: %s runner scores written to %s (p_all=%.3f)", len(ids), path, p_all)
+
+
+class AcceptanceTable:
+    def __init__(self, ids, probabilities, p_all):
+        self.ids = ids
+        self.probabilities = probabilities
+        self.p_all = float(p_all)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["ids"], data["p"], data["p_all"])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def probabilities_for(self, runner_ids):
+        """Acceptance probability per runner id; p_all for runners not in the table."""
+        runner_ids = np.asarray(runner_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(runner_ids), self.p_all)
+        pos = np.minimum(np.searchsorted(self.ids, runner_ids), len(self.ids) - 1)
+        return np.where(self.ids[pos] == runner_ids, self.probabilities[pos], self.p_all)
+
+    def rank(self, matches, limit=None):
+        """Order RunnerMatch rows by weighted distance and acceptance cost, then trust, keeping
+        the best `limit`."""
+        if not matches:
+            return matches
+        distance_weight = float(getattr(settings, 'RUNNER_RANK_DISTANCE_WEIGHT', 1.0))
+        acceptance_weight = float(getattr(settings, 'RUNNER_RANK_ACCEPTANCE_WEIGHT', 1.0))
+        scale_m = float(getattr(settings, 'RUNNER_RANK_DISTANCE_SCALE_M', 1000))
+        p = self.probabilities_for([m.runner_id for m in matches])
+        costs = (
+            distance_weight * np.asarray([m.distance_m for m in matches], dtype=np.float64) / scale_m
+            + acceptance_weight * (1.0 - p)
+        ).tolist()
+        keyed = [(cost, -(m.trust_score or 0), i) for i, (cost, m) in enumerate(zip(costs, matches))]
+        best = heapq.nsmallest(limit, keyed) if limit and len(keyed) > limit else sorted(keyed)
+        return [matches[i] for _, _, i in best]
+
+
+_lock = threading.Lock()
+_state = {"table": None, "mtime": None, "checked_at": float("-inf")}
+
+
+def get_acceptance_table():
+    """The published table, loaded once per process and reloaded when the file changes. None
+    when no table has been fitted or NumPy is unavailable."""
+    path = getattr(settings, 'RUNNER_ACCEPTANCE_TABLE_PATH', '')
+    if np is None or not path:
+        return None
+    now = time.monotonic()
+    if now - _state["checked_at"] < getattr(settings, 'RUNNER_ACCEPTANCE_REFRESH_SECONDS', 300):
+        return _state["table"]
+    with _lock:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != _state["mtime"]:
+            table = None
+            if mtime is not None:
+                try:
+                    table = AcceptanceTable.load(path)
+                    logger.info("get_acceptance_table: loaded %s runner scores from %s", len(table), path)
+                except (OSError, ValueError, KeyError):
+                    logger.exception("get_acceptance_table: unreadable table %s", path)
+            _state["table"], _state["mtime"] = table, mtime
+        _state["checked_at"] = now
+    return _state["table"]
+
+
+def reset_acceptance_table():
+    """Forget the loaded table (after fitting a new one or changing settings)."""
+    _state.update(table=None, mtime=None, checked_at=float("-inf"))
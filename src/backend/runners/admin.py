@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import RunnerPresence
+
+
+@admin.register(RunnerPresence)
+class RunnerPresenceAdmin(admin.ModelAdmin):
+    list_display = ('user', 'is_online', 'last_heartbeat_at', 'active_errand_count')
+    list_filter = ('is_online',)
+    search_fields = ('user__email',)
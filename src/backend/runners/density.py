@@ -0,0 +1,125 @@
+"""Runner density clusters for the buyer map.
+
+The map asks for a bounding box and a zoom level instead of individual runners. The box is
+covered with Web Mercator tiles at that zoom (the tiles the map itself draws). Each tile is split
+into RUNNER_DENSITY_TILE_GRID x RUNNER_DENSITY_TILE_GRID cells. Available runners are counted per
+cell, and each non-empty cell becomes one cluster (count and centroid).
+
+Clusters are computed per tile and cached for RUNNER_DENSITY_TTL_SECONDS. Every buyer looking at
+the same area shares the work, and the response size is bounded by
+RUNNER_DENSITY_MAX_TILES * TILE_GRID^2 however many runners are in view. When the box needs more
+tiles than that, the zoom is lowered until it fits.
+"""
+import logging
+from math import asinh, atan, degrees, floor, pi, radians, sinh, tan
+from typing import NamedTuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from apps.locations.grid import grid_cells_in_box
+from apps.roles.models import Role
+from runners.presence import available_runners_q
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+TILE_KEY = "runners:density:{zoom}:{x}:{y}"
+MAX_MERCATOR_LAT = 85.05112878
+
+
+class RunnerCluster(NamedTuple):
+    count: int
+    latitude: float
+    longitude: float
+
+
+def _mercator(latitude, longitude, zoom):
+    """Fractional tile coordinates (x, y) of a point at `zoom`."""
+    n = 2 ** zoom
+    lat = radians(max(min(float(latitude), MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT))
+    x = (float(longitude) + 180.0) / 360.0 * n
+    y = (1.0 - asinh(tan(lat)) / pi) / 2.0 * n
+    return min(max(x, 0.0), n - 1e-9), min(max(y, 0.0), n - 1e-9)
+
+
+def tile_bounds(zoom, x, y):
+    """(min_lat, min_lon, max_lat, max_lon) of tile (x, y)."""
+    n = 2 ** zoom
+    lon_min = x / n * 360.0 - 180.0
+    lon_max = (x + 1) / n * 360.0 - 180.0
+    lat_max = degrees(atan(sinh(pi * (1 - 2 * y / n))))
+    lat_min = degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n))))
+    return lat_min, lon_min, lat_max, lon_max
+
+
+def tiles_for_bbox(min_lat, min_lon, max_lat, max_lon, zoom):
+    """Zoom actually used and the (x, y) tiles covering the box, at most RUNNER_DENSITY_MAX_TILES."""
+    max_tiles = getattr(settings, 'RUNNER_DENSITY_MAX_TILES', 16)
+    zoom = max(0, min(int(zoom), getattr(settings, 'RUNNER_DENSITY_MAX_ZOOM', 18)))
+    while True:
+        x0, y0 = _mercator(max_lat, min_lon, zoom)  # north-west corner
+        x1, y1 = _mercator(min_lat, max_lon, zoom)  # south-east corner
+        xs = range(floor(x0), floor(x1) + 1)
+        ys = range(floor(y0), floor(y1) + 1)
+        if len(xs) * len(ys) <= max_tiles or zoom == 0:
+            return zoom, [(x, y) for x in xs for y in ys]
+        zoom -= 1
+
+
+def _tile_runner_positions(zoom, x, y):
+    min_lat, min_lon, max_lat, max_lon = tile_bounds(zoom, x, y)
+    qs = User.objects.filter(available_runners_q(), profile__roles__name=Role.RUNNER, location__isnull=False)
+    cells = grid_cells_in_box(min_lat, min_lon, max_lat, max_lon)
+    if cells is not None:
+        qs = qs.filter(location__grid_cell__in=cells)
+    return (
+        qs.filter(location__latitude__range=(min_lat, max_lat), location__longitude__range=(min_lon, max_lon))
+        # The id keeps runners standing at the same spot apart; distinct() only drops duplicate
+        # rows from the role join
+        .values_list("id", "location__latitude", "location__longitude")
+        .distinct()
+    )
+
+
+def tile_clusters(zoom, x, y):
+    """Clusters of one tile, from the cache when fresh."""
+    key = TILE_KEY.format(zoom=zoom, x=x, y=y)
+    clusters = cache.get(key)
+    if clusters is not None:
+        return clusters
+
+    grid = getattr(settings, 'RUNNER_DENSITY_TILE_GRID', 8)
+    cells = {}
+    seen = set()
+    for runner_id, lat, lon in _tile_runner_positions(zoom, x, y):
+        if runner_id in seen:
+            continue
+        seen.add(runner_id)
+        fx, fy = _mercator(lat, lon, zoom)
+        # Points on the tile's far edge belong to the neighbour tile
+        if floor(fx) != x or floor(fy) != y:
+            continue
+        cell = (min(int((fx - x) * grid), grid - 1), min(int((fy - y) * grid), grid - 1))
+        count, lat_sum, lon_sum = cells.get(cell, (0, 0.0, 0.0))
+        cells[cell] = (count + 1, lat_sum + lat, lon_sum + lon)
+
+    clusters = [RunnerCluster(count, lat_sum / count, lon_sum / count) for count, lat_sum, lon_sum in cells.values()]
+    cache.set(key, clusters, timeout=getattr(settings, 'RUNNER_DENSITY_TTL_SECONDS', 15))
+    return clusters
+
+
+def runner_density(min_lat, min_lon, max_lat, max_lon, zoom):
+    """(zoom used, clusters whose centroid lies in the box)."""
+    if min_lat > max_lat:
+        min_lat, max_lat = max_lat, min_lat
+    zoom, tiles = tiles_for_bbox(min_lat, min_lon, max_lat, max_lon, zoom)
+    clusters = [
+        cluster
+        for x, y in tiles
+        for cluster in tile_clusters(zoom, x, y)
+        if min_lat <= cluster.latitude <= max_lat and min_lon <= cluster.longitude <= max_lon
+    ]
+    logger.debug("runner_density: zoom=%s tiles=%s clusters=%s", zoom, len(tiles), len(clusters))
+    return zoom, clusters
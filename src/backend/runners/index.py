@@ -0,0 +1,430 @@
+"""In-memory spatial index of runner positions.
+
+A single `run_runner_index` process owns a `RunnerIndex` and serves it over a local socket
+(`RUNNER_INDEX_ADDRESS`, either "unix:/path/to.sock" or "host:port"). Every web worker talks to it
+through `RunnerIndexClient`, which returns None whenever the index is unreachable so callers can
+fall back to the ORM path. Busy regions can get a dedicated process (`run_runner_index --region`,
+listed in `RUNNER_INDEX_REGION_ADDRESSES`) holding only that region's runners.
+
+Wire protocol: one JSON object per line in each direction.
+"""
+import heapq
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from array import array
+from typing import NamedTuple
+
+from django.conf import settings
+
+from apps.locations.grid import grid_cell_for, grid_cells_within, region_for
+from apps.locations.service_areas import service_area_for
+
+logger = logging.getLogger(__name__)
+
+
+class RunnerMatch(NamedTuple):
+    runner_id: int
+    latitude: float
+    longitude: float
+    trust_score: int
+    distance_m: float
+
+
+def _rank_key(match):
+    return match.distance_m, -match.trust_score
+
+
+def rank_matches(matches, limit=None):
+    """Order matches by distance asc then trust desc, keeping only the best `limit` of them.
+    Uses heap selection (O(n log k)) when a limit is given instead of sorting everything."""
+    if limit and len(matches) > limit:
+        return heapq.nsmallest(limit, matches, key=_rank_key)
+    return sorted(matches, key=_rank_key)
+
+
+# =====================
+# INDEX
+# =====================
+
+# Service area argument of `upsert` when the caller does not know it
+AREA_AT_POSITION = object()
+
+class RunnerIndex:
+    """Compact arrays of (runner_id, lat, lon, trust_score, last heartbeat) bucketed by grid cell.
+
+    Slots freed by `remove` are reused by later `upsert` calls so the arrays never grow past the
+    peak number of runners. Queries skip runners whose last heartbeat is older than
+    RUNNER_PRESENCE_TIMEOUT_SECONDS, so a runner who stops pinging drops out of matching on time
+    rather than at the next resync. Each slot also keeps the runner's matching region and service
+    area, so queries for an errand's zone fill their limit from that zone only. All public
+    methods are thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = array('q')
+        self._lat = array('d')
+        self._lon = array('d')
+        self._trust = array('h')
+        self._seen = array('d')  # last heartbeat, epoch seconds
+        self._cells = []
+        self._zones = []  # (region, service area id) per slot
+        self._slot_by_id = {}
+        self._free_slots = []
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._slot_by_id)
+
+    def upsert(self, runner_id, latitude, longitude, trust_score=0, seen_at=None, service_area=AREA_AT_POSITION):
+        """Add or move a runner; `seen_at` is their last heartbeat (epoch seconds, default now) and
+        `service_area` their area id (None outside every area), looked up from the position when
+        not given."""
+        runner_id = int(runner_id)
+        latitude = float(latitude)
+        longitude = float(longitude)
+        seen_at = time.time() if seen_at is None else float(seen_at)
+        cell = grid_cell_for(latitude, longitude)
+        if service_area is AREA_AT_POSITION:
+            service_area = service_area_for(latitude, longitude)
+        zone = (region_for(latitude, longitude), service_area)
+        with self._lock:
+            slot = self._slot_by_id.get(runner_id)
+            if slot is None:
+                if self._free_slots:
+                    slot = self._free_slots.pop()
+                    self._ids[slot] = runner_id
+                    self._lat[slot] = latitude
+                    self._lon[slot] = longitude
+                    self._trust[slot] = int(trust_score or 0)
+                    self._seen[slot] = seen_at
+                    self._cells[slot] = cell
+                    self._zones[slot] = zone
+                else:
+                    slot = len(self._ids)
+                    self._ids.append(runner_id)
+                    self._lat.append(latitude)
+                    self._lon.append(longitude)
+                    self._trust.append(int(trust_score or 0))
+                    self._seen.append(seen_at)
+                    self._cells.append(cell)
+                    self._zones.append(zone)
+                self._slot_by_id[runner_id] = slot
+            else:
+                old_cell = self._cells[slot]
+                if old_cell != cell:
+                    self._buckets.get(old_cell, set()).discard(slot)
+                self._lat[slot] = latitude
+                self._lon[slot] = longitude
+                self._trust[slot] = int(trust_score or 0)
+                self._seen[slot] = seen_at
+                self._cells[slot] = cell
+                self._zones[slot] = zone
+            self._buckets.setdefault(cell, set()).add(slot)
+
+    def remove(self, runner_id):
+        with self._lock:
+            slot = self._slot_by_id.pop(int(runner_id), None)
+            if slot is None:
+                return False
+            self._buckets.get(self._cells[slot], set()).discard(slot)
+            self._ids[slot] = -1
+            self._cells[slot] = ""
+            self._free_slots.append(slot)
+            return True
+
+    def replace_all(self, rows):
+        """Rebuild the index from an iterable of (runner_id, lat, lon, trust_score, seen_at) rows."""
+        fresh = RunnerIndex()
+        for row in rows:
+            fresh.upsert(*row)
+        with self._lock:
+            self._ids, self._lat, self._lon, self._trust = fresh._ids, fresh._lat, fresh._lon, fresh._trust
+            self._seen = fresh._seen
+            self._cells, self._zones, self._slot_by_id = fresh._cells, fresh._zones, fresh._slot_by_id
+            self._free_slots, self._buckets = fresh._free_slots, fresh._buckets
+
+    def _matches_in_cells(self, latitude, longitude, radius_m, cells, region=None, service_area=None):
+        from runners.services import distances_from
+
+        cutoff = time.time() - getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300)
+        slots = [
+            slot for cell in cells for slot in self._buckets.get(cell, ())
+            if self._seen[slot] >= cutoff
+            and (region is None or self._zones[slot][0] == region)
+            and (service_area is None or self._zones[slot][1] == service_area)
+        ]
+        if not slots:
+            return []
+        lats = [self._lat[slot] for slot in slots]
+        lons = [self._lon[slot] for slot in slots]
+        dists = distances_from((latitude, longitude), lats, lons)
+        return [
+            RunnerMatch(self._ids[slot], lat, lon, self._trust[slot], float(dist))
+            for slot, lat, lon, dist in zip(slots, lats, lons, dists)
+            if dist <= radius_m
+        ]
+
+    def within(self, latitude, longitude, radius_m, limit=None, region=None, service_area=None):
+        """Best `limit` runners within radius_m meters, ordered by distance asc then trust desc;
+        only those in `region` and `service_area` when given."""
+        latitude = float(latitude)
+        longitude = float(longitude)
+        with self._lock:
+            cells = grid_cells_within(latitude, longitude, radius_m)
+            if cells is None:
+                cells = list(self._buckets.keys())
+            matches = self._matches_in_cells(latitude, longitude, radius_m, cells, region, service_area)
+        return rank_matches(matches, limit)
+
+    def nearest(self, latitude, longitude, k, max_radius_m):
+        """The k closest runners within max_radius_m, growing the search ring until k are found."""
+        radius_m = min(float(getattr(settings, 'RUNNER_GRID_CELL_DEG', 0.05)) * 111320, max_radius_m)
+        while True:
+            matches = self.within(latitude, longitude, radius_m, limit=k)
+            if len(matches) >= k or radius_m >= max_radius_m:
+                return matches
+            radius_m = min(radius_m * 2, max_radius_m)
+
+
+# =====================
+# SERVER
+# =====================
+
+def _parse_address(address):
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class _IndexRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        index = self.server.index
+        for raw in self.rfile:
+            try:
+                request = json.loads(raw)
+                op = request.get("op")
+                if op == "upsert":
+                    index.upsert(
+                        request["id"], request["lat"], request["lon"], request.get("trust", 0), request.get("seen"),
+                        request["service_area"] if "service_area" in request else AREA_AT_POSITION,
+                    )
+                    response = {"ok": True}
+                elif op == "remove":
+                    response = {"ok": True, "removed": index.remove(request["id"])}
+                elif op == "within":
+                    matches = index.within(
+                        request["lat"], request["lon"], request["radius_m"], request.get("limit"),
+                        request.get("region"), request.get("service_area"),
+                    )
+                    response = {"ok": True, "matches": [list(m) for m in matches]}
+                elif op == "nearest":
+                    matches = index.nearest(request["lat"], request["lon"], request["k"], request["radius_m"])
+                    response = {"ok": True, "matches": [list(m) for m in matches]}
+                elif op == "ping":
+                    response = {"ok": True, "size": len(index)}
+                else:
+                    response = {"ok": False, "error": f"unknown op {op!r}"}
+            except Exception as e:
+                logger.exception("runner index: failed handling request")
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def bind_server(address, handler_class):
+    """Threading stream server for a "unix:/path" or "host:port" address."""
+    family, bind_to = _parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind_to):
+            os.unlink(bind_to)
+        return _ThreadingUnixServer(bind_to, handler_class)
+    return _ThreadingTCPServer(bind_to, handler_class)
+
+
+def connect(address, timeout):
+    """Client socket connected to a `bind_server` address."""
+    family, target = _parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(target)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def make_index_server(index, address):
+    server = bind_server(address, _IndexRequestHandler)
+    server.index = index
+    return server
+
+
+def load_runner_rows(region=None):
+    """Current (runner_id, lat, lon, trust_score, seen_at) rows for every available runner with a
+    saved location, optionally only those in one region."""
+    from django.contrib.auth import get_user_model
+    from runners.presence import available_runners_q
+
+    User = get_user_model()
+    qs = User.objects.filter(available_runners_q(), profile__roles__name="RUNNER", location__isnull=False)
+    if region:
+        qs = qs.filter(location__region=region)
+    rows = qs.values_list("id", "location__latitude", "location__longitude", "profile__trust_score", "presence__last_heartbeat_at")
+    return ((runner_id, lat, lon, trust, seen.timestamp()) for runner_id, lat, lon, trust, seen in rows.iterator())
+
+
+# =====================
+# CLIENT
+# =====================
+
+class RunnerIndexClient:
+    """Per-thread connections to the index processes. Every call returns None when the index is
+    disabled or unreachable; after a failure that index is skipped for RUNNER_INDEX_RETRY_SECONDS.
+
+    Calls carrying a `region` go to that region's dedicated index when RUNNER_INDEX_REGION_ADDRESSES
+    lists one, and to RUNNER_INDEX_ADDRESS otherwise."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._down_until = {}
+
+    @property
+    def enabled(self):
+        return bool(getattr(settings, 'RUNNER_INDEX_ADDRESS', '') or getattr(settings, 'RUNNER_INDEX_REGION_ADDRESSES', {}))
+
+    def address_for(self, region=None):
+        if region:
+            address = getattr(settings, 'RUNNER_INDEX_REGION_ADDRESSES', {}).get(region)
+            if address:
+                return address
+        return getattr(settings, 'RUNNER_INDEX_ADDRESS', '')
+
+    def _connections(self):
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        return conns
+
+    def _connection(self, address):
+        conns = self._connections()
+        conn = conns.get(address)
+        if conn is None:
+            sock = connect(address, getattr(settings, 'RUNNER_INDEX_TIMEOUT_MS', 50) / 1000.0)
+            conn = (sock, sock.makefile("rb"))
+            conns[address] = conn
+        return conn
+
+    def _close(self, address=None):
+        """Drop this thread's connection to `address` (all of them when None)."""
+        conns = self._connections()
+        for addr in [address] if address is not None else list(conns):
+            conn = conns.pop(addr, None)
+            if conn:
+                try:
+                    conn[1].close()
+                    conn[0].close()
+                except OSError:
+                    pass
+
+    def _call(self, payload, region=None):
+        address = self.address_for(region)
+        if not address or time.monotonic() < self._down_until.get(address, 0.0):
+            return None
+        try:
+            sock, reader = self._connection(address)
+            sock.sendall((json.dumps(payload) + "\n").encode())
+            response = json.loads(reader.readline())
+        except (OSError, ValueError) as e:
+            self._close(address)
+            self._down_until[address] = time.monotonic() + getattr(settings, 'RUNNER_INDEX_RETRY_SECONDS', 30)
+            logger.warning("RunnerIndexClient: index %s unavailable (%s); falling back to database", address, e)
+            return None
+        if not response.get("ok"):
+            logger.warning("RunnerIndexClient: %s failed: %s", payload.get("op"), response.get("error"))
+            return None
+        return response
+
+    def upsert(self, runner_id, latitude, longitude, trust_score=0, region=None, seen_at=None, service_area=AREA_AT_POSITION):
+        payload = {"op": "upsert", "id": runner_id, "lat": latitude, "lon": longitude, "trust": trust_score}
+        if seen_at is not None:
+            payload["seen"] = seen_at
+        if service_area is not AREA_AT_POSITION:
+            payload["service_area"] = service_area
+        return self._call(payload, region) is not None
+
+    def remove(self, runner_id, region=None):
+        return self._call({"op": "remove", "id": runner_id}, region) is not None
+
+    def within(self, latitude, longitude, radius_m, limit=None, region=None, service_area=None):
+        """`region` picks the index process and, with `service_area`, filters the runners."""
+        payload = {"op": "within", "lat": latitude, "lon": longitude, "radius_m": radius_m, "limit": limit, "region": region}
+        if service_area is not None:
+            payload["service_area"] = service_area
+        response = self._call(payload, region)
+        return None if response is None else [RunnerMatch(*m) for m in response["matches"]]
+
+    def nearest(self, latitude, longitude, k, radius_m, region=None):
+        response = self._call({"op": "nearest", "lat": latitude, "lon": longitude, "k": k, "radius_m": radius_m}, region)
+        return None if response is None else [RunnerMatch(*m) for m in response["matches"]]
+
+
+runner_index = RunnerIndexClient()
+
+
+def publish_runner(user, location=None, seen_at=None):
+    """Push a runner's current location, trust score and last heartbeat (`seen_at`, epoch
+    seconds, default now) to the index (best effort). Callers only pass users holding the RUNNER
+    role."""
+    if not runner_index.enabled:
+        return
+    location = location or getattr(user, "location", None)
+    if location is None:
+        return
+    profile = getattr(user, "profile", None)
+    runner_index.upsert(
+        user.id, location.latitude, location.longitude, getattr(profile, "trust_score", 0) or 0,
+        region=getattr(location, "region", None) or region_for(location.latitude, location.longitude),
+        seen_at=seen_at,
+    )
+
+
+def republish_runners(runner_ids):
+    """Push the stored location, trust score, heartbeat and service area of those of `runner_ids`
+    who are available to the index again, e.g. after their service area was recomputed. Returns
+    the number published."""
+    from django.contrib.auth import get_user_model
+    from runners.presence import available_runners_q
+
+    if not runner_index.enabled or not runner_ids:
+        return 0
+    User = get_user_model()
+    rows = User.objects.filter(
+        available_runners_q(), profile__roles__name="RUNNER", location__isnull=False, id__in=list(runner_ids)
+    ).values_list(
+        "id", "location__latitude", "location__longitude", "profile__trust_score",
+        "presence__last_heartbeat_at", "location__region", "location__service_area_id",
+    )
+    published = 0
+    for runner_id, lat, lon, trust, seen, region, area_id in rows:
+        runner_index.upsert(
+            runner_id, lat, lon, trust or 0, region=region or region_for(lat, lon), seen_at=seen.timestamp(), service_area=area_id,
+        )
+        published += 1
+    return published
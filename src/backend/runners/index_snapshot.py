@@ -0,0 +1,229 @@
+"""Versioned binary snapshot of runner positions for warm-starting the runner index.
+
+Rebuilding the index from the database means scanning every runner's UserLocation, profile,
+roles and presence. Instead, `run_runner_index` writes the scan result to
+`RUNNER_INDEX_SNAPSHOT_PATH` on every resync (and `manage.py snapshot_runner_index` writes one on
+demand). A starting index maps the file, loads the rows that are still available, and catches up
+by re-reading only the runners whose location, presence or profile changed after the snapshot.
+
+File layout (little-endian): a 64-byte header followed by `count` packed ROW_DTYPE records.
+
+    magic "RIDX" | format u32 | version u64 (time_ns) | taken_at f64 (epoch s) | count u32 | padding
+
+Availability (online, recent heartbeat, spare capacity) is evaluated when the snapshot is loaded,
+not when it is written, so a runner whose heartbeat expired in between is left out.
+
+A region index (`run_runner_index --region`) keeps its own snapshot holding only that region's
+runners (`snapshot_path(region)`).
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
+
+# Optional NumPy import: without it snapshots are disabled and the index loads from the database
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from apps.locations.grid import region_for
+from apps.roles.models import Role
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+MAGIC = b"RIDX"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sIqdI")
+HEADER_SIZE = 64
+
+FLAG_RUNNER = 1
+FLAG_ONLINE = 2
+
+ROW_DTYPE = np.dtype([
+    ("id", "<i8"),
+    ("lat", "<f8"),
+    ("lon", "<f8"),
+    ("heartbeat", "<f8"),  # epoch seconds
+    ("trust", "<i2"),
+    ("active", "<i2"),  # in-progress errands
+    ("flags", "u1"),
+]) if np is not None else None
+
+_ROW_FIELDS = (
+    "id",
+    "location__latitude",
+    "location__longitude",
+    "profile__trust_score",
+    "presence__is_online",
+    "presence__last_heartbeat_at",
+    "presence__active_errand_count",
+)
+
+
+def snapshot_path(region=None):
+    """RUNNER_INDEX_SNAPSHOT_PATH, with the region inserted before the extension for region indexes."""
+    path = getattr(settings, 'RUNNER_INDEX_SNAPSHOT_PATH', '')
+    if not path or not region:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{region.replace(':', '_')}{ext}"
+
+
+def snapshot_rows(changed_since=None, region=None):
+    """Rows for every runner with a saved location, as tuples of `_ROW_FIELDS`. With
+    `changed_since`, only runners whose location, presence or profile changed after it; with
+    `region`, only runners located in that region."""
+    qs = User.objects.filter(profile__roles__name=Role.RUNNER, location__isnull=False)
+    if region:
+        qs = qs.filter(location__region=region)
+    if changed_since is not None:
+        qs = qs.filter(
+            Q(location__updated_at__gt=changed_since)
+            | Q(presence__updated_at__gt=changed_since)
+            | Q(profile__updated_at__gt=changed_since)
+        )
+    return qs.values_list(*_ROW_FIELDS).distinct().iterator()
+
+
+def _to_records(rows):
+    records = []
+    for runner_id, lat, lon, trust, online, heartbeat, active in rows:
+        flags = FLAG_RUNNER | (FLAG_ONLINE if online else 0)
+        records.append((runner_id, lat, lon, heartbeat.timestamp() if heartbeat else 0.0, trust or 0, active or 0, flags))
+    return np.array(records, dtype=ROW_DTYPE)
+
+
+def write_snapshot(path, rows, taken_at):
+    """Write `snapshot_rows()` output read at `taken_at` (taken *before* the query started, so
+    the catch-up after loading covers writes made during the scan). Atomic: readers see either
+    the previous file or the complete new one."""
+    records = _to_records(rows)
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, time.time_ns(), taken_at.timestamp(), len(records))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as fh:
+        fh.write(header.ljust(HEADER_SIZE, b"\0"))
+        fh.write(records.tobytes())
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+    logger.info("write_snapshot: %s runners written to %s", len(records), path)
+    return len(records)
+
+
+class RunnerSnapshot:
+    """A snapshot file mapped read-only; `records` is a zero-copy view of the rows."""
+
+    def __init__(self, path):
+        with open(path, "rb") as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.version, taken_at, count = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a runner index snapshot (format {fmt})")
+        self.taken_at = datetime.fromtimestamp(taken_at, tz=dt_timezone.utc)
+        self.records = np.frombuffer(self._mmap, dtype=ROW_DTYPE, count=count, offset=HEADER_SIZE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def available_rows(self, now=None):
+        """(runner_id, lat, lon, trust, heartbeat) of runners available at `now`, same rules as
+        `presence.available_runners_q`."""
+        now = now or timezone.now()
+        cutoff = (now - timedelta(seconds=getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300))).timestamp()
+        r = self.records
+        mask = (
+            ((r["flags"] & (FLAG_RUNNER | FLAG_ONLINE)) == (FLAG_RUNNER | FLAG_ONLINE))
+            & (r["heartbeat"] >= cutoff)
+            & (r["active"] < getattr(settings, 'RUNNER_MAX_ACTIVE_ERRANDS', 1))
+        )
+        selected = r[mask]
+        return zip(
+            selected["id"].tolist(), selected["lat"].tolist(), selected["lon"].tolist(),
+            selected["trust"].tolist(), selected["heartbeat"].tolist(),
+        )
+
+    def close(self):
+        self.records = None
+        self._mmap.close()
+
+
+def _is_available(online, heartbeat, active, now):
+    cutoff = now - timedelta(seconds=getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300))
+    return bool(online) and heartbeat is not None and heartbeat >= cutoff and (active or 0) < getattr(settings, 'RUNNER_MAX_ACTIVE_ERRANDS', 1)
+
+
+def catch_up(index, since, region=None):
+    """Apply changes made after `since` to the index. Returns the number of runners re-read.
+    Runners that left `region` are removed, so the changed rows are read for every region."""
+    now = timezone.now()
+    # Allow for clock skew between the writer and the database
+    since = since - timedelta(seconds=getattr(settings, 'RUNNER_INDEX_SNAPSHOT_SKEW_SECONDS', 5))
+    count = 0
+    for runner_id, lat, lon, trust, online, heartbeat, active in snapshot_rows(changed_since=since):
+        if _is_available(online, heartbeat, active, now) and (not region or region_for(lat, lon) == region):
+            index.upsert(runner_id, lat, lon, trust or 0, heartbeat.timestamp())
+        else:
+            index.remove(runner_id)
+        count += 1
+    return count
+
+
+def warm_start(index, path, region=None):
+    """Load the index from the snapshot at `path` and catch up. Returns False (index untouched)
+    when there is no usable snapshot, so the caller can fall back to a full database load."""
+    if np is None or not path or not os.path.exists(path):
+        return False
+    started = time.monotonic()
+    try:
+        snapshot = RunnerSnapshot(path)
+    except (OSError, ValueError, struct.error):
+        logger.exception("warm_start: unreadable snapshot %s", path)
+        return False
+
+    try:
+        max_age = getattr(settings, 'RUNNER_INDEX_SNAPSHOT_MAX_AGE_SECONDS', 3600)
+        if (timezone.now() - snapshot.taken_at).total_seconds() > max_age:
+            logger.info("warm_start: snapshot %s is older than %ss; ignoring", path, max_age)
+            return False
+        index.replace_all(snapshot.available_rows())
+        loaded = time.monotonic()
+        changed = catch_up(index, snapshot.taken_at, region)
+    finally:
+        snapshot.close()
+    logger.info(
+        "warm_start: %s runners from snapshot in %.1f ms, %s caught up in %.1f ms",
+        len(index), (loaded - started) * 1000, changed, (time.monotonic() - loaded) * 1000,
+    )
+    return True
+
+
+def rebuild(index, path=None, region=None):
+    """Full database load of the index; also writes the snapshot when `path` is set. One scan
+    serves both."""
+    taken_at = timezone.now()
+    rows = list(snapshot_rows(region=region))
+    now = timezone.now()
+    index.replace_all(
+        (runner_id, lat, lon, trust or 0, heartbeat.timestamp())
+        for runner_id, lat, lon, trust, online, heartbeat, active in rows
+        if _is_available(online, heartbeat, active, now)
+    )
+    if path and np is not None:
+        try:
+            write_snapshot(path, rows, taken_at)
+        except OSError:
+            logger.exception("rebuild: failed writing snapshot %s", path)
+    return len(index)
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from runners.services import np
+from runners.travel import build_travel_matrix, load_osm_graph, reset_travel_provider, write_travel_matrix
+
+
+class Command(BaseCommand):
+    help = (
+        "Precompute the cell-to-cell road distance/ETA matrix used by the travel provider from an "
+        "OSM XML extract (convert .pbf extracts with `osmium cat extract.pbf -o extract.osm`)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("osm_file", help="Path to the .osm extract")
+        parser.add_argument(
+            "--bbox",
+            required=True,
+            help="Area covered by the matrix: min_lat,min_lon,max_lat,max_lon",
+        )
+        parser.add_argument(
+            "--cell-deg",
+            type=float,
+            default=None,
+            help="Matrix cell size in degrees (default TRAVEL_MATRIX_CELL_DEG)",
+        )
+        parser.add_argument("--out", default=None, help="Output directory (default TRAVEL_MATRIX_DIR)")
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("NumPy is required to build the travel matrix")
+        try:
+            min_lat, min_lon, max_lat, max_lon = (float(v) for v in options["bbox"].split(","))
+        except ValueError:
+            raise CommandError("--bbox must be min_lat,min_lon,max_lat,max_lon")
+        cell_deg = options["cell_deg"] or getattr(settings, "TRAVEL_MATRIX_CELL_DEG", 0.005)
+        out = options["out"] or str(getattr(settings, "TRAVEL_MATRIX_DIR", ""))
+        if not out:
+            raise CommandError("TRAVEL_MATRIX_DIR is not set; pass --out")
+
+        coords, adjacency = load_osm_graph(options["osm_file"])
+        self.stdout.write(f"Loaded road graph: {len(coords)} nodes")
+
+        def progress(done, total):
+            if done == total or done % 100 == 0:
+                self.stdout.write(f"  {done}/{total} cells")
+
+        meta, distances, etas = build_travel_matrix(
+            coords, adjacency, min_lat, min_lon, max_lat, max_lon, cell_deg, progress=progress
+        )
+        write_travel_matrix(out, meta, distances, etas)
+        reset_travel_provider()
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {meta['rows']}x{meta['cols']} cell matrix to {out}; restart workers to load it"
+        ))
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from runners.acceptance import fit_acceptance, offer_history, reset_acceptance_table, write_table
+from runners.services import np
+
+
+class Command(BaseCommand):
+    help = (
+        "Fit per-runner offer acceptance probabilities from resolved ErrandOffer history and "
+        "publish the score table used to rank matching candidates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=None,
+            help="History window in days (default RUNNER_ACCEPTANCE_LOOKBACK_DAYS)",
+        )
+        parser.add_argument("--out", default=None, help="Output file (default RUNNER_ACCEPTANCE_TABLE_PATH)")
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("NumPy is required to fit acceptance scores")
+        out = options["out"] or str(getattr(settings, "RUNNER_ACCEPTANCE_TABLE_PATH", ""))
+        if not out:
+            raise CommandError("RUNNER_ACCEPTANCE_TABLE_PATH is not set; pass --out")
+
+        runner_ids, accepted, latency_s, age_s = offer_history(days=options["days"])
+        if not runner_ids:
+            raise CommandError("No resolved offers in the history window; nothing to fit")
+        ids, probabilities, p_all = fit_acceptance(runner_ids, accepted, latency_s, age_s)
+        write_table(out, ids, probabilities, p_all)
+        reset_acceptance_table()
+        self.stdout.write(self.style.SUCCESS(
+            f"Fitted {len(ids)} runners from {len(runner_ids)} offers (overall acceptance {p_all:.1%}); wrote {out}"
+        ))
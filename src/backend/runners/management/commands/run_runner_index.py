@@ -0,0 +1,72 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from runners.index import RunnerIndex, make_index_server, runner_index
+from runners.index_snapshot import rebuild, snapshot_path, warm_start
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Serve the in-memory runner position index on RUNNER_INDEX_ADDRESS for all web workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--address", default=None, help="Override RUNNER_INDEX_ADDRESS")
+        parser.add_argument(
+            "--region",
+            default=None,
+            help="Only index runners in this region (serve it on its RUNNER_INDEX_REGION_ADDRESSES entry)",
+        )
+        parser.add_argument(
+            "--resync-seconds",
+            type=int,
+            default=None,
+            help="Full rebuild interval from the database (default RUNNER_INDEX_RESYNC_SECONDS, 0 disables)",
+        )
+
+    def handle(self, *args, **options):
+        region = options["region"]
+        address = options["address"] or runner_index.address_for(region)
+        if not address:
+            raise CommandError("RUNNER_INDEX_ADDRESS is not set")
+
+        resync_seconds = options["resync_seconds"]
+        if resync_seconds is None:
+            resync_seconds = getattr(settings, "RUNNER_INDEX_RESYNC_SECONDS", 300)
+
+        path = snapshot_path(region)
+        index = RunnerIndex()
+        if warm_start(index, path, region):
+            self.stdout.write(f"Warm-started {len(index)} runners from {path}; serving on {address}")
+        else:
+            rebuild(index, path, region)
+            self.stdout.write(f"Loaded {len(index)} runners; serving on {address}")
+
+        if resync_seconds:
+            # Incremental updates are best effort; a periodic rebuild repairs anything missed
+            # while the index was down or a worker could not reach it.
+            stop = threading.Event()
+
+            def resync():
+                while not stop.wait(resync_seconds):
+                    try:
+                        close_old_connections()
+                        # The same scan refreshes the snapshot the next process warm-starts from
+                        rebuild(index, path, region)
+                        logger.info("run_runner_index: resynced %s runners", len(index))
+                    except Exception:
+                        logger.exception("run_runner_index: resync failed")
+
+            threading.Thread(target=resync, daemon=True).start()
+
+        server = make_index_server(index, address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from runners.index_snapshot import np, snapshot_path, snapshot_rows, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Write the runner index snapshot that run_runner_index warm-starts from."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default=None, help="Override RUNNER_INDEX_SNAPSHOT_PATH")
+        parser.add_argument("--region", default=None, help="Snapshot for a region index (run_runner_index --region)")
+
+    def handle(self, *args, **options):
+        region = options["region"]
+        path = options["out"] or snapshot_path(region)
+        if not path:
+            raise CommandError("RUNNER_INDEX_SNAPSHOT_PATH is not set")
+        if np is None:
+            raise CommandError("NumPy is required to write runner index snapshots")
+
+        taken_at = timezone.now()
+        count = write_snapshot(path, snapshot_rows(region=region), taken_at)
+        self.stdout.write(f"Wrote {count} runners to {path}")
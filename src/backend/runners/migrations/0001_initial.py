@@ -0,0 +1,63 @@
+# Generated by Django 6.0.1 on 2026-10-17 03:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_presence(apps, schema_editor):
+    """Existing runners start online, last seen when their location was last saved."""
+    UserLocation = apps.get_model('locations', 'UserLocation')
+    RunnerPresence = apps.get_model('runners', 'RunnerPresence')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+
+    runners = (
+        User.objects
+        .filter(profile__roles__name='RUNNER')
+        .annotate(active=Count('accepted_errands', filter=Q(accepted_errands__status='IN_PROGRESS')))
+    )
+    seen = dict(UserLocation.objects.values_list('user_id', 'updated_at'))
+    RunnerPresence.objects.bulk_create(
+        [
+            RunnerPresence(
+                user_id=runner.id,
+                last_heartbeat_at=seen.get(runner.id) or django.utils.timezone.now(),
+                active_errand_count=runner.active,
+            )
+            for runner in runners
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('errands', '0001_initial'),
+        ('locations', '0002_userlocation_grid_cell'),
+        ('roles', '0001_initial'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunnerPresence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_online', models.BooleanField(default=True)),
+                ('last_heartbeat_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('active_errand_count', models.PositiveSmallIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='presence', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['is_online', 'last_heartbeat_at', 'active_errand_count'], name='runner_presence_avail_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_presence, migrations.RunPython.noop),
+    ]
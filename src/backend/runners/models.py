@@ -1,3 +1,29 @@
+from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+User = get_user_model()
+
+
+class RunnerPresence(models.Model):
+    """Compact availability row per runner, filtered on in SQL by matching.
+
+    A runner is matchable when online, seen within RUNNER_PRESENCE_TIMEOUT_SECONDS and holding
+    fewer than RUNNER_MAX_ACTIVE_ERRANDS in-progress errands.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="presence")
+
+    is_online = models.BooleanField(default=True)
+    last_heartbeat_at = models.DateTimeField(default=timezone.now)
+    active_errand_count = models.PositiveSmallIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["is_online", "last_heartbeat_at", "active_errand_count"], name="runner_presence_avail_idx"),
+        ]
+
+    def __str__(self):
+        state = "online" if self.is_online else "offline"
+        return f"Presence({self.user_id}, {state}, active={self.active_errand_count})"
@@ -0,0 +1,119 @@
+"""Per-runner offer caps kept in the cache, so the runners closest to busy areas are not sent an
+offer for every errand.
+
+Two limits, both checked by `send_errand_offer` without querying ErrandOffer:
+
+- RUNNER_MAX_PENDING_OFFERS concurrent pending offers. Each pending offer holds one of the
+  runner's numbered slot keys, taken with `cache.add` (atomic in Redis and LocMem). A slot is
+  given back when the offer is accepted, rejected or expired by the errand. It also frees itself
+  when the offer's TTL runs out, so a lost release costs at most one TTL.
+- RUNNER_MAX_OFFERS_PER_MINUTE new offers per runner per clock minute: a `cache.incr` counter
+  per runner and minute.
+
+Either limit set to 0 disables it. Matching skips saturated runners (`saturated_runners`) and
+moves on to the next-best candidates.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+SLOT_KEY = "runners:offer-slot:{runner_id}:{slot}"
+HELD_KEY = "runners:offer-held:{runner_id}:{errand_id}"
+RATE_KEY = "runners:offer-rate:{runner_id}:{minute}"
+
+
+def _limits():
+    return (
+        int(getattr(settings, 'RUNNER_MAX_PENDING_OFFERS', 3)),
+        int(getattr(settings, 'RUNNER_MAX_OFFERS_PER_MINUTE', 6)),
+    )
+
+
+def _slot_keys(runner_id, max_pending):
+    return [SLOT_KEY.format(runner_id=runner_id, slot=slot) for slot in range(max_pending)]
+
+
+def _rate_key(runner_id, now=None):
+    return RATE_KEY.format(runner_id=runner_id, minute=int((now or timezone.now().timestamp()) // 60))
+
+
+def _take_slot(runner_id, errand_id, max_pending, ttl_seconds):
+    held_key = HELD_KEY.format(runner_id=runner_id, errand_id=errand_id)
+    keys = _slot_keys(runner_id, max_pending)
+    taken = cache.get_many(keys)
+    for key in keys:
+        if key not in taken and cache.add(key, errand_id, timeout=ttl_seconds):
+            cache.set(held_key, key, timeout=ttl_seconds)
+            return key
+    return None
+
+
+def reserve_offer(runner_id, errand_id, ttl_seconds):
+    """Claim capacity for offering `errand_id` to the runner. Returns False (nothing claimed)
+    when the runner is at either cap. Re-offering an errand the runner already holds a slot for
+    only extends that slot."""
+    max_pending, per_minute = _limits()
+    held_key = HELD_KEY.format(runner_id=runner_id, errand_id=errand_id)
+    slot_key = cache.get(held_key)
+    if slot_key is not None:
+        cache.touch(slot_key, ttl_seconds)
+        cache.touch(held_key, ttl_seconds)
+        return True
+
+    if max_pending:
+        slot_key = _take_slot(runner_id, errand_id, max_pending, ttl_seconds)
+        if slot_key is None:
+            logger.info("reserve_offer: runner=%s already has %s pending offers", runner_id, max_pending)
+            return False
+
+    if per_minute:
+        rate_key = _rate_key(runner_id)
+        cache.add(rate_key, 0, timeout=120)
+        try:
+            sent = cache.incr(rate_key)
+        except ValueError:  # evicted between add and incr
+            cache.set(rate_key, 1, timeout=120)
+            sent = 1
+        if sent > per_minute:
+            logger.info("reserve_offer: runner=%s reached %s offers this minute", runner_id, per_minute)
+            release_offer(runner_id, errand_id)
+            return False
+    return True
+
+
+def release_offer(runner_id, errand_id):
+    """Give back the slot held for `errand_id` (offer accepted, rejected or expired)."""
+    held_key = HELD_KEY.format(runner_id=runner_id, errand_id=errand_id)
+    slot_key = cache.get(held_key)
+    if slot_key is None:
+        return
+    # The slot may have timed out and been taken for another errand since
+    if cache.get(slot_key) == errand_id:
+        cache.delete(slot_key)
+    cache.delete(held_key)
+
+
+def release_errand_offers(errand_id, runner_ids):
+    for runner_id in runner_ids:
+        release_offer(runner_id, errand_id)
+
+
+def saturated_runners(runner_ids):
+    """Ids among `runner_ids` that are at either cap, from one `get_many`."""
+    runner_ids = list(runner_ids)
+    max_pending, per_minute = _limits()
+    if not runner_ids or not (max_pending or per_minute):
+        return set()
+    slot_keys = {runner_id: _slot_keys(runner_id, max_pending) for runner_id in runner_ids}
+    now = timezone.now().timestamp()
+    rate_keys = {runner_id: _rate_key(runner_id, now) for runner_id in runner_ids}
+    values = cache.get_many([key for keys in slot_keys.values() for key in keys] + list(rate_keys.values()))
+    return {
+        runner_id for runner_id in runner_ids
+        if (max_pending and all(key in values for key in slot_keys[runner_id]))
+        or (per_minute and values.get(rate_keys[runner_id], 0) >= per_minute)
+    }
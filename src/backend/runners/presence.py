@@ -0,0 +1,114 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+
+from runners.index import publish_runner, runner_index
+from runners.models import RunnerPresence
+from apps.locations.grid import grid_cell_for, region_for
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_VERSION_KEY = "runners:presence-version:{user_id}"
+
+
+def available_runners_q(now=None):
+    """Q filter on User rows keeping online runners with a recent heartbeat and spare capacity.
+
+    RUNNER_MAX_ACTIVE_ERRANDS governs regular matching only: a runner at that many in-progress
+    errands gets further errands solely through route chaining, which checks its own cap
+    (ERRAND_CHAIN_MAX_ACTIVE_ERRANDS, see apps.errands.chaining)."""
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300))
+    return Q(
+        presence__is_online=True,
+        presence__last_heartbeat_at__gte=cutoff,
+        presence__active_errand_count__lt=getattr(settings, 'RUNNER_MAX_ACTIVE_ERRANDS', 1),
+    )
+
+
+def is_available(presence, now=None):
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'RUNNER_PRESENCE_TIMEOUT_SECONDS', 300))
+    return (
+        presence.is_online
+        and presence.last_heartbeat_at >= cutoff
+        and presence.active_errand_count < getattr(settings, 'RUNNER_MAX_ACTIVE_ERRANDS', 1)
+    )
+
+
+def record_heartbeat(user):
+    """Mark the runner as seen now. The row is rewritten at most every
+    RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS so frequent pings stay cheap."""
+    now = timezone.now()
+    presence, created = RunnerPresence.objects.get_or_create(user=user, defaults={"last_heartbeat_at": now})
+    interval = timedelta(seconds=getattr(settings, 'RUNNER_HEARTBEAT_WRITE_INTERVAL_SECONDS', 15))
+    if not created and presence.last_heartbeat_at <= now - interval:
+        presence.last_heartbeat_at = now
+        presence.save(update_fields=["last_heartbeat_at", "updated_at"])
+    return presence
+
+
+def presence_version(user_id):
+    """Counter bumped on every availability change, so processes caching a runner's
+    availability (the location ping buffer) know when to re-read it."""
+    return cache.get(PRESENCE_VERSION_KEY.format(user_id=user_id)) or 0
+
+
+def _bump_presence_version(user_id):
+    key = PRESENCE_VERSION_KEY.format(user_id=user_id)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted between add and incr
+        cache.set(key, 1, timeout=None)
+
+
+def _availability_changed(user):
+    """Propagate a presence change to the nearby-runner snapshots and the shared index."""
+    from runners.snapshots import touch_runner_cells
+
+    _bump_presence_version(user.id)
+    location = getattr(user, "location", None)
+    if location is None:
+        return
+    touch_runner_cells(grid_cell_for(location.latitude, location.longitude))
+    presence = RunnerPresence.objects.filter(user=user).first()
+    if presence is not None and is_available(presence):
+        publish_runner(user, location, seen_at=presence.last_heartbeat_at.timestamp())
+    elif runner_index.enabled:
+        runner_index.remove(user.id, region=location.region or region_for(location.latitude, location.longitude))
+
+
+def set_online(user, online):
+    now = timezone.now()
+    defaults = {"is_online": online}
+    if online:
+        defaults["last_heartbeat_at"] = now
+    RunnerPresence.objects.update_or_create(user=user, defaults=defaults)
+    logger.info("set_online: runner=%s online=%s", getattr(user, 'id', None), online)
+    _availability_changed(user)
+
+
+def errand_started(runner):
+    """A runner accepted an errand: count it against their capacity."""
+    # update() skips auto_now: set updated_at so index snapshots catch the change up
+    updated = RunnerPresence.objects.filter(user=runner).update(
+        active_errand_count=F("active_errand_count") + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        RunnerPresence.objects.create(user=runner, active_errand_count=1)
+    _availability_changed(runner)
+
+
+def errand_finished(runner):
+    """An in-progress errand was completed, cancelled or deleted: free the runner's capacity."""
+    if runner is None:
+        return
+    RunnerPresence.objects.filter(user=runner, active_errand_count__gt=0).update(
+        active_errand_count=F("active_errand_count") - 1, updated_at=timezone.now()
+    )
+    _availability_changed(runner)
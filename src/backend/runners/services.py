@@ -1,7 +1,22 @@
 import logging
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
 from math import radians, sin, cos, sqrt, atan2
 
+# Optional NumPy import: distances_from falls back to a pure-Python loop without it
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from apps.locations.grid import EARTH_RADIUS_M, bounding_box, grid_cells_within, region_for
+from apps.locations.service_areas import has_service_areas, service_area_for
+from runners.index import RunnerMatch, rank_matches, runner_index
+from runners.presence import available_runners_q
+
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
@@ -54,50 +69,231 @@ def distance_between(location, go_to):
         return float("inf")
 
 
-def get_nearby_runners(errand):
+def _point_coords(point):
+    """(lat, lon) floats from an object with .latitude/.longitude or a (lat, lon) tuple."""
+    if hasattr(point, "latitude") and hasattr(point, "longitude"):
+        return float(point.latitude), float(point.longitude)
+    return float(point[0]), float(point[1])
+
+
+def distances_from(point, lats, lons):
+    """Haversine distances in meters from `point` to every (lats[i], lons[i]) pair, in the same order.
+
+    Batch counterpart of `distance_between` for ranking many runners against one errand: all
+    distances are computed in one vectorized NumPy pass (returns a float64 array). Missing
+    coordinates yield inf, like the scalar function.
     """
-    Returns runners ordered by:
+    lat1, lon1 = _point_coords(point)
+
+    if np is None:  # pragma: no cover
+        return [
+            distance_between((lat1, lon1), (lat, lon)) if lat is not None and lon is not None else float("inf")
+            for lat, lon in zip(lats, lons)
+        ]
+
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons, dtype=np.float64))
+    phi1 = np.radians(lat1)
+
+    a = np.sin((lat2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(lat2) * np.sin((lon2 - np.radians(lon1)) / 2) ** 2
+    dist = 2 * EARTH_RADIUS_M * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    dist[np.isnan(dist)] = np.inf
+    return dist
+
+
+def pairwise_distances(lats1, lons1, lats2, lons2):
+    """Haversine distance matrix in meters: result[i, j] is the distance from (lats1[i], lons1[i])
+    to (lats2[j], lons2[j]). Requires NumPy; used by the batch matcher on chunks of errands."""
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lon1 = np.radians(np.asarray(lons1, dtype=np.float64))[:, None]
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    lon2 = np.radians(np.asarray(lons2, dtype=np.float64))[None, :]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    dist = 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(np.sqrt(a), 1.0))
+    dist[np.isnan(dist)] = np.inf
+    return dist
+
+
+def _within_search_area(runners_qs, go_to, radius_m):
+    """Restrict a User queryset to runners whose location lies in the grid cells (or, for very
+    large radii, the bounding box) covering `radius_m` meters around `go_to`."""
+    cells = grid_cells_within(go_to.latitude, go_to.longitude, radius_m)
+    if cells is not None:
+        return runners_qs.filter(location__grid_cell__in=cells)
+
+    min_lat, max_lat, min_lon, max_lon = bounding_box(go_to.latitude, go_to.longitude, radius_m)
+    return runners_qs.filter(
+        location__latitude__range=(min_lat, max_lat),
+        location__longitude__range=(min_lon, max_lon),
+    )
+
+
+def errand_region(go_to):
+    """Matching region of an errand's go_to (stored on ErrandLocation, derived for tuples and
+    unsaved rows)."""
+    return getattr(go_to, "region", None) or region_for(*_point_coords(go_to))
+
+
+def errand_service_area(go_to):
+    """Service area id of an errand's go_to (stored on ErrandLocation, looked up for tuples and
+    unsaved rows); None outside every area."""
+    if getattr(go_to, "pk", None) is not None:
+        return go_to.service_area_id
+    return service_area_for(*_point_coords(go_to))
+
+
+def _candidate_runners(go_to, radius_m):
+    """Available runners (online, recently seen, with spare capacity) located in the search area,
+    the errand's region and its service area."""
+    runners = User.objects.filter(
+        available_runners_q(),
+        profile__roles__name="RUNNER",
+        location__isnull=False,
+        location__region=errand_region(go_to),
+    )
+    service_area_id = errand_service_area(go_to)
+    if service_area_id is not None:
+        runners = runners.filter(location__service_area_id=service_area_id)
+    return _within_search_area(runners, go_to, radius_m)
+
+
+def haversine_expression(latitude, longitude, lat_field="location__latitude", lon_field="location__longitude"):
+    """Database expression for the Haversine distance in meters from (latitude, longitude) to the
+    row's coordinates. Built from portable functions available on Postgres and on SQLite (Django
+    registers the math functions on SQLite connections)."""
+    dphi = Radians(F(lat_field) - Value(float(latitude))) / 2
+    dlambda = Radians(F(lon_field) - Value(float(longitude))) / 2
+    a = Power(Sin(dphi), 2) + Value(cos(radians(float(latitude)))) * Cos(Radians(F(lat_field))) * Power(Sin(dlambda), 2)
+    # Least() guards asin against rounding pushing sqrt(a) just above 1 for antipodal points
+    return ExpressionWrapper(
+        Value(2.0 * EARTH_RADIUS_M) * ASin(Least(Sqrt(a), Value(1.0))),
+        output_field=FloatField(),
+    )
+
+
+def _match_runners_db(go_to, radius_m, limit):
+    """Best `limit` RunnerMatch rows with distance, radius filter, ordering and LIMIT done in SQL,
+    so only the top rows cross the wire."""
+    qs = (
+        _candidate_runners(go_to, radius_m)
+        .annotate(distance_m=haversine_expression(go_to.latitude, go_to.longitude))
+        .filter(distance_m__lte=radius_m)
+        .order_by("distance_m", "-profile__trust_score")
+        .values_list("id", "location__latitude", "location__longitude", "profile__trust_score", "distance_m")
+    )
+    if limit:
+        qs = qs[:limit]
+    return [RunnerMatch(runner_id, lat, lon, trust or 0, dist) for runner_id, lat, lon, trust, dist in qs]
+
+
+def _match_runners_orm(go_to, radius_m, limit):
+    """Best `limit` RunnerMatch rows ranked in Python from plain column values (no User/profile/
+    location instances are built)."""
+    rows = _candidate_runners(go_to, radius_m).values_list(
+        "id", "location__latitude", "location__longitude", "profile__trust_score"
+    )
+
+    rows = list(rows)
+    if not rows:
+        return []
+    ids, lats, lons, trusts = zip(*rows)
+    dists = distances_from(go_to, lats, lons)
+
+    # Cells are square, the search area is a circle: drop the corners before ranking
+    matches = [
+        RunnerMatch(runner_id, lat, lon, trust or 0, float(dist))
+        for runner_id, lat, lon, trust, dist in zip(ids, lats, lons, trusts, dists)
+        if dist <= radius_m
+    ]
+
+    # Distance asc, trust desc; partial selection when only the top `limit` are needed
+    return rank_matches(matches, limit)
+
+
+def find_nearby_runners(errand, max_distance_m=None, limit=None):
+    """
+    Returns up to `limit` RunnerMatch(runner_id, latitude, longitude, trust_score, distance_m) rows
+    for runners within `max_distance_m` of the errand's go_to and in its region and service area,
+    ordered by:
     1. Distance (ascending)
     2. Trust score (descending)
+    or, once `fit_acceptance_scores` has published a table, by distance combined with each
+    runner's acceptance probability (see runners.acceptance), then trust.
 
-    This function fetches candidate users with a non-null `location` and sorts them in Python
-    using the `distance_between` helper because the database does not use geo indexes.
+    Defaults come from `RUNNER_SEARCH_RADIUS_M` and `RUNNER_MATCH_LIMIT` (0 means no limit).
+    When the travel provider knows road distances, `distance_m` is the runner's road distance to
+    the errand and ranking uses it.
+    Served by the shared in-memory runner index when it is reachable. Otherwise candidates are
+    prefiltered on the indexed `UserLocation.grid_cell` key and ranked either in SQL
+    (`RUNNER_DISTANCE_BACKEND = "db"`, the default) or in Python, which is also the fallback when
+    the database cannot evaluate the distance expression.
     """
-    logger.info("get_nearby_runners: computing candidates for errand=%s", getattr(errand, 'id', None))
-    # Select candidates who have the RUNNER role and a saved location
-    runners_qs = (
-        User.objects
-        .filter(profile__roles__name="RUNNER", location__isnull=False)
-        .select_related("location", "profile")
-    )
+    go_to = getattr(errand, 'go_to', None)
+    if go_to is None:
+        logger.info("find_nearby_runners: errand=%s has no go_to; no candidates", getattr(errand, 'id', None))
+        return []
 
-    # Log how many users matched the DB filter and sample ids
-    try:
-        total_candidates = runners_qs.count()
-        sample_ids = list(runners_qs.values_list('id', flat=True)[:10])
-        logger.info("get_nearby_runners: DB matched %s users with RUNNER role and location. sample_ids=%s", total_candidates, sample_ids)
-    except Exception:
-        logger.exception("get_nearby_runners: failed to inspect candidate queryset")
-
-    # Prepare list with computed distances
-    runners_with_distance = []
-    for r in runners_qs:
+    service_area_id = errand_service_area(go_to)
+    if service_area_id is None and has_service_areas():
+        logger.info("find_nearby_runners: errand=%s is outside every service area; no candidates", getattr(errand, 'id', None))
+        return []
+
+    radius_m = max_distance_m if max_distance_m is not None else getattr(settings, 'RUNNER_SEARCH_RADIUS_M', 10000)
+    if limit is None:
+        limit = getattr(settings, 'RUNNER_MATCH_LIMIT', 20)
+
+    from runners.acceptance import get_acceptance_table  # both build on the helpers above
+    from runners.travel import get_travel_provider
+
+    # Candidates are selected by straight-line distance; with a road-distance provider or an
+    # acceptance table a wider set is fetched and re-ranked
+    provider = get_travel_provider()
+    acceptance = get_acceptance_table()
+    rerank = provider.name != "haversine"
+    widen = rerank or acceptance is not None
+    fetch_limit = limit * getattr(settings, 'TRAVEL_RERANK_FACTOR', 3) if widen and limit else limit
+
+    region = errand_region(go_to)
+    # A shared index holds every region and zone: it filters them before taking the best `fetch_limit`
+    matches = runner_index.within(go_to.latitude, go_to.longitude, radius_m, fetch_limit, region=region, service_area=service_area_id)
+    source = "index"
+    if matches is None and getattr(settings, 'RUNNER_DISTANCE_BACKEND', 'db') == 'db':
         try:
-            dist = distance_between(r.location, errand.go_to)
-            trust = getattr(r.profile, "trust_score", 0)
-        except Exception as e:
-            logger.exception("get_nearby_runners: failed for runner=%s: %s", getattr(r, 'id', None), e)
-            dist = float("inf")
-            trust = 0
-        runners_with_distance.append((r, dist, trust))
-
-    # Sort by distance asc, trust desc
-    runners_with_distance.sort(key=lambda t: (t[1], -t[2]))
-
-    # Log sorted list
-    logger.info("get_nearby_runners: sorted %s candidates for errand=%s", len(runners_with_distance), getattr(errand, 'id', None))
-    for r, dist, trust in runners_with_distance:
-        logger.debug("candidate runner=%s dist_m=%s trust=%s", getattr(r, 'id', None), dist, trust)
-
-    # Return only user objects in order
-    return [t[0] for t in runners_with_distance]
+            matches = _match_runners_db(go_to, radius_m, fetch_limit)
+            source = "db"
+        except DatabaseError:
+            logger.exception("find_nearby_runners: SQL distance ranking failed; falling back to Python")
+    if matches is None:
+        matches = _match_runners_orm(go_to, radius_m, fetch_limit)
+        source = "python"
+
+    if rerank:
+        matches = _rank_by_travel_distance(provider, go_to, matches, None if acceptance is not None else limit)
+    if acceptance is not None:
+        matches = acceptance.rank(matches, limit)
+
+    logger.info("find_nearby_runners: %s candidates for errand=%s (source=%s)", len(matches), getattr(errand, 'id', None), source)
+    for m in matches:
+        logger.debug("candidate runner=%s dist_m=%s trust=%s", m.runner_id, m.distance_m, m.trust_score)
+    return matches
+
+
+def _rank_by_travel_distance(provider, go_to, matches, limit):
+    if not matches:
+        return matches
+    dists = provider.distances_from(go_to, [m.latitude for m in matches], [m.longitude for m in matches])
+    return rank_matches([m._replace(distance_m=float(d)) for m, d in zip(matches, dists)], limit)
+
+
+def hydrate_runners(matches):
+    """User objects (with location and profile) for RunnerMatch rows, in the same order."""
+    if not matches:
+        return []
+    users = User.objects.select_related("location", "profile").in_bulk([m.runner_id for m in matches])
+    return [users[m.runner_id] for m in matches if m.runner_id in users]
+
+
+def get_nearby_runners(errand, max_distance_m=None, limit=None):
+    """Same ranking as `find_nearby_runners`, hydrated into User objects (with location and profile)."""
+    return hydrate_runners(find_nearby_runners(errand, max_distance_m=max_distance_m, limit=limit))
@@ -0,0 +1,86 @@
+"""Per-errand snapshot of the ranked nearby-runner list.
+
+CreateErrand, the matching job and every errandStatus poll need the same candidate list for an
+errand. It is computed once, cached for `RUNNER_SNAPSHOT_TTL_SECONDS`, and recomputed early only
+when a runner moves meaningfully inside one of the grid cells the snapshot covers.
+
+Each grid cell has a version token in the cache. A snapshot records the tokens of the cells it
+covered, and location writes replace the tokens of the cells they touch (`touch_runner_cells`).
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.locations.grid import grid_cell_for, grid_cells_within
+from runners.services import distance_between, find_nearby_runners
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = "runners:snapshot:{errand_id}"
+CELL_VERSION_KEY = "runners:cell-version:{cell}"
+
+
+def _cell_version_keys(cells):
+    return [CELL_VERSION_KEY.format(cell=cell) for cell in cells]
+
+
+def touch_runner_cells(*cells):
+    """Invalidate every snapshot covering any of these grid cells."""
+    token = time.time_ns()
+    cache.set_many({key: token for key in _cell_version_keys(set(cells))}, timeout=None)
+
+
+def note_runner_moved(old, new):
+    """Called on location writes with the previous and new (lat, lon) of a runner (old may be None).
+    Small moves inside the same cell are ignored so GPS jitter does not flush snapshots."""
+    new_cell = grid_cell_for(*new)
+    if old is None:
+        touch_runner_cells(new_cell)
+        return
+
+    old_cell = grid_cell_for(*old)
+    min_move_m = getattr(settings, 'RUNNER_SNAPSHOT_MIN_MOVE_M', 100)
+    if old_cell != new_cell or distance_between(old, new) >= min_move_m:
+        touch_runner_cells(old_cell, new_cell)
+
+
+def snapshot_nearby_runners(errand, limit=None):
+    """Ranked RunnerMatch rows for an errand, served from its snapshot when still valid.
+
+    The snapshot holds the top `RUNNER_MATCH_LIMIT` runners; callers asking for more (or for no
+    limit) bypass it, as do searches spanning too many cells to track.
+    """
+    snapshot_limit = getattr(settings, 'RUNNER_MATCH_LIMIT', 20)
+    if limit is None:
+        limit = snapshot_limit
+
+    go_to = getattr(errand, 'go_to', None)
+    errand_id = getattr(errand, 'id', None)
+    if go_to is None or errand_id is None or not limit or not snapshot_limit or limit > snapshot_limit:
+        return find_nearby_runners(errand, limit=limit)
+
+    cells = grid_cells_within(go_to.latitude, go_to.longitude, getattr(settings, 'RUNNER_SEARCH_RADIUS_M', 10000))
+    if cells is None:
+        return find_nearby_runners(errand, limit=limit)
+
+    version_keys = _cell_version_keys(cells)
+    key = SNAPSHOT_KEY.format(errand_id=errand_id)
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        versions = cache.get_many(version_keys)
+        if all(versions.get(k) == snapshot["versions"].get(k) for k in version_keys):
+            logger.debug("snapshot_nearby_runners: hit for errand=%s", errand_id)
+            return snapshot["matches"][:limit]
+        logger.info("snapshot_nearby_runners: runners moved near errand=%s; recomputing", errand_id)
+
+    # Read versions before computing so a move during the computation invalidates this snapshot
+    versions = cache.get_many(version_keys)
+    matches = find_nearby_runners(errand, limit=snapshot_limit)
+    cache.set(key, {"versions": versions, "matches": matches}, timeout=getattr(settings, 'RUNNER_SNAPSHOT_TTL_SECONDS', 30))
+    return matches[:limit]
+
+
+def drop_snapshot(errand_id):
+    cache.delete(SNAPSHOT_KEY.format(errand_id=errand_id))
@@ -1,3 +1,439 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, SimpleTestCase
+from django.utils import timezone
+
+from apps.errands.models import Errand, ErrandOffer
+from apps.locations.grid import grid_cell_for, grid_cells_within, region_for
+from apps.locations.models import UserLocation, LocationMode
+from apps.roles.models import Role
+from apps.users.models import UserProfile
+from errand_location.models import ErrandLocation
+from apps.locations.services import upsert_user_location
+from runners.models import RunnerPresence
+from runners.presence import errand_finished, errand_started, set_online
+from runners.index import RunnerIndex, make_index_server, runner_index
+from runners.services import (
+    get_nearby_runners,
+    find_nearby_runners,
+    distance_between,
+    distances_from,
+    _match_runners_db,
+    _match_runners_orm,
+)
+from runners.snapshots import snapshot_nearby_runners
+from runners import acceptance, density, index_snapshot, travel
+
+User = get_user_model()
+
+
+def make_runner(username, latitude, longitude, trust_score=60):
+    user = User.objects.create(username=username, email=f"{username}@example.com")
+    profile = UserProfile.objects.create(user=user, trust_score=trust_score)
+    profile.roles.add(Role.objects.get_or_create(name=Role.RUNNER)[0])
+    UserLocation.objects.create(user=user, latitude=latitude, longitude=longitude, mode=LocationMode.DEVICE)
+    RunnerPresence.objects.create(user=user)
+    return user
+
+
+def make_errand(latitude, longitude):
+    buyer, _ = User.objects.get_or_create(username="buyer", defaults={"email": "buyer@example.com"})
+    errand = Errand.objects.create(user=buyer, type=Errand.Type.ONE_WAY, speed="NORMAL", payment_method=Errand.PaymentMethod.CASH)
+    errand.go_to = ErrandLocation.objects.create(errand=errand, latitude=latitude, longitude=longitude, mode=LocationMode.STATIC)
+    errand.save(update_fields=["go_to"])
+    return errand
+
+
+class GridCellTests(TestCase):
+    def test_location_save_sets_grid_cell(self):
+        runner = make_runner("r1", 3.8480, 11.5021)
+        self.assertEqual(runner.location.grid_cell, grid_cell_for(3.8480, 11.5021))
+
+        runner.location.latitude = 4.0511
+        runner.location.longitude = 9.7679
+        runner.location.save(update_fields=["latitude", "longitude"])
+        runner.location.refresh_from_db()
+        self.assertEqual(runner.location.grid_cell, grid_cell_for(4.0511, 9.7679))
+
+    def test_cells_within_cover_point(self):
+        cells = grid_cells_within(3.8480, 11.5021, 5000)
+        self.assertIn(grid_cell_for(3.8480, 11.5021), cells)
+        self.assertIn(grid_cell_for(3.8480, 11.5021 + 0.04), cells)
+
+
+class RegionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_named_regions_and_grid_fallback(self):
+        self.assertEqual(region_for(3.8480, 11.5021), "yaounde")
+        self.assertEqual(region_for(4.0511, 9.7679), "douala")
+        self.assertEqual(region_for(5.9631, 10.1591), "g:5:10")
+
+    def test_runners_are_only_matched_within_the_errand_region(self):
+        inside = make_runner("inside", 3.8470, 11.5010)
+        across = make_runner("across", 3.8482, 11.5023)
+        errand = make_errand(3.8480, 11.5021)
+
+        # Split the city at longitude 11.5022: the closest runner is now in another region
+        regions = [("west", (3.70, 11.35, 4.05, 11.5022)), ("east", (3.70, 11.5022, 4.05, 11.70))]
+        with self.settings(REGIONS=regions):
+            for obj in (inside.location, across.location, errand.go_to):
+                obj.save()
+            self.assertEqual(errand.go_to.region, "west")
+            self.assertEqual(across.location.region, "east")
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [inside.id])
+
+
+class DistancesFromTests(SimpleTestCase):
+    def test_matches_scalar_distance_between(self):
+        origin = (3.8480, 11.5021)
+        lats = [3.8490, 4.0511, -33.9249, 3.8480]
+        lons = [11.5030, 9.7679, 18.4241, 11.5021]
+
+        dists = distances_from(origin, lats, lons)
+
+        self.assertEqual(len(dists), len(lats))
+        for dist, lat, lon in zip(dists, lats, lons):
+            self.assertAlmostEqual(float(dist), distance_between(origin, (lat, lon)), places=4)
+
+    def test_missing_coordinates_are_infinite(self):
+        self.assertEqual(float(distances_from((3.8480, 11.5021), [None], [None])[0]), float("inf"))
+
+
+class NearbyRunnersTests(TestCase):
+    def test_only_runners_inside_radius_are_ranked(self):
+        near = make_runner("near", 3.8490, 11.5030, trust_score=50)
+        nearer = make_runner("nearer", 3.8481, 11.5022, trust_score=40)
+        make_runner("far", 4.0511, 9.7679)  # Douala, ~200 km away
+        errand = make_errand(3.8480, 11.5021)
+
+        with self.settings(RUNNER_SEARCH_RADIUS_M=5000):
+            runners = get_nearby_runners(errand)
+
+        self.assertEqual([r.id for r in runners], [nearer.id, near.id])
+
+    def test_radius_and_limit_parameters(self):
+        near = make_runner("near", 3.8490, 11.5030, trust_score=50)
+        nearer = make_runner("nearer", 3.8481, 11.5022, trust_score=40)
+        tied = make_runner("tied", 3.8490, 11.5030, trust_score=90)
+        errand = make_errand(3.8480, 11.5021)
+
+        self.assertEqual([r.id for r in get_nearby_runners(errand, limit=2)], [nearer.id, tied.id])
+        self.assertEqual([r.id for r in get_nearby_runners(errand, max_distance_m=50)], [nearer.id])
+        self.assertEqual([m.runner_id for m in find_nearby_runners(errand, limit=0)], [nearer.id, tied.id, near.id])
+
+    def test_sql_and_python_rankings_are_identical(self):
+        offsets = [(0.001, 0.002), (-0.004, 0.0), (0.02, -0.03), (0.001, 0.002), (0.05, 0.05), (-0.07, 0.01)]
+        for i, (dlat, dlon) in enumerate(offsets):
+            make_runner(f"r{i}", 3.8480 + dlat, 11.5021 + dlon, trust_score=40 + i * 10)
+        errand = make_errand(3.8480, 11.5021)
+
+        for limit in (0, 3):
+            db = _match_runners_db(errand.go_to, 8000, limit)
+            py = _match_runners_orm(errand.go_to, 8000, limit)
+            self.assertEqual([m.runner_id for m in db], [m.runner_id for m in py])
+            for a, b in zip(db, py):
+                self.assertAlmostEqual(a.distance_m, b.distance_m, places=3)
+
+        with self.settings(RUNNER_DISTANCE_BACKEND="python"):
+            python_ids = [m.runner_id for m in find_nearby_runners(errand, max_distance_m=8000)]
+        with self.settings(RUNNER_DISTANCE_BACKEND="db"):
+            db_ids = [m.runner_id for m in find_nearby_runners(errand, max_distance_m=8000)]
+        self.assertEqual(db_ids, python_ids)
+
+
+class RunnerIndexTests(TestCase):
+    def test_within_orders_by_distance_then_trust(self):
+        index = RunnerIndex()
+        index.upsert(1, 3.8490, 11.5030, 50)
+        index.upsert(2, 3.8481, 11.5022, 40)
+        index.upsert(3, 4.0511, 9.7679, 90)
+        index.upsert(4, 3.8490, 11.5030, 80)
+
+        self.assertEqual([m.runner_id for m in index.within(3.8480, 11.5021, 5000)], [2, 4, 1])
+        self.assertEqual([m.runner_id for m in index.nearest(3.8480, 11.5021, 2, 500000)], [2, 4])
+
+    def test_upsert_moves_and_remove_frees_slot(self):
+        index = RunnerIndex()
+        index.upsert(1, 3.8480, 11.5021)
+        index.upsert(1, 4.0511, 9.7679)
+        self.assertEqual(index.within(3.8480, 11.5021, 5000), [])
+        self.assertTrue(index.remove(1))
+        index.upsert(2, 3.8480, 11.5021)
+        self.assertEqual(len(index), 1)
+        self.assertEqual([m.runner_id for m in index.within(3.8480, 11.5021, 5000)], [2])
+
+    def test_runners_with_lapsed_heartbeat_are_skipped(self):
+        index = RunnerIndex()
+        index.upsert(1, 3.8481, 11.5022, seen_at=time.time() - 301)
+        index.upsert(2, 3.8490, 11.5030)
+        with self.settings(RUNNER_PRESENCE_TIMEOUT_SECONDS=300):
+            self.assertEqual([m.runner_id for m in index.within(3.8480, 11.5021, 5000)], [2])
+            # A new heartbeat brings the runner back
+            index.upsert(1, 3.8481, 11.5022)
+            self.assertEqual([m.runner_id for m in index.within(3.8480, 11.5021, 5000)], [1, 2])
+
+
+class RunnerIndexServerTests(TestCase):
+    def test_find_nearby_runners_uses_index_and_falls_back(self):
+        near = make_runner("near", 3.8490, 11.5030)
+        errand = make_errand(3.8480, 11.5021)
+
+        index = RunnerIndex()
+        index.upsert(near.id, 3.8490, 11.5030, 60)
+        address = "unix:" + os.path.join(tempfile.mkdtemp(), "index.sock")
+        server = make_index_server(index, address)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with self.settings(RUNNER_INDEX_ADDRESS=address):
+                self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [near.id])
+                # Runner 999 exists only in the index: proves the answer came from it
+                self.assertTrue(runner_index.upsert(999, 3.8481, 11.5022))
+                self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [999, near.id])
+                self.assertEqual([r.id for r in get_nearby_runners(errand)], [near.id])
+        finally:
+            server.shutdown()
+            server.server_close()
+            runner_index._close()
+
+        with self.settings(RUNNER_INDEX_ADDRESS=address):
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [near.id])
+        runner_index._down_until.clear()
+
+
+class RunnerSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_snapshot_reused_until_a_runner_moves_nearby(self):
+        runner = make_runner("near", 3.8490, 11.5030)
+        errand = make_errand(3.8480, 11.5021)
+
+        first = snapshot_nearby_runners(errand)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot_nearby_runners(errand, limit=10), first)
+
+        # GPS jitter inside the same cell keeps the snapshot
+        upsert_user_location(runner, LocationMode.DEVICE, 3.84901, 11.50301)
+        with self.assertNumQueries(0):
+            snapshot_nearby_runners(errand)
+
+        # Moving away invalidates it
+        upsert_user_location(runner, LocationMode.DEVICE, 4.0511, 9.7679)
+        self.assertEqual(snapshot_nearby_runners(errand), [])
+
+
+class RunnerPresenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_only_online_recent_idle_runners_are_matched(self):
+        idle = make_runner("idle", 3.8490, 11.5030)
+        busy = make_runner("busy", 3.8481, 11.5022)
+        stale = make_runner("stale", 3.8482, 11.5023)
+        offline = make_runner("offline", 3.8483, 11.5024)
+        errand = make_errand(3.8480, 11.5021)
+
+        errand_started(busy)
+        RunnerPresence.objects.filter(user=stale).update(last_heartbeat_at=timezone.now() - timedelta(days=14))
+        set_online(offline, False)
+
+        self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [idle.id])
+
+        errand_finished(busy)
+        upsert_user_location(stale, LocationMode.DEVICE, 3.8482, 11.5023)
+        set_online(offline, True)
+        self.assertEqual(
+            [m.runner_id for m in find_nearby_runners(errand)],
+            [busy.id, stale.id, offline.id, idle.id],
+        )
+
+    def test_only_runners_can_go_online(self):
+        from core.schema import schema
+
+        buyer = User.objects.create(username="buyer", email="buyer@example.com")
+        UserProfile.objects.create(user=buyer)
+        mutation = "mutation { setRunnerOnline(online: true) { ok online } }"
+
+        result = schema.execute(mutation, context_value=mock.Mock(user=buyer))
+        self.assertEqual([e.message for e in result.errors], ["Only runners can go on duty"])
+        self.assertFalse(RunnerPresence.objects.filter(user=buyer).exists())
+
+        runner = make_runner("runner", 3.8480, 11.5021)
+        set_online(runner, False)
+        result = schema.execute(mutation, context_value=mock.Mock(user=runner))
+        self.assertIsNone(result.errors)
+        self.assertTrue(RunnerPresence.objects.get(user=runner).is_online)
+
+
+class RunnerDensityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_runners_are_clustered_per_tile_cell(self):
+        make_runner("a", 3.8460, 11.5060)
+        make_runner("b", 3.8470, 11.5070)
+        make_runner("far", 3.9500, 11.6500)
+        busy = make_runner("busy", 3.8466, 11.5066)
+        errand_started(busy)
+
+        zoom, clusters = density.runner_density(3.80, 11.45, 4.00, 11.70, 12)
+        self.assertEqual(zoom, 12)
+        self.assertEqual(sorted(c.count for c in clusters), [1, 2])
+        pair = max(clusters, key=lambda c: c.count)
+        self.assertAlmostEqual(pair.latitude, 3.8465)
+        self.assertAlmostEqual(pair.longitude, 11.5065)
+
+        # Served from the tile cache until it expires
+        make_runner("late", 3.8465, 11.5065)
+        self.assertEqual(sorted(c.count for c in density.runner_density(3.80, 11.45, 4.00, 11.70, 12)[1]), [1, 2])
+        cache.clear()
+        self.assertEqual(sorted(c.count for c in density.runner_density(3.80, 11.45, 4.00, 11.70, 12)[1]), [1, 3])
+
+    def test_runners_at_the_same_spot_are_all_counted(self):
+        for name in ("a", "b", "c"):
+            make_runner(name, 3.8460, 11.5060)
+        _, clusters = density.runner_density(3.80, 11.45, 4.00, 11.70, 12)
+        self.assertEqual([c.count for c in clusters], [3])
+
+    def test_large_boxes_lower_the_zoom(self):
+        with self.settings(RUNNER_DENSITY_MAX_TILES=4):
+            zoom, tiles = density.tiles_for_bbox(3.0, 9.0, 5.0, 12.0, 14)
+        self.assertLess(zoom, 14)
+        self.assertLessEqual(len(tiles), 4)
+
+
+# An L-shaped road: A -> B (east) -> C (north), so A to C is ~40% longer by road than straight
+ROAD_OSM = """<?xml version="1.0"?>
+<osm version="0.6">
+  <node id="1" lat="3.8000" lon="11.5000"/>
+  <node id="2" lat="3.8000" lon="11.5200"/>
+  <node id="3" lat="3.8200" lon="11.5200"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="residential"/></way>
+</osm>
+"""
+
+
+class TravelProviderTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        osm_path = os.path.join(self.directory, "area.osm")
+        with open(osm_path, "w") as fh:
+            fh.write(ROAD_OSM)
+        coords, adjacency = travel.load_osm_graph(osm_path)
+        meta, distances, etas = travel.build_travel_matrix(coords, adjacency, 3.7975, 11.4975, 3.8225, 11.5225, 0.005)
+        travel.write_travel_matrix(self.directory, meta, distances, etas)
+        self.addCleanup(travel.reset_travel_provider)
+
+    def test_matrix_lookup_follows_the_road(self):
+        provider = travel.MatrixProvider(self.directory)
+        a, c = (3.8001, 11.5001), (3.8201, 11.5201)
+
+        straight = distance_between(a, c)
+        self.assertAlmostEqual(provider.distance_m(a, c), 2 * distance_between(a, (3.8001, 11.5201)), delta=100)
+        self.assertGreater(provider.distance_m(a, c), straight * 1.3)
+        # Outside the matrix area: straight line
+        self.assertEqual(provider.distance_m(a, (4.0511, 9.7679)), distance_between(a, (4.0511, 9.7679)))
+
+    def test_matching_ranks_by_road_distance(self):
+        cache.clear()
+        by_road = make_runner("by_road", 3.8201, 11.5201)  # closer in a straight line, far by road
+        off_grid = make_runner("off_grid", 3.8001, 11.5290)  # no road data: straight line
+        errand = make_errand(3.8001, 11.5001)
+
+        with self.settings(TRAVEL_PROVIDER="haversine"):
+            travel.reset_travel_provider()
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [by_road.id, off_grid.id])
+
+        with self.settings(TRAVEL_PROVIDER="matrix", TRAVEL_MATRIX_DIR=self.directory):
+            travel.reset_travel_provider()
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand, limit=1)], [off_grid.id])
+
+
+class AcceptanceScoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.path = os.path.join(tempfile.mkdtemp(), "acceptance.npz")
+        self.addCleanup(acceptance.reset_acceptance_table)
+
+    def test_fit_smooths_towards_overall_rate_and_penalises_late_accepts(self):
+        ids, p, p_all = acceptance.fit_acceptance(
+            [1, 1, 1, 1, 2, 3, 3], [True, True, True, True, False, True, True], [0, 0, 0, 0, 0, 0, 60], [0] * 7,
+            ttl_s=60, prior_weight=1.0,
+        )
+        self.assertEqual(ids.tolist(), [1, 2, 3])
+        self.assertAlmostEqual(p_all, 5.5 / 7)
+        self.assertGreater(p[0], p[2])  # runner 3 accepted once at the end of the TTL
+        self.assertAlmostEqual(float(p[1]), p_all / 2, places=5)  # one rejection, one offer of prior
+
+    def test_fitted_table_reorders_candidates(self):
+        ignores = make_runner("ignores", 3.8481, 11.5021)
+        accepts = make_runner("accepts", 3.8490, 11.5030)
+        now = timezone.now()
+        for _ in range(6):
+            errand = make_errand(3.8480, 11.5021)
+            ErrandOffer.objects.create(errand=errand, runner=ignores, position=1, status=ErrandOffer.Status.EXPIRED, expires_at=now)
+            ErrandOffer.objects.create(
+                errand=errand, runner=accepts, position=2, status=ErrandOffer.Status.ACCEPTED, expires_at=now, responded_at=now
+            )
+        Errand.objects.update(is_open=False)
+        errand = make_errand(3.8480, 11.5021)
+
+        with self.settings(RUNNER_ACCEPTANCE_TABLE_PATH=self.path):
+            acceptance.reset_acceptance_table()
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [ignores.id, accepts.id])
+
+            call_command("fit_acceptance_scores", stdout=io.StringIO())
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand)], [accepts.id, ignores.id])
+            self.assertEqual([m.runner_id for m in find_nearby_runners(errand, limit=1)], [accepts.id])
+
+
+class RunnerIndexWarmStartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.path = os.path.join(tempfile.mkdtemp(), "runner-index.snap")
+
+    def test_warm_start_loads_snapshot_and_catches_up(self):
+        kept = make_runner("kept", 3.8480, 11.5020, trust_score=80)
+        moved = make_runner("moved", 3.8490, 11.5030)
+        went_busy = make_runner("went_busy", 3.8500, 11.5040)
+        stale = make_runner("stale", 3.8510, 11.5050)
+        RunnerPresence.objects.filter(user=stale).update(last_heartbeat_at=timezone.now() - timedelta(days=14))
+
+        index_snapshot.rebuild(RunnerIndex(), self.path)
+        snapshot = index_snapshot.RunnerSnapshot(self.path)
+        self.assertEqual(len(snapshot), 4)
+        self.assertEqual(sorted(r[0] for r in snapshot.available_rows()), sorted([kept.id, moved.id, went_busy.id]))
+        snapshot.close()
+
+        # Changes after the snapshot are picked up by the catch-up query
+        upsert_user_location(moved, LocationMode.DEVICE, 3.9000, 11.6000)
+        errand_started(went_busy)
+        late = make_runner("late", 3.8485, 11.5025)
+
+        index = RunnerIndex()
+        self.assertTrue(index_snapshot.warm_start(index, self.path))
+        self.assertEqual(
+            [m.runner_id for m in index.within(3.8480, 11.5020, 1000)],
+            [kept.id, late.id],
+        )
+        self.assertEqual([m.runner_id for m in index.within(3.9000, 11.6000, 100)], [moved.id])
+
+    def test_missing_or_expired_snapshot_is_not_used(self):
+        index = RunnerIndex()
+        self.assertFalse(index_snapshot.warm_start(index, self.path))
+
+        make_runner("runner", 3.8480, 11.5020)
+        index_snapshot.rebuild(index, self.path)
+        with self.settings(RUNNER_INDEX_SNAPSHOT_MAX_AGE_SECONDS=-1):
+            self.assertFalse(index_snapshot.warm_start(RunnerIndex(), self.path))
@@ -0,0 +1,303 @@
+"""Distance / ETA providers used by matching and pricing.
+
+`MatrixProvider` (the default) answers road distance and travel time between two points in O(1)
+from a cell-to-cell matrix precomputed offline from an OSM extract by
+`manage.py build_travel_matrix` and memory-mapped from `TRAVEL_MATRIX_DIR`. `HaversineProvider`
+(straight line) is the fallback: used when no matrix has been built, and for points outside the
+matrix area or pairs with no road path.
+
+Select with `TRAVEL_PROVIDER` = "matrix" | "haversine".
+"""
+import heapq
+import json
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+from math import floor
+
+from django.conf import settings
+
+from runners.services import _point_coords, distance_between, distances_from, np
+
+logger = logging.getLogger(__name__)
+
+MATRIX_META = "meta.json"
+MATRIX_DISTANCES = "distance_m.npy"
+MATRIX_ETAS = "eta_s.npy"
+
+
+def _average_speed_mps():
+    return float(getattr(settings, 'RUNNER_AVG_SPEED_MPS', 5.0))
+
+
+class HaversineProvider:
+    name = "haversine"
+
+    def distance_m(self, origin, destination):
+        return distance_between(origin, destination)
+
+    def eta_seconds(self, origin, destination):
+        return self.distance_m(origin, destination) / _average_speed_mps()
+
+    def distances_from(self, origin, lats, lons):
+        return distances_from(origin, lats, lons)
+
+
+class MatrixProvider(HaversineProvider):
+    """Road distances/ETAs between grid cells of a local area, read from memory-mapped .npy files.
+
+    meta.json describes the grid: {"min_lat", "min_lon", "cell_deg", "rows", "cols"}; cell
+    (row, col) has index row * cols + col in both square matrices.
+    """
+    name = "matrix"
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, MATRIX_META)) as fh:
+            meta = json.load(fh)
+        self.min_lat = float(meta["min_lat"])
+        self.min_lon = float(meta["min_lon"])
+        self.cell_deg = float(meta["cell_deg"])
+        self.rows = int(meta["rows"])
+        self.cols = int(meta["cols"])
+        self.distances = np.load(os.path.join(directory, MATRIX_DISTANCES), mmap_mode="r")
+        self.etas = np.load(os.path.join(directory, MATRIX_ETAS), mmap_mode="r")
+
+    def cell_index(self, latitude, longitude):
+        row = floor((float(latitude) - self.min_lat) / self.cell_deg)
+        col = floor((float(longitude) - self.min_lon) / self.cell_deg)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row * self.cols + col
+        return None
+
+    def _lookup(self, matrix, origin, destination):
+        try:
+            a = self.cell_index(*_point_coords(origin))
+            b = self.cell_index(*_point_coords(destination))
+        except (TypeError, ValueError, IndexError):
+            return None
+        if a is None or b is None:
+            return None
+        value = float(matrix[a, b])
+        return value if np.isfinite(value) else None
+
+    # Cell-level values are coarse (two points in the same cell read 0), and a road is never
+    # shorter than the straight line: never answer below the Haversine figure.
+
+    def distance_m(self, origin, destination):
+        straight = super().distance_m(origin, destination)
+        value = self._lookup(self.distances, origin, destination)
+        return max(value, straight) if value is not None else straight
+
+    def eta_seconds(self, origin, destination):
+        straight = super().eta_seconds(origin, destination)
+        value = self._lookup(self.etas, origin, destination)
+        return max(value, straight) if value is not None else straight
+
+    def distances_from(self, origin, lats, lons):
+        """Road distances from every (lats[i], lons[i]) runner position to `origin` (the errand)."""
+        straight = np.asarray(super().distances_from(origin, lats, lons), dtype=np.float64)
+        target = self.cell_index(*_point_coords(origin))
+        if target is None:
+            return straight
+
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        rows = np.floor((lats - self.min_lat) / self.cell_deg)
+        cols = np.floor((lons - self.min_lon) / self.cell_deg)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+
+        road = straight.copy()
+        cells = (rows[inside] * self.cols + cols[inside]).astype(np.intp)
+        values = np.asarray(self.distances[cells, target], dtype=np.float64)
+        road[inside] = np.where(np.isfinite(values), values, straight[inside])
+        return np.maximum(road, straight)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_travel_provider():
+    """The configured provider, loaded once per process. Falls back to Haversine when the
+    matrix files are missing or NumPy is unavailable."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = _load_provider()
+    return _provider
+
+
+def _load_provider():
+    if getattr(settings, 'TRAVEL_PROVIDER', 'matrix') == 'matrix':
+        directory = str(getattr(settings, 'TRAVEL_MATRIX_DIR', ''))
+        if not os.path.exists(os.path.join(directory, MATRIX_META)):
+            logger.info("travel provider: no matrix in %r (run build_travel_matrix); using haversine", directory)
+            return HaversineProvider()
+        try:
+            if np is None:
+                raise RuntimeError("NumPy is not installed")
+            provider = MatrixProvider(directory)
+            logger.info("travel provider: matrix %sx%s cells loaded from %s", provider.rows, provider.cols, directory)
+            return provider
+        except Exception:
+            logger.exception("travel provider: failed to load matrix from %s; using haversine", directory)
+    return HaversineProvider()
+
+
+def reset_travel_provider():
+    """Forget the loaded provider (after rebuilding the matrix or changing settings)."""
+    global _provider
+    _provider = None
+
+
+# -------------------------------------------------------------------
+# Offline matrix build (manage.py build_travel_matrix)
+# -------------------------------------------------------------------
+
+# Default speeds (km/h) per OSM highway class; ways of other classes (footway, steps, ...) are skipped
+HIGHWAY_SPEEDS_KMH = {
+    "motorway": 80, "motorway_link": 50, "trunk": 60, "trunk_link": 40,
+    "primary": 45, "primary_link": 35, "secondary": 40, "secondary_link": 30,
+    "tertiary": 35, "tertiary_link": 25, "unclassified": 25, "residential": 25,
+    "living_street": 10, "service": 15, "track": 15, "road": 25,
+}
+
+
+def _way_speed_kmh(tags):
+    maxspeed = tags.get("maxspeed", "").split(" ")[0]
+    if maxspeed.isdigit() and int(maxspeed) > 0:
+        return float(maxspeed)
+    return float(HIGHWAY_SPEEDS_KMH[tags["highway"]])
+
+
+def load_osm_graph(path):
+    """Road graph from an OSM XML extract (.osm; convert .pbf with osmium first).
+
+    Returns (coords, adjacency): coords[i] = (lat, lon) of node i, adjacency[i] = [(j, meters,
+    seconds), ...]. Nodes are streamed, so only the coordinates and the drivable ways are kept.
+    """
+    node_coords = {}
+    ways = []
+    tags = {}
+    refs = []
+    for _event, elem in ET.iterparse(path, events=("end",)):
+        if elem.tag == "node":
+            node_coords[elem.get("id")] = (float(elem.get("lat")), float(elem.get("lon")))
+            tags = {}
+            elem.clear()
+        elif elem.tag == "nd":
+            refs.append(elem.get("ref"))
+        elif elem.tag == "tag":
+            tags[elem.get("k")] = elem.get("v")
+        elif elem.tag == "way":
+            if tags.get("highway") in HIGHWAY_SPEEDS_KMH and len(refs) > 1:
+                ways.append((refs, dict(tags)))
+            refs, tags = [], {}
+            elem.clear()
+        elif elem.tag in ("relation", "member"):
+            refs, tags = [], {}
+            elem.clear()
+
+    index_of = {}
+    coords = []
+    adjacency = []
+
+    def node(ref):
+        i = index_of.get(ref)
+        if i is None:
+            i = index_of[ref] = len(coords)
+            coords.append(node_coords[ref])
+            adjacency.append([])
+        return i
+
+    for refs, way_tags in ways:
+        refs = [r for r in refs if r in node_coords]
+        speed_mps = _way_speed_kmh(way_tags) / 3.6
+        oneway = way_tags.get("oneway")
+        for a_ref, b_ref in zip(refs, refs[1:]):
+            a, b = node(a_ref), node(b_ref)
+            meters = distance_between(coords[a], coords[b])
+            seconds = meters / speed_mps
+            if oneway != "-1":
+                adjacency[a].append((b, meters, seconds))
+            if oneway not in ("yes", "1", "true"):
+                adjacency[b].append((a, meters, seconds))
+    return coords, adjacency
+
+
+def _shortest_paths(adjacency, source):
+    """Dijkstra on travel time from `source`: (seconds, meters) along the fastest path, per node."""
+    seconds = {source: 0.0}
+    meters = {source: 0.0}
+    done = set()
+    heap = [(0.0, source)]
+    while heap:
+        t, u = heapq.heappop(heap)
+        if u in done:
+            continue
+        done.add(u)
+        for v, edge_m, edge_s in adjacency[u]:
+            nt = t + edge_s
+            if nt < seconds.get(v, float("inf")):
+                seconds[v] = nt
+                meters[v] = meters[u] + edge_m
+                heapq.heappush(heap, (nt, v))
+    return seconds, meters
+
+
+def build_travel_matrix(coords, adjacency, min_lat, min_lon, max_lat, max_lon, cell_deg, progress=None):
+    """Cell-to-cell (distance_m, eta_s) float32 matrices over the bounding box.
+
+    Each cell is represented by the graph node closest to its centre; cells without a road node
+    keep inf rows/columns so lookups involving them fall back to Haversine.
+    """
+    rows = max(1, int(np.ceil((max_lat - min_lat) / cell_deg)))
+    cols = max(1, int(np.ceil((max_lon - min_lon) / cell_deg)))
+
+    # Representative node per cell: closest to the cell centre
+    best = {}
+    for i, (lat, lon) in enumerate(coords):
+        if not adjacency[i]:
+            continue
+        row = floor((lat - min_lat) / cell_deg)
+        col = floor((lon - min_lon) / cell_deg)
+        if not (0 <= row < rows and 0 <= col < cols):
+            continue
+        cell = row * cols + col
+        centre = (min_lat + (row + 0.5) * cell_deg, min_lon + (col + 0.5) * cell_deg)
+        d = distance_between(centre, (lat, lon))
+        if cell not in best or d < best[cell][0]:
+            best[cell] = (d, i)
+
+    size = rows * cols
+    distances = np.full((size, size), np.inf, dtype=np.float32)
+    etas = np.full((size, size), np.inf, dtype=np.float32)
+    targets = sorted((cell, node) for cell, (_d, node) in best.items())
+    for n, (cell, node) in enumerate(targets):
+        seconds, meters = _shortest_paths(adjacency, node)
+        for other_cell, other_node in targets:
+            if other_node in seconds:
+                etas[cell, other_cell] = seconds[other_node]
+                distances[cell, other_cell] = meters[other_node]
+        if progress is not None:
+            progress(n + 1, len(targets))
+
+    meta = {"min_lat": min_lat, "min_lon": min_lon, "cell_deg": cell_deg, "rows": rows, "cols": cols}
+    return meta, distances, etas
+
+
+def write_travel_matrix(directory, meta, distances, etas):
+    """Write the matrix files; each file is swapped in atomically and meta.json goes last, so a
+    concurrently starting worker never maps a half-written matrix."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in ((MATRIX_DISTANCES, distances), (MATRIX_ETAS, etas)):
+        tmp = os.path.join(directory, name + ".tmp")
+        with open(tmp, "wb") as fh:
+            np.save(fh, array)
+        os.replace(tmp, os.path.join(directory, name))
+    tmp = os.path.join(directory, MATRIX_META + ".tmp")
+    with open(tmp, "w") as fh:
+        json.dump(meta, fh)
+    os.replace(tmp, os.path.join(directory, MATRIX_META))